@@ -0,0 +1,482 @@
+"""DETECTOR-DE-NOVEDADES/database_tools/backends.py"""
+import datetime
+import os
+import sqlite3
+import uuid
+from urllib import parse
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+def _register_sqlite_adapters():
+    """
+    Lets sqlite3 bind the dates as ISO 'YYYY-MM-DD' text, which sorts and compares like a DATE,
+    and the numpy scalars as Python numbers. numpy and pandas are imported here so the
+    SQL Server runs do not import them through this module.
+    """
+    import numpy as np
+    import pandas as pd
+    for date_type in (datetime.date, datetime.datetime, pd.Timestamp):
+        sqlite3.register_adapter(date_type, lambda value: value.isoformat()[:10])
+    for integer_type in (np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64, np.bool_):
+        sqlite3.register_adapter(integer_type, int)
+    sqlite3.register_adapter(np.float32, float)
+
+# Types of the format files of BULK INSERT for the native values of each column type
+BCP_NATIVE_TYPES = {
+    'BIGINT': 'SQLBIGINT',
+    'INT': 'SQLINT',
+    'FLOAT': 'SQLFLT8'
+}
+
+def _server_path(server_directory, file_name):
+    """
+    Joins a file name to the staging directory as seen by SQL Server (Windows or Linux), escaping quotes.
+    """
+    separator = '\\' if '\\' in server_directory else '/'
+    return f"{server_directory.rstrip(separator)}{separator}{file_name}".replace("'", "''")
+
+def rows_exist(cursor, from_clause, params=()):
+    """
+    Checks whether a query returns any row, reading at most one row in both backends.
+
+    Args:
+        cursor: Database cursor.
+        from_clause (str): The FROM and WHERE clauses of the query, e.g. 'FROM dbo.ConsumosMIPS WHERE IdFecha = ?'.
+        params (tuple, optional): Parameters of the query.
+
+    Returns:
+        bool: True if the query returns at least one row.
+    """
+    cursor.execute(f'SELECT CASE WHEN EXISTS (SELECT 1 {from_clause}) THEN 1 ELSE 0 END', tuple(params))
+    return bool(cursor.fetchone()[0])
+
+class SqlServerBackend:
+    """
+    Statements of the pipeline that are specific to SQL Server (pyodbc): temporary #tables,
+    sequences, MERGE and the catalog functions.
+    """
+    name = 'sqlserver'
+    binary_type = 'VARBINARY(MAX)'
+    count_rows = 'COUNT_BIG(*)'
+    # Writes to different tables from different connections run in parallel
+    concurrent_writes = True
+
+    def create_engine(self, connection_string, pool_size, max_overflow):
+        """
+        Creates a pooled engine over an ODBC connection string.
+        """
+        return create_engine(
+            f"mssql+pyodbc:///?odbc_connect={parse.quote_plus(connection_string)}",
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=True,
+            fast_executemany=True
+        )
+
+    def prepare_bulk(self, cursor):
+        """
+        Enables fast_executemany, so executemany sends the parameters in arrays.
+        """
+        cursor.fast_executemany = True
+
+    def table_exists(self, cursor, table):
+        """
+        Checks whether dbo.table exists.
+        """
+        cursor.execute("SELECT CASE WHEN OBJECT_ID(?, 'U') IS NULL THEN 0 ELSE 1 END", (f'dbo.{table}',))
+        return bool(cursor.fetchone()[0])
+
+    def column_exists(self, cursor, table, column):
+        """
+        Checks whether dbo.table has the given column.
+        """
+        cursor.execute('SELECT CASE WHEN COL_LENGTH(?, ?) IS NULL THEN 0 ELSE 1 END', (f'dbo.{table}', column))
+        return bool(cursor.fetchone()[0])
+
+    def count_tables(self, cursor, tables):
+        """
+        Counts how many of the given tables exist in the dbo schema.
+        """
+        placeholders = ', '.join('?' for _ in tables)
+        cursor.execute(f"""
+            SELECT COUNT(*)
+            FROM information_schema.tables
+            WHERE table_schema = 'dbo' AND table_catalog = 'Consumos-PrediccionesMIPS'
+            AND table_name IN ({placeholders});
+        """, tuple(tables))
+        return cursor.fetchone()[0]
+
+    def drop_table(self, cursor, table):
+        """
+        Drops dbo.table if it exists.
+        """
+        cursor.execute(f"IF OBJECT_ID('{table}', 'U') IS NOT NULL DROP TABLE {table}")
+
+    def limit(self, query, rows):
+        """
+        Limits a SELECT statement to its first rows.
+        """
+        return query.replace('SELECT', f'SELECT TOP ({int(rows)})', 1)
+
+    def stage_rows(self, cursor, table_name, columns, rows):
+        """
+        Creates the temporary table #table_name and bulk loads the rows into it. The text columns
+        take the collation of the database, so they can be compared with its tables.
+        """
+        columns = [
+            (name, f'{sql_type} COLLATE DATABASE_DEFAULT' if 'CHAR' in sql_type.upper() else sql_type)
+            for name, sql_type in columns
+        ]
+        column_definitions = ', '.join(f'{name} {sql_type}' for name, sql_type in columns)
+        column_names = ', '.join(name for name, _ in columns)
+        placeholders = ', '.join('?' for _ in columns)
+        self.drop_staging(cursor, table_name)
+        cursor.execute(f'CREATE TABLE {table_name} ({column_definitions})')
+        if rows:
+            self.prepare_bulk(cursor)
+            cursor.executemany(f'INSERT INTO {table_name} ({column_names}) VALUES ({placeholders})', rows)
+        return table_name
+
+    def drop_staging(self, cursor, table_name):
+        """
+        Drops a temporary table created with stage_rows.
+        """
+        cursor.execute(f"IF OBJECT_ID('tempdb..{table_name}') IS NOT NULL DROP TABLE {table_name}")
+
+    def bulk_insert(self, cursor, table, columns, records, batch_rows, staging_directory=None, server_directory=None):
+        """
+        Inserts a typed record array into a table, batch_rows rows per statement, in the open transaction.
+
+        By default every batch is converted to rows in one call and sent with fast_executemany. With a
+        server_directory, the file based load is used instead: every batch is written as is (native
+        little-endian values, no per-row conversion) to a data file of the staging_directory described by an
+        XML format file, and loaded with BULK INSERT. The directory must be a share that the SQL Server
+        service reads as server_directory, and the login needs the ADMINISTER BULK OPERATIONS permission.
+        The columns must then be all the columns of the table, in order.
+        """
+        if server_directory is None:
+            self.prepare_bulk(cursor)
+            placeholders = ', '.join('?' for _ in columns)
+            column_names = ', '.join(name for name, _ in columns)
+            for start in range(0, len(records), batch_rows):
+                cursor.executemany(
+                    f'INSERT INTO {table} ({column_names}) VALUES ({placeholders})',
+                    records[start:start + batch_rows].tolist()
+                )
+            return
+
+        staging_directory = staging_directory or server_directory
+        os.makedirs(staging_directory, exist_ok=True)
+        prefix = f'{table.replace(".", "_")}_{os.getpid()}_{uuid.uuid4().hex}'
+        format_name = f'{prefix}.xml'
+        fields = ''.join(
+            f'<FIELD ID="{position}" xsi:type="NativeFixed" LENGTH="{records.dtype[name].itemsize}"/>'
+            for position, (name, _) in enumerate(columns, start=1)
+        )
+        row = ''.join(
+            f'<COLUMN SOURCE="{position}" NAME="{name}" xsi:type="{BCP_NATIVE_TYPES[sql_type.upper()]}"/>'
+            for position, (name, sql_type) in enumerate(columns, start=1)
+        )
+        written = [os.path.join(staging_directory, format_name)]
+        try:
+            with open(written[0], 'w') as format_file:
+                format_file.write(
+                    '<?xml version="1.0"?>'
+                    '<BCPFORMAT xmlns="http://schemas.microsoft.com/sqlserver/2004/bulkload/format" '
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+                    f'<RECORD>{fields}</RECORD><ROW>{row}</ROW></BCPFORMAT>'
+                )
+            for batch, start in enumerate(range(0, len(records), batch_rows)):
+                data_name = f'{prefix}_{batch}.dat'
+                written.append(os.path.join(staging_directory, data_name))
+                records[start:start + batch_rows].tofile(written[-1])
+                data_path = _server_path(server_directory, data_name)
+                format_path = _server_path(server_directory, format_name)
+                cursor.execute(
+                    f"BULK INSERT {table} FROM '{data_path}' WITH (FORMATFILE = '{format_path}', TABLOCK)"
+                )
+        finally:
+            for path in written:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def sequence_exists(self, cursor, sequence_name):
+        """
+        Checks whether a sequence exists.
+        """
+        cursor.execute("SELECT CASE WHEN OBJECT_ID(?, 'SO') IS NULL THEN 0 ELSE 1 END", (sequence_name,))
+        return bool(cursor.fetchone()[0])
+
+    def create_sequence(self, cursor, sequence_name, start_value=1):
+        """
+        Creates a BIGINT sequence without an upper bound that starts at start_value.
+        """
+        cursor.execute(f"""
+            CREATE SEQUENCE {sequence_name} AS BIGINT
+            START WITH {int(start_value)}
+            INCREMENT BY 1
+            MINVALUE 1
+            NO MAXVALUE
+            NO CYCLE;
+        """)
+
+    def remove_sequence_limit(self, cursor, sequence_name):
+        """
+        Removes the upper bound of a sequence created by an older version, so it never cycles.
+        """
+        cursor.execute(f'ALTER SEQUENCE {sequence_name} NO MAXVALUE NO CYCLE')
+
+    def drop_sequence(self, cursor, sequence_name):
+        """
+        Drops a sequence if it exists.
+        """
+        cursor.execute(f"IF OBJECT_ID('{sequence_name}', 'SO') IS NOT NULL DROP SEQUENCE {sequence_name}")
+
+    def allocate_ids(self, cursor, sequence_name, count):
+        """
+        Reserves count consecutive values of a sequence in a single call.
+        """
+        cursor.execute("""
+            SET NOCOUNT ON;
+            DECLARE @PrimerValor SQL_VARIANT;
+            EXEC sys.sp_sequence_get_range
+                @sequence_name = ?,
+                @range_size = ?,
+                @range_first_value = @PrimerValor OUTPUT;
+            SELECT CAST(@PrimerValor AS BIGINT);
+        """, (sequence_name, count))
+        first_value = int(cursor.fetchone()[0])
+        return range(first_value, first_value + count)
+
+    def restart_sequence(self, cursor, sequence_name, start_value=1):
+        """
+        Restarts a sequence at start_value without an upper bound.
+        """
+        cursor.execute(f"""
+            ALTER SEQUENCE {sequence_name}
+            RESTART WITH {int(start_value)}
+            INCREMENT BY 1
+            MINVALUE 1
+            NO MAXVALUE
+            NO CYCLE;
+        """)
+
+    def insert_dimension_rows(self, cursor, table, id_column, key_names, staging_table, id_sequence=None):
+        """
+        Inserts the staged keys missing from a dimension table and returns the (Fila, ID) pair of every
+        staged key, in a single batch. The new IDs come from id_sequence, or follow MAX(id_column).
+        """
+        if id_sequence is None:
+            id_expression = '@UltimoId + ROW_NUMBER() OVER (ORDER BY t.Fila)'
+        else:
+            id_expression = f'NEXT VALUE FOR {id_sequence}'
+        key_match = ' AND '.join(f'd.{name} = t.{name}' for name in key_names)
+        cursor.execute(f"""
+            SET NOCOUNT ON;
+            DECLARE @UltimoId INT = (SELECT ISNULL(MAX({id_column}), 0) FROM dbo.{table});
+            INSERT INTO dbo.{table} ({id_column}, {', '.join(key_names)})
+            SELECT {id_expression}, {', '.join(f't.{name}' for name in key_names)}
+            FROM {staging_table} t
+            WHERE NOT EXISTS (SELECT 1 FROM dbo.{table} d WHERE {key_match});
+            SELECT t.Fila, d.{id_column}
+            FROM {staging_table} t
+            INNER JOIN dbo.{table} d ON {key_match};
+        """)
+        return cursor.fetchall()
+
+    def merge_rows(self, cursor, table, key_columns, value_columns, source, params=()):
+        """
+        Inserts the rows of source into dbo.table, updating the value columns of the keys that already exist.
+        source is a table name or a parenthesized SELECT.
+        """
+        columns = key_columns + value_columns
+        cursor.execute(f"""
+            MERGE dbo.{table} AS m
+            USING {source} AS s
+            ON {' AND '.join(f'm.{name} = s.{name}' for name in key_columns)}
+            WHEN MATCHED THEN UPDATE SET {', '.join(f'{name} = s.{name}' for name in value_columns)}
+            WHEN NOT MATCHED THEN INSERT ({', '.join(columns)})
+            VALUES ({', '.join(f's.{name}' for name in columns)});
+        """, tuple(params))
+
+class SQLiteBackend:
+    """
+    Embedded stand-in of SQL Server, to run and benchmark the whole pipeline on a single machine.
+    The database file is attached as the 'dbo' schema, so the queries keep their dbo. prefix.
+    Sequences are rows of the dbo.Secuencias table and the staging tables are TEMP tables.
+    """
+    name = 'sqlite'
+    binary_type = 'BLOB'
+    count_rows = 'COUNT(*)'
+    # A single writer holds the lock of the whole database file
+    concurrent_writes = False
+
+    def connect(self, path):
+        """
+        Opens a connection to the database file, attached as the 'dbo' schema.
+
+        Args:
+            path (str): Path of the database file. It is created if it does not exist.
+
+        Returns:
+            sqlite3.Connection: The connection.
+        """
+        _register_sqlite_adapters()
+        connection = sqlite3.connect(':memory:', timeout=60, check_same_thread=False)
+        connection.execute('ATTACH DATABASE ? AS dbo', (path,))
+        return connection
+
+    def create_engine(self, path, pool_size, max_overflow):
+        """
+        Creates a pooled engine whose connections attach the database file as the 'dbo' schema.
+        """
+        return create_engine(
+            'sqlite://',
+            creator=lambda: self.connect(path),
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=True
+        )
+
+    def prepare_bulk(self, cursor):
+        pass
+
+    def bulk_insert(self, cursor, table, columns, records, batch_rows, staging_directory=None, server_directory=None):
+        """
+        Inserts a typed record array into a table with one executemany per batch of batch_rows rows.
+        SQLite has no bulk load statement, so this is its only path and the directories are ignored.
+        """
+        placeholders = ', '.join('?' for _ in columns)
+        column_names = ', '.join(name for name, _ in columns)
+        for start in range(0, len(records), batch_rows):
+            cursor.executemany(
+                f'INSERT INTO {table} ({column_names}) VALUES ({placeholders})',
+                records[start:start + batch_rows].tolist()
+            )
+
+    def table_exists(self, cursor, table):
+        return rows_exist(cursor, "FROM dbo.sqlite_master WHERE type IN ('table', 'view') AND name = ?", (table,))
+
+    def column_exists(self, cursor, table, column):
+        cursor.execute(f'PRAGMA dbo.table_info({table})')
+        return any(row[1] == column for row in cursor.fetchall())
+
+    def count_tables(self, cursor, tables):
+        placeholders = ', '.join('?' for _ in tables)
+        cursor.execute(
+            f"SELECT COUNT(*) FROM dbo.sqlite_master WHERE type = 'table' AND name IN ({placeholders})",
+            tuple(tables)
+        )
+        return cursor.fetchone()[0]
+
+    def drop_table(self, cursor, table):
+        cursor.execute(f'DROP TABLE IF EXISTS dbo.{table}')
+
+    def limit(self, query, rows):
+        return f'{query} LIMIT {int(rows)}'
+
+    def stage_rows(self, cursor, table_name, columns, rows):
+        quoted_name = f'"{table_name}"'
+        column_definitions = ', '.join(f'{name} {sql_type}' for name, sql_type in columns)
+        column_names = ', '.join(name for name, _ in columns)
+        placeholders = ', '.join('?' for _ in columns)
+        self.drop_staging(cursor, quoted_name)
+        cursor.execute(f'CREATE TEMP TABLE {quoted_name} ({column_definitions})')
+        if rows:
+            cursor.executemany(f'INSERT INTO {quoted_name} ({column_names}) VALUES ({placeholders})', rows)
+        return quoted_name
+
+    def drop_staging(self, cursor, table_name):
+        if not table_name.startswith('"'):
+            table_name = f'"{table_name}"'
+        cursor.execute(f'DROP TABLE IF EXISTS temp.{table_name}')
+
+    def _sequence_name(self, sequence_name):
+        return sequence_name.split('.')[-1]
+
+    def sequence_exists(self, cursor, sequence_name):
+        if not self.table_exists(cursor, 'Secuencias'):
+            return False
+        return rows_exist(cursor, 'FROM dbo.Secuencias WHERE Nombre = ?', (self._sequence_name(sequence_name),))
+
+    def create_sequence(self, cursor, sequence_name, start_value=1):
+        cursor.execute('CREATE TABLE IF NOT EXISTS dbo.Secuencias (Nombre TEXT PRIMARY KEY, Siguiente INTEGER NOT NULL)')
+        cursor.execute(
+            'INSERT INTO dbo.Secuencias (Nombre, Siguiente) VALUES (?, ?)',
+            (self._sequence_name(sequence_name), int(start_value))
+        )
+
+    def remove_sequence_limit(self, cursor, sequence_name):
+        pass
+
+    def drop_sequence(self, cursor, sequence_name):
+        if self.table_exists(cursor, 'Secuencias'):
+            cursor.execute('DELETE FROM dbo.Secuencias WHERE Nombre = ?', (self._sequence_name(sequence_name),))
+
+    def allocate_ids(self, cursor, sequence_name, count):
+        cursor.execute(
+            'UPDATE dbo.Secuencias SET Siguiente = Siguiente + ? WHERE Nombre = ? RETURNING Siguiente',
+            (count, self._sequence_name(sequence_name))
+        )
+        next_value = int(cursor.fetchone()[0])
+        return range(next_value - count, next_value)
+
+    def restart_sequence(self, cursor, sequence_name, start_value=1):
+        cursor.execute(
+            'UPDATE dbo.Secuencias SET Siguiente = ? WHERE Nombre = ?',
+            (int(start_value), self._sequence_name(sequence_name))
+        )
+
+    def insert_dimension_rows(self, cursor, table, id_column, key_names, staging_table, id_sequence=None):
+        key_match = ' AND '.join(f'd.{name} = t.{name}' for name in key_names)
+        missing = f'FROM {staging_table} t WHERE NOT EXISTS (SELECT 1 FROM dbo.{table} d WHERE {key_match})'
+        if id_sequence is None:
+            cursor.execute(f'SELECT COALESCE(MAX({id_column}), 0) FROM dbo.{table}')
+            last_id = int(cursor.fetchone()[0])
+        else:
+            cursor.execute(f'SELECT COUNT(*) {missing}')
+            new_ids = self.allocate_ids(cursor, id_sequence, int(cursor.fetchone()[0]))
+            last_id = new_ids.start - 1
+        cursor.execute(f"""
+            INSERT INTO dbo.{table} ({id_column}, {', '.join(key_names)})
+            SELECT ? + ROW_NUMBER() OVER (ORDER BY t.Fila), {', '.join(f't.{name}' for name in key_names)}
+            {missing}
+        """, (last_id,))
+        cursor.execute(f"""
+            SELECT t.Fila, d.{id_column}
+            FROM {staging_table} t
+            INNER JOIN dbo.{table} d ON {key_match}
+        """)
+        return cursor.fetchall()
+
+    def merge_rows(self, cursor, table, key_columns, value_columns, source, params=()):
+        columns = key_columns + value_columns
+        cursor.execute(f"""
+            INSERT INTO dbo.{table} ({', '.join(columns)})
+            SELECT {', '.join(f's.{name}' for name in columns)} FROM {source} AS s WHERE true
+            ON CONFLICT ({', '.join(key_columns)})
+            DO UPDATE SET {', '.join(f'{name} = excluded.{name}' for name in value_columns)}
+        """, tuple(params))
+
+BACKENDS = {backend.name: backend for backend in (SqlServerBackend(), SQLiteBackend())}
+
+def backend_for(connection):
+    """
+    Returns the backend of a connection or cursor: a sqlite3 connection or cursor, a pooled SQLAlchemy
+    connection over one, or a SQLAlchemy connection with the sqlite dialect use the SQLite backend.
+    Wrappers such as the instrumented connections and cursors are unwrapped through __wrapped__.
+    Everything else is treated as SQL Server.
+
+    Args:
+        connection: A DBAPI connection or cursor, or a SQLAlchemy connection or engine.
+
+    Returns:
+        SqlServerBackend or SQLiteBackend: The backend.
+    """
+    connection = getattr(connection, '__wrapped__', connection)
+    dbapi_connection = getattr(connection, 'dbapi_connection', connection)
+    dialect = getattr(connection, 'dialect', None)
+    if isinstance(dbapi_connection, (sqlite3.Connection, sqlite3.Cursor)) or getattr(dialect, 'name', None) == 'sqlite':
+        return BACKENDS['sqlite']
+    return BACKENDS['sqlserver']
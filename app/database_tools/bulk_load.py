@@ -0,0 +1,85 @@
+"""DETECTOR-DE-NOVEDADES/database_tools/bulk_load.py"""
+import os
+import numpy as np
+from database_tools.backends import backend_for
+
+# Layout of the values of each column type in the typed buffers (little-endian, as the SQL Server native format)
+BUFFER_DTYPES = {
+    'BIGINT': '<i8',
+    'INT': '<i4',
+    'FLOAT': '<f8'
+}
+
+# Columns of dbo.ConsumosMIPS, in the order of the table, with their SQL types
+CONSUMPTION_COLUMNS = [
+    ('IdConsumo', 'BIGINT'),
+    ('IdProceso', 'INT'),
+    ('IdGrupo', 'INT'),
+    ('IdFecha', 'INT'),
+    ('IdDiaSemana', 'INT'),
+    ('IdAtipico', 'INT'),
+    ('Ejecuciones', 'INT'),
+    ('ConsumoMIPS', 'FLOAT')
+]
+
+def bulk_load_directories():
+    """
+    Reads the directories of the file based bulk load of SQL Server, which is opt-in: it is only used when
+    BULK_LOAD_SERVER_DIRECTORY is set to a share that the SQL Server service can read (e.g. a UNC path).
+    BULK_LOAD_DIRECTORY is the same share as mounted in this process, when it is mounted on a different path.
+
+    Returns:
+        tuple: The pair (staging_directory, server_directory), (None, None) when the file based load is not enabled.
+    """
+    server_directory = os.getenv('BULK_LOAD_SERVER_DIRECTORY') or None
+    if server_directory is None:
+        return None, None
+    return os.getenv('BULK_LOAD_DIRECTORY') or server_directory, server_directory
+
+def typed_records(df, columns):
+    """
+    Packs the given columns of a DataFrame into a single record array with the binary layout of their
+    SQL types. Every column is cast and copied once, as a whole, without creating per-row Python objects.
+
+    Args:
+        df (pd.DataFrame): Input DataFrame.
+        columns (list of tuple): Pairs (column name, SQL type), with the types of BUFFER_DTYPES.
+
+    Returns:
+        np.ndarray: The record array, one field per column.
+    """
+    records = np.empty(len(df), dtype=[(name, BUFFER_DTYPES[sql_type.upper()]) for name, sql_type in columns])
+    for name, _ in columns:
+        records[name] = df[name].to_numpy()
+    return records
+
+def bulk_insert(cursor, table, columns, df, batch_rows=None):
+    """
+    Inserts the given columns of a DataFrame into a table with the bulk path of the backend, in batches.
+    The caller commits.
+
+    With SQL Server, the batches are sent with fast_executemany, converted to rows straight from the typed
+    buffers. When BULK_LOAD_SERVER_DIRECTORY names a share readable by the server (see bulk_load_directories),
+    they are written there as native data files and loaded with BULK INSERT instead. SQLite has no bulk load
+    statement and always uses executemany.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        table (str): Name of the table, e.g. 'dbo.ConsumosMIPS'.
+        columns (list of tuple): Pairs (column name, SQL type). With BULK INSERT they must be all the columns of the table, in order.
+        df (pd.DataFrame): The rows to insert.
+        batch_rows (int, optional): Rows per statement. Default is BULK_LOAD_BATCH_ROWS or 100000.
+    """
+    if df.empty:
+        return
+    batch_rows = int(batch_rows or os.getenv('BULK_LOAD_BATCH_ROWS') or 100_000)
+    staging_directory, server_directory = bulk_load_directories()
+    backend_for(cursor).bulk_insert(
+        cursor,
+        table,
+        columns,
+        typed_records(df, columns),
+        batch_rows,
+        staging_directory=staging_directory,
+        server_directory=server_directory
+    )
@@ -0,0 +1,105 @@
+"""DETECTOR-DE-NOVEDADES/database_tools/calendar_dimension.py"""
+import pandas as pd
+from database_tools.backends import backend_for
+
+# Date -> IdFecha mapping of dbo.Fechas. It is valid while MAX(IdFecha) does not change,
+# since the table only grows by appending new dates with higher ids.
+_date_ids_cache = {'max_id_fecha': None, 'date_ids': None}
+
+def day_of_week_ids(dates) -> pd.Series:
+    """
+    Calculates the IdDiaSemana of every date (Monday = 1 ... Sunday = 7, as in the DiaSemana table).
+
+    Args:
+        dates (array-like): Dates to convert.
+
+    Returns:
+        pd.Series: The IdDiaSemana of each date.
+    """
+    return pd.Series(pd.to_datetime(dates)).dt.dayofweek + 1
+
+def build_calendar(dates, first_id_fecha: int) -> pd.DataFrame:
+    """
+    Builds the rows of the calendar dimension for the given dates in one vectorized pass.
+    The dates are deduplicated, sorted and numbered consecutively starting at first_id_fecha.
+
+    Args:
+        dates (array-like): Dates to include in the calendar.
+        first_id_fecha (int): IdFecha of the first date.
+
+    Returns:
+        pd.DataFrame: A DataFrame with the columns 'IdFecha' and 'Fecha', as in dbo.Fechas.
+    """
+    fechas = pd.DatetimeIndex(pd.to_datetime(dates)).normalize().unique().sort_values()
+    return pd.DataFrame({
+        'IdFecha': range(first_id_fecha, first_id_fecha + len(fechas)),
+        'Fecha': fechas
+    })
+
+def month_dates(month_start) -> pd.DatetimeIndex:
+    """
+    Generates every date of the month that starts at the given date.
+
+    Args:
+        month_start (datetime-like): First day of the month.
+
+    Returns:
+        pd.DatetimeIndex: The dates of the month.
+    """
+    month_start = pd.Timestamp(month_start)
+    return pd.date_range(start=month_start, end=month_start + pd.offsets.MonthEnd(0))
+
+def insert_calendar(cursor, calendar: pd.DataFrame):
+    """
+    Bulk inserts the rows of a calendar built with build_calendar into dbo.Fechas.
+    The in-memory date -> IdFecha mapping is extended with them when it was up to date,
+    otherwise it is discarded. The caller is responsible for committing the transaction.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        calendar (pd.DataFrame): Rows to insert.
+    """
+    if calendar.empty:
+        return
+    ids = calendar['IdFecha'].astype(int).tolist()
+    dates = calendar['Fecha'].dt.date.tolist()
+    backend_for(cursor).prepare_bulk(cursor)
+    cursor.executemany('INSERT INTO dbo.Fechas (IdFecha, Fecha) VALUES (?, ?)', list(zip(ids, dates)))
+
+    if _date_ids_cache['date_ids'] is not None and _date_ids_cache['max_id_fecha'] == ids[0] - 1:
+        _date_ids_cache['date_ids'].update(zip(dates, ids))
+        _date_ids_cache['max_id_fecha'] = ids[-1]
+    else:
+        _date_ids_cache['date_ids'] = None
+        _date_ids_cache['max_id_fecha'] = None
+
+def max_id_fecha(cursor) -> int:
+    """
+    Returns the highest IdFecha stored in dbo.Fechas, 0 if the table is empty.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+
+    Returns:
+        int: The highest IdFecha.
+    """
+    cursor.execute('SELECT MAX(IdFecha) FROM dbo.Fechas')
+    return cursor.fetchone()[0] or 0
+
+def date_ids(cursor) -> dict:
+    """
+    Returns the date -> IdFecha mapping of dbo.Fechas. The mapping is kept in memory and
+    only read again from the database when MAX(IdFecha) changed since the last read.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+
+    Returns:
+        dict: A dictionary mapping datetime.date to IdFecha.
+    """
+    current_max_id = max_id_fecha(cursor)
+    if _date_ids_cache['date_ids'] is None or _date_ids_cache['max_id_fecha'] != current_max_id:
+        cursor.execute('SELECT IdFecha, Fecha FROM dbo.Fechas')
+        _date_ids_cache['date_ids'] = {pd.Timestamp(row[1]).date(): row[0] for row in cursor.fetchall()}
+        _date_ids_cache['max_id_fecha'] = current_max_id
+    return _date_ids_cache['date_ids']
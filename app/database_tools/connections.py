@@ -1,14 +1,20 @@
 """database/connections.py"""
 import os
-import pyodbc
-from urllib import parse
-from sqlalchemy import create_engine
+import threading
+from contextlib import contextmanager
+from database_tools.backends import BACKENDS, backend_for
+from monitoring_tools.instrumentation import InstrumentedConnection, instrument_engine, log_progress
 
-def connect_to_insert_data():
-    """Connect to SQL Server database
+# Targets of the connection manager
+INSERTION = 'insertion'
+EXTRACTION = 'extraction'
+
+def insertion_connection_string():
+    """
+    Builds the ODBC connection string of the database where the consumptions and forecasts are stored.
 
     Returns:
-        pyodbc.Connection: Database connection object
+        str: The ODBC connection string.
     """
     db_name = os.getenv("DB_NAME_INSERTIONS")
     user = os.getenv("DB_USER_INSERTIONS")
@@ -16,7 +22,7 @@ def connect_to_insert_data():
     host = os.getenv("DB_SERVER_INSERTIONS")
     port = os.getenv("DB_PORT_INSERTIONS")
 
-    conn_str = (
+    return (
         f"DRIVER={{ODBC Driver 17 for SQL Server}};"
         f"SERVER={host},{port};"
         f"DATABASE={db_name};"
@@ -24,17 +30,13 @@ def connect_to_insert_data():
         f"PWD={password};"
         f"Timeout=60;"
     )
-    conn = pyodbc.connect(conn_str)
-    if conn:
-        print("Connection to the database for inserting data was successful.")
-    return conn
 
-def connect_to_fetch_data():
+def extraction_connection_string():
     """
-    Establishes a connection to the specified SQL Server database for fetching data.
+    Builds the ODBC connection string of the database the source data is fetched from.
 
     Returns:
-        sqlalchemy.engine.base.Connection: A connection object to the database.
+        str: The ODBC connection string.
     """
     driver = os.getenv("DB_DRIVER_EXTRACTION")
     server = os.getenv("DB_SERVER_EXTRACTION")
@@ -42,34 +44,145 @@ def connect_to_fetch_data():
     user = os.getenv("DB_USER_EXTRACTION")
     password = os.getenv("DB_PASSWORD_EXTRACTION")
 
-    String = 'Driver={};Server={},1428;Database={};Uid={};Pwd={};Encrypt=yes;TrustServerCertificate=yes;INTEGRATED SECURITY=SSPI;Connection Timeout=30;sslverify=0'.format(driver, server, database, user, password)
-    params = parse.quote_plus(String)
-    conn_str = "mssql+pyodbc:///?odbc_connect={}".format(params)
+    return 'Driver={};Server={},1428;Database={};Uid={};Pwd={};Encrypt=yes;TrustServerCertificate=yes;INTEGRATED SECURITY=SSPI;Connection Timeout=30;sslverify=0'.format(driver, server, database, user, password)
 
-    engine = create_engine(conn_str)
-    connection = engine.connect()
-    if connection:
-        print("Connection to the database for fetching data was successful.")
-    return connection
+CONNECTION_STRINGS = {
+    INSERTION: insertion_connection_string,
+    EXTRACTION: extraction_connection_string
+}
 
-def connect_to_insert_forecasting_data():
-    """Connect to SQL Server database using SQLAlchemy engine
+# With the embedded backend the database names are the paths of the database files
+DATABASE_FILES = {
+    INSERTION: 'DB_NAME_INSERTIONS',
+    EXTRACTION: 'DB_NAME_EXTRACTION'
+}
 
-    Returns:
-        sqlalchemy.engine.Engine: SQLAlchemy engine object
+@contextmanager
+def bulk_cursor(conn):
     """
-    db_name = os.getenv("DB_NAME_INSERTIONS")
-    user = os.getenv("DB_USER_INSERTIONS")
-    password = os.getenv("DB_PASSWORD_INSERTIONS")
-    host = os.getenv("DB_SERVER_INSERTIONS")
-    port = os.getenv("DB_PORT_INSERTIONS")
+    Opens a cursor for bulk operations: fast_executemany is always enabled in SQL Server, so executemany
+    sends the parameters in arrays instead of one round trip per row. The cursor is closed on exit.
 
-    conn_str = (
-        f"mssql+pyodbc://{user}:{password}@{host}:{port}/{db_name}"
-        f"?driver=ODBC+Driver+17+for+SQL+Server&timeout=60"
-    )
-    engine = create_engine(conn_str)
-    connection = engine.connect()
-    if connection:
-        print("Connection to the database for inserting forcasts data was successful.")
-    return connection
+    Args:
+        conn (pyodbc.Connection): A DBAPI connection, e.g. from ConnectionManager.raw_connection.
+
+    Yields:
+        pyodbc.Cursor: The cursor.
+    """
+    cursor = conn.cursor()
+    backend_for(conn).prepare_bulk(cursor)
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+class ConnectionManager:
+    """
+    Keeps one pooled SQLAlchemy engine per target (INSERTION or EXTRACTION), created on first use.
+    The engines use the storage backend named by STORAGE_BACKEND: 'sqlserver' (default) or 'sqlite',
+    the embedded stand-in whose database files are given by DB_NAME_INSERTIONS and DB_NAME_EXTRACTION.
+    The pooled connections are checked with a ping before being handed out, so a connection dropped
+    by the server is replaced instead of failing the stage that borrows it. The statements and fetched
+    rows of every connection are counted in the run report (monitoring_tools.instrumentation).
+
+    Every stage borrows its connections with the context managers connection (SQLAlchemy connection,
+    for pd.read_sql) and raw_connection (pyodbc connection, for cursors), which return them to the pool
+    on exit. Uncommitted work is rolled back when a connection returns to the pool.
+
+    Usage:
+        with ConnectionManager() as manager:
+            with manager.raw_connection(INSERTION) as conn, manager.connection(EXTRACTION) as conn_fetch:
+                ...
+    """
+
+    def __init__(self, pool_size=None, max_overflow=None):
+        """
+        Args:
+            pool_size (int, optional): Connections kept open per target. Default is DB_POOL_SIZE or 5.
+            max_overflow (int, optional): Extra connections opened when the pool is exhausted.
+                Default is DB_POOL_MAX_OVERFLOW or 5.
+        """
+        self.pool_size = int(pool_size or os.getenv('DB_POOL_SIZE') or 5)
+        self.max_overflow = int(max_overflow or os.getenv('DB_POOL_MAX_OVERFLOW') or 5)
+        self._engines = {}
+        # Serializes the creation of the engines, which several worker threads may request at the same time
+        self._engines_lock = threading.Lock()
+
+    def engine(self, target):
+        """
+        Returns the pooled engine of a target, creating it on first use. The creation is guarded by a lock
+        (double-checked), so threads borrowing their first connection at the same time share one pool.
+
+        Args:
+            target (str): INSERTION or EXTRACTION.
+
+        Returns:
+            sqlalchemy.engine.Engine: The engine.
+        """
+        engine = self._engines.get(target)
+        if engine is not None:
+            return engine
+        with self._engines_lock:
+            engine = self._engines.get(target)
+            created = engine is None
+            if created:
+                backend = BACKENDS[os.getenv('STORAGE_BACKEND') or 'sqlserver']
+                if backend.name == 'sqlite':
+                    location = os.getenv(DATABASE_FILES[target])
+                else:
+                    location = CONNECTION_STRINGS[target]()
+                engine = instrument_engine(backend.create_engine(location, self.pool_size, self.max_overflow))
+                self._engines[target] = engine
+        # Logged outside the lock, so other threads do not wait on the log handler
+        if created:
+            log_progress(f"Connection pool for the {target} database was created.")
+        return engine
+
+    @contextmanager
+    def connection(self, target):
+        """
+        Borrows a SQLAlchemy connection of a target.
+
+        Args:
+            target (str): INSERTION or EXTRACTION.
+
+        Yields:
+            sqlalchemy.engine.Connection: The connection.
+        """
+        connection = self.engine(target).connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def raw_connection(self, target=INSERTION):
+        """
+        Borrows the DBAPI (pyodbc) connection of a target, for the stages that work with cursors.
+
+        Args:
+            target (str, optional): INSERTION or EXTRACTION. Default is INSERTION.
+
+        Yields:
+            InstrumentedConnection: The pooled pyodbc connection, whose cursors are counted. Closing it returns it to the pool.
+        """
+        connection = InstrumentedConnection(self.engine(target).raw_connection())
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def dispose(self):
+        """
+        Closes every pooled connection of every target.
+        """
+        with self._engines_lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.dispose()
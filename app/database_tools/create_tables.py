@@ -1,4 +1,20 @@
 """"DETECTOR-DE-NOVEDADES/database_tools/create_tables.py"""
+from database_tools.backends import backend_for
+from monitoring_tools.instrumentation import log_progress
+
+CORE_TABLES = [
+    'Atipicos',
+    'CategoriasMetricas',
+    'Procesos',
+    'Grupos',
+    'ProcesosGrupos',
+    'Fechas',
+    'DiaSemana',
+    'ConsumosMIPS',
+    'PrediccionesMIPS',
+    'MetricasPredicciones'
+]
+
 def create_tables(conn):
     """
     Creates the necessary tables for the database and inserts initial data.
@@ -12,7 +28,7 @@ def create_tables(conn):
     - DiaSemana: Stores days of the week.
     - ConsumosMIPS: Stores MIPS consumption data.
     - PrediccionesMIPS: Stores MIPS prediction data.
-    - MetricasPredicciones: Stores prediction metrics data.
+    - MetricasPredicciones: Stores prediction metrics data and the state they are updated from.
     - CategoriasMetricas: Stores metric categories.
 
     Initial data is inserted into the Atipicos and DiaSemana tables.
@@ -20,45 +36,42 @@ def create_tables(conn):
     Raises:
         Any exceptions raised by the database connection or cursor operations.
     """
-    print("Creating tables...")
+    log_progress("Creating tables...")
+    backend = backend_for(conn)
     cursor = conn.cursor()
 
     cursor.execute("""
-    CREATE TABLE Atipicos (
+    CREATE TABLE dbo.Atipicos (
         IdAtipico INT PRIMARY KEY,
         Categoria NVARCHAR(50)
     )
     """)
 
     cursor.execute("""
-    CREATE TABLE CategoriasMetricas (
+    CREATE TABLE dbo.CategoriasMetricas (
         IdCategoriaMetrica INT PRIMARY KEY,
         Categoria NVARCHAR(50)
     )
     """)
 
     cursor.execute("""
-    CREATE TABLE Procesos (
+    CREATE TABLE dbo.Procesos (
         IdProceso INT PRIMARY KEY,
         NombreProceso NVARCHAR(100)
     )
     """)
 
     cursor.execute("""
-    CREATE TABLE Grupos (
+    CREATE TABLE dbo.Grupos (
         IdGrupo INT PRIMARY KEY,
         NombreGrupo NVARCHAR(100)
     )
     """)
 
-    cursor.execute("""
-    CREATE SEQUENCE proceso_grupo_seq
-    START WITH 1
-    INCREMENT BY 1;
-    """)
+    backend.create_sequence(cursor, 'proceso_grupo_seq')
 
     cursor.execute("""
-    CREATE TABLE ProcesosGrupos (
+    CREATE TABLE dbo.ProcesosGrupos (
         IdProcesoGrupo INT PRIMARY KEY,
         IdProceso INT,
         IdGrupo INT,
@@ -68,22 +81,22 @@ def create_tables(conn):
     """)
 
     cursor.execute("""
-    CREATE TABLE Fechas (
+    CREATE TABLE dbo.Fechas (
         IdFecha INT PRIMARY KEY,
         Fecha DATE UNIQUE
     )
     """)
 
     cursor.execute("""
-    CREATE TABLE DiaSemana (
+    CREATE TABLE dbo.DiaSemana (
         IdDiaSemana INT PRIMARY KEY,
         DiaSemana NVARCHAR(50)
     )
     """)
 
     cursor.execute("""
-    CREATE TABLE ConsumosMIPS (
-        IdConsumo INT PRIMARY KEY,
+    CREATE TABLE dbo.ConsumosMIPS (
+        IdConsumo BIGINT PRIMARY KEY,
         IdProceso INT,
         IdGrupo INT,
         IdFecha INT,
@@ -99,15 +112,11 @@ def create_tables(conn):
     )
     """)
 
-    cursor.execute("""
-    CREATE SEQUENCE predicciones_seq
-    START WITH 1
-    INCREMENT BY 1;
-    """)
+    backend.create_sequence(cursor, 'predicciones_seq')
 
     cursor.execute("""
-    CREATE TABLE PrediccionesMIPS (
-        IdPrediccion INT PRIMARY KEY,
+    CREATE TABLE dbo.PrediccionesMIPS (
+        IdPrediccion BIGINT PRIMARY KEY,
         IdFecha INT,
         IdDiaSemana INT,
         Prediccion FLOAT,
@@ -118,15 +127,11 @@ def create_tables(conn):
     )
     """)
 
-    cursor.execute("""
-    CREATE SEQUENCE metricas_seq
-    START WITH 1
-    INCREMENT BY 1;
-    """)
+    backend.create_sequence(cursor, 'metricas_seq')
 
     cursor.execute("""
-    CREATE TABLE MetricasPredicciones (
-        IdMetrica INT PRIMARY KEY,
+    CREATE TABLE dbo.MetricasPredicciones (
+        IdMetrica BIGINT PRIMARY KEY,
         IdFecha INT,
         IdCategoriaMetrica INT,
         MAE FLOAT,
@@ -134,20 +139,25 @@ def create_tables(conn):
         RMSE FLOAT,
         MAPE FLOAT,
         sMAPE FLOAT,
+        Observaciones INT,
+        SumaErrorAbsoluto FLOAT,
+        SumaErrorCuadratico FLOAT,
+        SumaErrorPorcentual FLOAT,
+        SumaErrorPorcentualSimetrico FLOAT,
         FOREIGN KEY (IdFecha) REFERENCES Fechas(IdFecha),
         FOREIGN KEY (IdCategoriaMetrica) REFERENCES CategoriasMetricas(IdCategoriaMetrica)
     )
     """)
 
     cursor.execute("""
-    INSERT INTO Atipicos (IdAtipico, Categoria) VALUES
+    INSERT INTO dbo.Atipicos (IdAtipico, Categoria) VALUES
     (-1, 'Inferior'),
     (0, 'NoAtipico'),
     (1, 'Superior')
     """)
 
     cursor.execute("""
-    INSERT INTO DiaSemana (IdDiaSemana, DiaSemana) VALUES
+    INSERT INTO dbo.DiaSemana (IdDiaSemana, DiaSemana) VALUES
     (1, 'Lunes'),
     (2, 'Martes'),
     (3, 'Miércoles'),
@@ -158,11 +168,101 @@ def create_tables(conn):
     """)
 
     cursor.execute("""
-    INSERT INTO CategoriasMetricas (IdCategoriaMetrica, Categoria) VALUES
+    INSERT INTO dbo.CategoriasMetricas (IdCategoriaMetrica, Categoria) VALUES
     (0, 'Mensual'),
     (1, 'Historica')
     """)
 
     conn.commit()
     cursor.close()
-    print("Tables created successfully.")
+    log_progress("Tables created successfully.")
+
+def create_auxiliary_tables(conn):
+    """
+    Creates, if they do not exist, the auxiliary tables used to speed up the pipeline.
+    They only hold data derived from the core tables, so they can be dropped and rebuilt at any time.
+
+    The following tables are created:
+    - EstadisticasSeries: Stores the robust statistics, the running central moments and the quantile
+      sketch of every (IdProceso, IdGrupo, IdDiaSemana) series.
+    - MarcasAgua: Stores the state of ConsumosMIPS the derived data was computed from.
+    - PrediccionesSeries: Stores the predictions of every group and top process.
+
+    It also adds to MetricasPredicciones, when it was created without them, the columns with the
+    state of the running metrics. It creates the consumos_seq sequence, which allocates IdConsumo
+    starting after the highest stored one, and removes the upper bound of the predicciones_seq and
+    metricas_seq sequences so their values are never reused.
+
+    Raises:
+        Any exceptions raised by the database connection or cursor operations.
+    """
+    backend = backend_for(conn)
+    cursor = conn.cursor()
+
+    if not backend.table_exists(cursor, 'EstadisticasSeries'):
+        cursor.execute(f"""
+        CREATE TABLE dbo.EstadisticasSeries (
+            IdProceso INT,
+            IdGrupo INT,
+            IdDiaSemana INT,
+            N INT,
+            Mediana FLOAT,
+            MAD FLOAT,
+            Q1 FLOAT,
+            Q3 FLOAT,
+            RangoCero BIT,
+            Normal BIT,
+            Bosquejo {backend.binary_type},
+            Media FLOAT,
+            M2 FLOAT,
+            M3 FLOAT,
+            M4 FLOAT,
+            PRIMARY KEY (IdProceso, IdGrupo, IdDiaSemana)
+        )
+        """)
+    else:
+        # Columns added after the first version of the table
+        for column, column_type in [('Bosquejo', backend.binary_type), ('Media', 'FLOAT'), ('M2', 'FLOAT'), ('M3', 'FLOAT'), ('M4', 'FLOAT')]:
+            if not backend.column_exists(cursor, 'EstadisticasSeries', column):
+                cursor.execute(f"ALTER TABLE dbo.EstadisticasSeries ADD {column} {column_type}")
+
+    # State of the running metrics, added after the first version of MetricasPredicciones
+    for column, column_type in [
+        ('Observaciones', 'INT'), ('SumaErrorAbsoluto', 'FLOAT'), ('SumaErrorCuadratico', 'FLOAT'),
+        ('SumaErrorPorcentual', 'FLOAT'), ('SumaErrorPorcentualSimetrico', 'FLOAT')
+    ]:
+        if not backend.column_exists(cursor, 'MetricasPredicciones', column):
+            cursor.execute(f"ALTER TABLE dbo.MetricasPredicciones ADD {column} {column_type}")
+
+    if not backend.table_exists(cursor, 'MarcasAgua'):
+        cursor.execute("""
+        CREATE TABLE dbo.MarcasAgua (
+            Nombre NVARCHAR(50) PRIMARY KEY,
+            Filas BIGINT,
+            MaxIdConsumo BIGINT
+        )
+        """)
+
+    if not backend.table_exists(cursor, 'PrediccionesSeries'):
+        cursor.execute("""
+        CREATE TABLE dbo.PrediccionesSeries (
+            TipoSerie NVARCHAR(20),
+            IdSerie INT,
+            IdFecha INT,
+            IdDiaSemana INT,
+            Prediccion FLOAT,
+            LimInf FLOAT,
+            LimSup FLOAT,
+            PRIMARY KEY (TipoSerie, IdSerie, IdFecha)
+        )
+        """)
+
+    if not backend.sequence_exists(cursor, 'consumos_seq'):
+        cursor.execute('SELECT MAX(IdConsumo) FROM dbo.ConsumosMIPS')
+        backend.create_sequence(cursor, 'consumos_seq', (cursor.fetchone()[0] or 0) + 1)
+
+    backend.remove_sequence_limit(cursor, 'predicciones_seq')
+    backend.remove_sequence_limit(cursor, 'metricas_seq')
+
+    conn.commit()
+    cursor.close()
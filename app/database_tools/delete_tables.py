@@ -1,4 +1,6 @@
 """DETECTOR-DE-NOVEDADES/database/delete_tables.py"""
+from database_tools.backends import backend_for
+from monitoring_tools.instrumentation import log_progress
 
 def delete_tables(conn):
     """
@@ -15,28 +17,24 @@ def delete_tables(conn):
     - PrediccionesMIPS
     - MetricasPredicciones
     - CategoriasMetricas
-    - The sequences proceso_grupo_seq and predicciones_seq
+    - EstadisticasSeries, MarcasAgua and PrediccionesSeries
+    - The sequences proceso_grupo_seq, predicciones_seq, metricas_seq and consumos_seq
 
     Raises:
         Any exceptions raised by the database connection or cursor operations.
     """
-    print("Deleting tables...")
+    log_progress("Deleting tables...")
+    backend = backend_for(conn)
     cursor = conn.cursor()
 
-    cursor.execute("IF OBJECT_ID('PrediccionesMIPS', 'U') IS NOT NULL DROP TABLE PrediccionesMIPS")
-    cursor.execute("IF OBJECT_ID('ConsumosMIPS', 'U') IS NOT NULL DROP TABLE ConsumosMIPS")
-    cursor.execute("IF OBJECT_ID('MetricasPredicciones', 'U') IS NOT NULL DROP TABLE MetricasPredicciones")
-    cursor.execute("IF OBJECT_ID('DiaSemana', 'U') IS NOT NULL DROP TABLE DiaSemana")
-    cursor.execute("IF OBJECT_ID('Fechas', 'U') IS NOT NULL DROP TABLE Fechas")
-    cursor.execute("IF OBJECT_ID('ProcesosGrupos', 'U') IS NOT NULL DROP TABLE ProcesosGrupos")
-    cursor.execute("IF OBJECT_ID('Grupos', 'U') IS NOT NULL DROP TABLE Grupos")
-    cursor.execute("IF OBJECT_ID('Procesos', 'U') IS NOT NULL DROP TABLE Procesos")
-    cursor.execute("IF OBJECT_ID('Atipicos', 'U') IS NOT NULL DROP TABLE Atipicos")
-    cursor.execute("IF OBJECT_ID('CategoriasMetricas', 'U') IS NOT NULL DROP TABLE CategoriasMetricas")
-    cursor.execute("IF OBJECT_ID('proceso_grupo_seq', 'SO') IS NOT NULL DROP SEQUENCE proceso_grupo_seq")
-    cursor.execute("IF OBJECT_ID('predicciones_seq', 'SO') IS NOT NULL DROP SEQUENCE predicciones_seq")
-    cursor.execute("IF OBJECT_ID('metricas_seq', 'SO') IS NOT NULL DROP SEQUENCE metricas_seq")
+    for table in [
+        'PrediccionesMIPS', 'ConsumosMIPS', 'MetricasPredicciones', 'DiaSemana', 'Fechas', 'ProcesosGrupos',
+        'Grupos', 'Procesos', 'Atipicos', 'CategoriasMetricas', 'EstadisticasSeries', 'MarcasAgua', 'PrediccionesSeries'
+    ]:
+        backend.drop_table(cursor, table)
+    for sequence in ['proceso_grupo_seq', 'predicciones_seq', 'metricas_seq', 'consumos_seq']:
+        backend.drop_sequence(cursor, sequence)
 
     conn.commit()
     cursor.close()
-    print("Tables deleted.")
+    log_progress("Tables deleted.")
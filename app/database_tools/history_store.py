@@ -0,0 +1,348 @@
+"""DETECTOR-DE-NOVEDADES/database_tools/history_store.py"""
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from database_tools.backends import backend_for
+from database_tools.bulk_load import BUFFER_DTYPES, CONSUMPTION_COLUMNS
+from monitoring_tools.instrumentation import log_progress
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = '.lock'
+# Rows read at a time when the store is rebuilt or caught up from the database
+FETCH_ROWS = 100_000
+
+# Serializes the writers of this process; the file lock serializes the processes
+_write_lock = threading.Lock()
+
+# Checksum of a row of dbo.ConsumosMIPS, which changes when the row is deleted, reloaded or corrected in
+# place (ConsumoMIPS or IdAtipico). It only uses integer arithmetic and a truncating cast, so the store
+# computes exactly the same value for the rows it appends (see consumption_checksum).
+ROW_CHECKSUM = 'CAST(IdConsumo AS BIGINT) * (IdAtipico + 2) + CAST(ConsumoMIPS * 1000 AS BIGINT)'
+
+def history_store_path():
+    """
+    Returns the directory of the history store, given by HISTORY_STORE_PATH, or None when it is disabled.
+    """
+    return os.getenv('HISTORY_STORE_PATH') or None
+
+def consumption_checksum(df):
+    """
+    Adds the ROW_CHECKSUM of some rows, as the database computes it.
+
+    Args:
+        df (pd.DataFrame): Rows with the columns 'IdConsumo', 'IdAtipico' and 'ConsumoMIPS'.
+
+    Returns:
+        int: The sum of the checksums of the rows.
+    """
+    id_consumo = df['IdConsumo'].to_numpy(dtype=np.int64)
+    id_atipico = df['IdAtipico'].to_numpy(dtype=np.int64)
+    consumo = (df['ConsumoMIPS'].to_numpy(dtype=np.float64) * 1000).astype(np.int64)
+    return int((id_consumo * (id_atipico + 2) + consumo).sum())
+
+def database_watermark(cursor):
+    """
+    Calculates the watermark of the whole dbo.ConsumosMIPS table: the number of rows, the maximum
+    IdConsumo and the sum of the ROW_CHECKSUM of the rows, which changes when rows are deleted and
+    inserted again or their values are corrected in place.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+
+    Returns:
+        tuple: The triple (rows, max_id_consumo, checksum).
+    """
+    cursor.execute(f"SELECT {backend_for(cursor).count_rows}, MAX(IdConsumo), SUM({ROW_CHECKSUM}) FROM dbo.ConsumosMIPS;")
+    rows, max_id, checksum = cursor.fetchone()
+    return int(rows or 0), int(max_id or 0), int(checksum or 0)
+
+class HistoryStore:
+    """
+    Local copy of dbo.ConsumosMIPS, with one directory per month of the consumptions ('YYYY-MM') and one
+    file per column in it, holding the raw little-endian values (the dtypes of BUFFER_DTYPES). The files are
+    read as memory maps, so the columns are used without loading or copying them (see read_parts), and
+    new rows are appended at the end of the files of their month.
+
+    The manifest.json file keeps the rows and the IdFecha range of every month and the watermark of the
+    rows it holds (see database_watermark). The rows beyond the count of the manifest, left by an
+    interrupted append, are ignored and overwritten by the next one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return {'rows': 0, 'max_id': 0, 'checksum': 0, 'months': {}}
+        with open(manifest_path) as file:
+            return json.load(file)
+
+    def _write_manifest(self):
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        temporary_path = f'{manifest_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(temporary_path, manifest_path)
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.path, exist_ok=True)
+        with _write_lock, open(os.path.join(self.path, LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another process may have changed the store since it was opened
+                self.manifest = self._read_manifest()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def watermark(self):
+        """
+        Returns:
+            tuple: The triple (rows, max_id_consumo, checksum) of the stored rows.
+        """
+        return self.manifest['rows'], self.manifest['max_id'], self.manifest['checksum']
+
+    def months(self, start_id_fecha=None, end_id_fecha=None):
+        """
+        Returns the months of the store, in order, that may have rows in the given IdFecha range.
+
+        Args:
+            start_id_fecha (int, optional): First IdFecha. Default is no lower limit.
+            end_id_fecha (int, optional): Last IdFecha. Default is no upper limit.
+
+        Returns:
+            list of str: The months, as 'YYYY-MM'.
+        """
+        return [
+            month for month, partition in sorted(self.manifest['months'].items())
+            if partition['rows'] > 0
+            and (start_id_fecha is None or partition['max_id_fecha'] >= start_id_fecha)
+            and (end_id_fecha is None or partition['min_id_fecha'] <= end_id_fecha)
+        ]
+
+    def column(self, month, name):
+        """
+        Maps the values of a column of a month, without reading them.
+
+        Args:
+            month (str): The month, as 'YYYY-MM'.
+            name (str): Name of the column.
+
+        Returns:
+            np.ndarray: A read only memory map of the stored values of the month.
+        """
+        dtype = np.dtype(BUFFER_DTYPES[dict(CONSUMPTION_COLUMNS)[name]])
+        rows = self.manifest['months'][month]['rows']
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, month, f'{name}.bin'), dtype=dtype, mode='r', shape=(rows,))
+
+    def read_parts(self, columns, start_id_fecha=None, end_id_fecha=None):
+        """
+        Maps some columns of the rows in an IdFecha range, month by month, without copying them. The months
+        inside the range are whole memory maps; the first and last months of the range are sliced, which is
+        also a view when their rows are stored in IdFecha order (the usual case, as the dates are appended
+        in order). Otherwise only the rows of the range are copied out of them.
+
+        Args:
+            columns (list of str): Names of the columns.
+            start_id_fecha (int, optional): First IdFecha. Default is no lower limit.
+            end_id_fecha (int, optional): Last IdFecha. Default is no upper limit.
+
+        Yields:
+            dict: The values of every column in one month, in the order they were stored.
+        """
+        for month in self.months(start_id_fecha, end_id_fecha):
+            partition = self.manifest['months'][month]
+            selected = slice(None)
+            if (start_id_fecha is not None and partition['min_id_fecha'] < start_id_fecha) or (
+                end_id_fecha is not None and partition['max_id_fecha'] > end_id_fecha
+            ):
+                id_fecha = self.column(month, 'IdFecha')
+                if np.all(id_fecha[1:] >= id_fecha[:-1]):
+                    selected = slice(
+                        None if start_id_fecha is None else int(np.searchsorted(id_fecha, start_id_fecha, side='left')),
+                        None if end_id_fecha is None else int(np.searchsorted(id_fecha, end_id_fecha, side='right'))
+                    )
+                else:
+                    in_range = np.ones(len(id_fecha), dtype=bool)
+                    if start_id_fecha is not None:
+                        in_range &= id_fecha >= start_id_fecha
+                    if end_id_fecha is not None:
+                        in_range &= id_fecha <= end_id_fecha
+                    selected = np.flatnonzero(in_range)
+            yield {name: self.column(month, name)[selected] for name in columns}
+
+    def read(self, columns, start_id_fecha=None, end_id_fecha=None):
+        """
+        Reads some columns of the rows in an IdFecha range into a DataFrame. The rows of the months
+        (see read_parts) are copied into it once.
+
+        Args:
+            columns (list of str): Names of the columns.
+            start_id_fecha (int, optional): First IdFecha. Default is no lower limit.
+            end_id_fecha (int, optional): Last IdFecha. Default is no upper limit.
+
+        Returns:
+            pd.DataFrame: The rows, in the order they were stored.
+        """
+        parts = list(self.read_parts(columns, start_id_fecha, end_id_fecha))
+        return pd.DataFrame({
+            name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=BUFFER_DTYPES[dict(CONSUMPTION_COLUMNS)[name]])
+            for name in columns
+        })
+
+    def append(self, df, months):
+        """
+        Appends rows at the end of the files of their months and updates the manifest.
+
+        Args:
+            df (pd.DataFrame): The rows, with the columns of CONSUMPTION_COLUMNS.
+            months (array-like): The month of every row, as 'YYYY-MM'.
+        """
+        if df.empty:
+            return
+        months = np.asarray(months)
+        with self._locked():
+            for month in np.unique(months):
+                rows = df[months == month]
+                partition = self.manifest['months'].setdefault(
+                    month, {'rows': 0, 'min_id_fecha': None, 'max_id_fecha': None}
+                )
+                os.makedirs(os.path.join(self.path, month), exist_ok=True)
+                for name, sql_type in CONSUMPTION_COLUMNS:
+                    dtype = np.dtype(BUFFER_DTYPES[sql_type])
+                    with open(os.path.join(self.path, month, f'{name}.bin'), 'ab') as file:
+                        file.truncate(partition['rows'] * dtype.itemsize)
+                        file.write(rows[name].to_numpy(dtype=dtype).tobytes())
+                id_fecha = rows['IdFecha'].astype(int)
+                first = int(id_fecha.min()) if partition['rows'] == 0 else min(int(id_fecha.min()), partition['min_id_fecha'])
+                last = int(id_fecha.max()) if partition['rows'] == 0 else max(int(id_fecha.max()), partition['max_id_fecha'])
+                partition.update(rows=partition['rows'] + len(rows), min_id_fecha=first, max_id_fecha=last)
+
+            id_consumo = df['IdConsumo'].astype(np.int64)
+            self.manifest['rows'] += len(df)
+            self.manifest['max_id'] = max(self.manifest['max_id'], int(id_consumo.max()))
+            self.manifest['checksum'] += consumption_checksum(df)
+            self._write_manifest()
+
+    def clear(self):
+        """
+        Removes every stored row.
+        """
+        with self._locked():
+            for month in self.manifest['months']:
+                for name, _ in CONSUMPTION_COLUMNS:
+                    column_path = os.path.join(self.path, month, f'{name}.bin')
+                    if os.path.exists(column_path):
+                        os.remove(column_path)
+            self.manifest = {'rows': 0, 'max_id': 0, 'checksum': 0, 'months': {}}
+            self._write_manifest()
+
+def consumption_months(cursor, df):
+    """
+    Finds the month of every row from its IdFecha, with one query to dbo.Fechas.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        df (pd.DataFrame): Rows with the column 'IdFecha'.
+
+    Returns:
+        np.ndarray: The month of every row, as 'YYYY-MM'.
+    """
+    id_fecha = df['IdFecha'].astype(np.int64)
+    cursor.execute(
+        'SELECT IdFecha, Fecha FROM dbo.Fechas WHERE IdFecha BETWEEN ? AND ?;',
+        (int(id_fecha.min()), int(id_fecha.max()))
+    )
+    dates = pd.DataFrame([tuple(row) for row in cursor.fetchall()], columns=['IdFecha', 'Fecha'])
+    months = pd.Series(pd.to_datetime(dates['Fecha']).dt.strftime('%Y-%m').to_numpy(), index=dates['IdFecha'].astype(np.int64))
+    return months.reindex(id_fecha.to_numpy()).to_numpy()
+
+def copy_consumptions(cursor, store, after_id_consumo=0):
+    """
+    Copies the rows of dbo.ConsumosMIPS with an IdConsumo greater than the given one to the store,
+    FETCH_ROWS at a time.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        store (HistoryStore): The store.
+        after_id_consumo (int, optional): Only the rows after this IdConsumo are copied. Default is 0.
+
+    Returns:
+        int: The number of copied rows.
+    """
+    columns = [name for name, _ in CONSUMPTION_COLUMNS]
+    cursor.execute(f"""
+        SELECT {', '.join(f'c.{name}' for name in columns)}, f.Fecha
+        FROM dbo.ConsumosMIPS c
+        INNER JOIN dbo.Fechas f ON f.IdFecha = c.IdFecha
+        WHERE c.IdConsumo > ?
+        ORDER BY c.IdConsumo;
+    """, (int(after_id_consumo),))
+    copied = 0
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            return copied
+        chunk = pd.DataFrame([tuple(row) for row in rows], columns=columns + ['Fecha'])
+        store.append(chunk, pd.to_datetime(chunk['Fecha']).dt.strftime('%Y-%m').to_numpy())
+        copied += len(chunk)
+
+def open_history_store(cursor):
+    """
+    Opens the history store and reconciles it with dbo.ConsumosMIPS by their watermarks:
+    - when they are equal, the store is used as it is,
+    - when the store holds exactly the rows of the table up to its maximum IdConsumo, the newer rows
+      of the table are appended to it,
+    - otherwise (deleted, reloaded or corrected rows), the store is rebuilt from the whole table.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+
+    Returns:
+        HistoryStore: The store, in sync with the table, or None when HISTORY_STORE_PATH is not set.
+    """
+    path = history_store_path()
+    if path is None:
+        return None
+
+    store = HistoryStore(path)
+    watermark = database_watermark(cursor)
+    if store.watermark() == watermark:
+        return store
+
+    rows, max_id, checksum = store.watermark()
+    cursor.execute(
+        f"SELECT {backend_for(cursor).count_rows}, SUM({ROW_CHECKSUM}) FROM dbo.ConsumosMIPS WHERE IdConsumo <= ?;",
+        (max_id,)
+    )
+    prefix_rows, prefix_checksum = cursor.fetchone()
+    if rows > 0 and (int(prefix_rows or 0), int(prefix_checksum or 0)) == (rows, checksum):
+        log_progress("Appending the new consumptions to the history store.")
+        copy_consumptions(cursor, store, max_id)
+    else:
+        log_progress("The history store is outdated. Rebuilding it.")
+        store.clear()
+        copy_consumptions(cursor, store)
+    return store
+
+def append_history(cursor, df):
+    """
+    Appends rows that were just inserted (and committed) into dbo.ConsumosMIPS to the history store,
+    when it is enabled. If it is not up to date, open_history_store reconciles it later.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        df (pd.DataFrame): The inserted rows, with the columns of CONSUMPTION_COLUMNS.
+    """
+    path = history_store_path()
+    if path is None or df.empty:
+        return
+    HistoryStore(path).append(df, consumption_months(cursor, df))
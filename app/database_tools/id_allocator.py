@@ -0,0 +1,33 @@
+"""DETECTOR-DE-NOVEDADES/database_tools/id_allocator.py"""
+from database_tools.backends import backend_for
+
+def allocate_ids(cursor, sequence_name, count):
+    """
+    Reserves a contiguous block of values of a sequence in a single call, instead of
+    running one NEXT VALUE FOR per row. The values are returned as Python integers,
+    so they are safe for BIGINT sequences.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        sequence_name (str): Name of the sequence, e.g. 'dbo.predicciones_seq'. It must not cycle.
+        count (int): Number of values to reserve.
+
+    Returns:
+        range: The reserved values, in ascending order. Empty if count is 0.
+    """
+    count = int(count)
+    if count <= 0:
+        return range(0)
+    return backend_for(cursor).allocate_ids(cursor, sequence_name, count)
+
+def restart_sequence(cursor, sequence_name, start_value=1):
+    """
+    Restarts a sequence at the given value without an upper bound, so it never cycles
+    back to values that are already in use.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        sequence_name (str): Name of the sequence.
+        start_value (int, optional): Next value of the sequence. Default is 1.
+    """
+    backend_for(cursor).restart_sequence(cursor, sequence_name, start_value)
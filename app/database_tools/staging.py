@@ -0,0 +1,46 @@
+"""DETECTOR-DE-NOVEDADES/database_tools/staging.py"""
+from database_tools.backends import backend_for
+
+def stage_rows(cursor, table_name, columns, rows):
+    """
+    Creates a temporary table and bulk loads the given rows into it, so they can be joined
+    against the database tables in a single set-based statement.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor. The temporary table lives in its session.
+        table_name (str): Name of the temporary table, starting with '#'.
+        columns (list of tuple): Pairs (column name, SQL type) of the temporary table.
+        rows (list of tuple): Rows to load, in the same order as the columns.
+
+    Returns:
+        str: The name of the temporary table, as it must be written in the queries of the backend.
+    """
+    return backend_for(cursor).stage_rows(cursor, table_name, columns, rows)
+
+def drop_staging(cursor, table_name):
+    """
+    Drops a temporary table created with stage_rows.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        table_name (str): Name of the temporary table, as returned by stage_rows.
+    """
+    backend_for(cursor).drop_staging(cursor, table_name)
+
+def dataframe_rows(df, columns):
+    """
+    Converts the given columns of a DataFrame into a list of tuples of Python scalars,
+    the format expected by cursor.executemany. Missing values are converted to None.
+
+    Args:
+        df (pd.DataFrame): Input DataFrame.
+        columns (list of str): Columns to convert, in the order of the SQL statement.
+
+    Returns:
+        list of tuple: One tuple per row of the DataFrame.
+    """
+    values = [
+        [None if value != value else value for value in df[column].tolist()]
+        for column in columns
+    ]
+    return list(zip(*values))
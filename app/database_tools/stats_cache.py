@@ -0,0 +1,155 @@
+"""DETECTOR-DE-NOVEDADES/database_tools/stats_cache.py"""
+import pandas as pd
+from database_tools.backends import backend_for
+from database_tools.staging import stage_rows, drop_staging, dataframe_rows
+
+SERIES_KEYS = ['IdProceso', 'IdGrupo', 'IdDiaSemana']
+STATS_COLUMNS = ['N', 'Mediana', 'MAD', 'Q1', 'Q3', 'RangoCero', 'Normal', 'Bosquejo', 'Media', 'M2', 'M3', 'M4']
+STATS_WATERMARK = 'EstadisticasSeries'
+
+# In-process layer, so repeated calls in the same run do not read the table again. The statistics are
+# kept with the key they were computed for (see series_stats_key) and, without quantile sketches, with
+# the stored consumptions of every series.
+_series_stats_cache = {'key': None, 'stats': None, 'history': None}
+
+def consumption_watermark(cursor, start_id_fecha):
+    """
+    Calculates the current watermark of dbo.ConsumosMIPS: the number of rows and the maximum
+    IdConsumo from the given IdFecha onwards.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        start_id_fecha (int): First IdFecha taken into account by the series statistics.
+
+    Returns:
+        tuple: The pair (rows, max_id_consumo).
+    """
+    cursor.execute(f"""
+        SELECT {backend_for(cursor).count_rows}, MAX(IdConsumo) FROM dbo.ConsumosMIPS
+        WHERE IdFecha >= ?;
+    """, (start_id_fecha,))
+    rows, max_id = cursor.fetchone()
+    return int(rows or 0), int(max_id or 0)
+
+def series_stats_key(cursor, watermark, start_id_fecha, config):
+    """
+    Builds the key of the in-process statistics: they are only reused for the same state of
+    dbo.ConsumosMIPS, the same first date, the same storage backend and the same settings.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        watermark (tuple): Current watermark of dbo.ConsumosMIPS (see consumption_watermark).
+        start_id_fecha (int): First IdFecha taken into account by the series statistics.
+        config (tuple): Settings the statistics depend on, such as the normality test and the
+            capacity of the quantile sketches.
+
+    Returns:
+        tuple: The key.
+    """
+    return tuple(watermark), int(start_id_fecha), type(backend_for(cursor)).__name__, tuple(config)
+
+def read_watermark(cursor, name):
+    """
+    Reads a watermark stored in dbo.MarcasAgua.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        name (str): Name of the watermark.
+
+    Returns:
+        tuple: The pair (rows, max_id_consumo), or None if the watermark does not exist.
+    """
+    cursor.execute('SELECT Filas, MaxIdConsumo FROM dbo.MarcasAgua WHERE Nombre = ?;', (name,))
+    row = cursor.fetchone()
+    return (int(row[0]), int(row[1])) if row else None
+
+def write_watermark(cursor, name, watermark):
+    """
+    Inserts or updates a watermark in dbo.MarcasAgua.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        name (str): Name of the watermark.
+        watermark (tuple): The pair (rows, max_id_consumo).
+    """
+    backend_for(cursor).merge_rows(
+        cursor, 'MarcasAgua', ['Nombre'], ['Filas', 'MaxIdConsumo'],
+        '(SELECT ? AS Nombre, ? AS Filas, ? AS MaxIdConsumo)', (name, int(watermark[0]), int(watermark[1]))
+    )
+
+def load_series_stats(cursor, watermark, start_id_fecha, config=()):
+    """
+    Loads the cached statistics of every series, if they were computed from the given watermark.
+    The in-process copy is used when its key matches (see series_stats_key), otherwise the
+    dbo.EstadisticasSeries table is read.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        watermark (tuple): Current watermark of dbo.ConsumosMIPS (see consumption_watermark).
+        start_id_fecha (int): First IdFecha taken into account by the series statistics.
+        config (tuple, optional): Settings the statistics depend on. Default is no settings.
+
+    Returns:
+        tuple: The statistics indexed by (IdProceso, IdGrupo, IdDiaSemana), or None if the cache is stale,
+        and the stored consumptions of every series kept with the in-process copy (a SeriesIndex), or None.
+    """
+    key = series_stats_key(cursor, watermark, start_id_fecha, config)
+    if _series_stats_cache['key'] == key:
+        return _series_stats_cache['stats'], _series_stats_cache['history']
+
+    if read_watermark(cursor, STATS_WATERMARK) != watermark:
+        return None, None
+
+    cursor.execute(f"SELECT {', '.join(SERIES_KEYS + STATS_COLUMNS)} FROM dbo.EstadisticasSeries;")
+    stats = pd.DataFrame(
+        [tuple(row) for row in cursor.fetchall()],
+        columns=SERIES_KEYS + STATS_COLUMNS
+    )
+    stats = stats.astype({
+        'RangoCero': bool, 'Normal': bool, 'Media': float, 'M2': float, 'M3': float, 'M4': float
+    }).set_index(SERIES_KEYS)
+    _series_stats_cache.update(key=key, stats=stats, history=None)
+    return stats, None
+
+def save_series_stats(cursor, stats, watermark, replace=False):
+    """
+    Stores the statistics of the given series and the watermark they correspond to.
+    The changes are committed by the caller.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        stats (pd.DataFrame): Statistics indexed by (IdProceso, IdGrupo, IdDiaSemana).
+        watermark (tuple): Watermark of dbo.ConsumosMIPS after the statistics were computed.
+        replace (bool, optional): If True, the table is emptied first and only the given series are kept.
+        Default is False, which inserts or updates the given series.
+    """
+    rows = dataframe_rows(stats.reset_index(), SERIES_KEYS + STATS_COLUMNS)
+    staging_table = stage_rows(
+        cursor,
+        '#EstadisticasLote',
+        [('IdProceso', 'INT'), ('IdGrupo', 'INT'), ('IdDiaSemana', 'INT'), ('N', 'INT'),
+         ('Mediana', 'FLOAT'), ('MAD', 'FLOAT'), ('Q1', 'FLOAT'), ('Q3', 'FLOAT'),
+         ('RangoCero', 'BIT'), ('Normal', 'BIT'), ('Bosquejo', backend_for(cursor).binary_type),
+         ('Media', 'FLOAT'), ('M2', 'FLOAT'), ('M3', 'FLOAT'), ('M4', 'FLOAT')],
+        rows
+    )
+    if replace:
+        cursor.execute('DELETE FROM dbo.EstadisticasSeries;')
+    backend_for(cursor).merge_rows(cursor, 'EstadisticasSeries', SERIES_KEYS, STATS_COLUMNS, staging_table)
+    drop_staging(cursor, staging_table)
+    write_watermark(cursor, STATS_WATERMARK, watermark)
+
+def cache_series_stats(cursor, stats, watermark, start_id_fecha, config=(), history=None):
+    """
+    Keeps the statistics of every series in the in-process layer.
+
+    Args:
+        cursor (pyodbc.Cursor): Database cursor.
+        stats (pd.DataFrame): Statistics of every series, indexed by (IdProceso, IdGrupo, IdDiaSemana).
+        watermark (tuple): Watermark of dbo.ConsumosMIPS the statistics correspond to.
+        start_id_fecha (int): First IdFecha taken into account by the series statistics.
+        config (tuple, optional): Settings the statistics depend on. Default is no settings.
+        history (SeriesIndex, optional): Stored consumptions of every series from start_id_fecha, up to
+            the watermark, so the next call does not read them again. Default is to keep none.
+    """
+    _series_stats_cache.update(key=series_stats_key(cursor, watermark, start_id_fecha, config), stats=stats, history=history)
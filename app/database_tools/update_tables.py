@@ -1,5 +1,60 @@
 """DETECTOR-DE-NOVEDADES/database/dataframe_utils.py"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+from monitoring_tools.instrumentation import log_progress, stage, with_stage_path
+from database_tools.calendar_dimension import (
+    build_calendar,
+    date_ids,
+    day_of_week_ids,
+    insert_calendar,
+    max_id_fecha,
+    month_dates
+)
+from database_tools.backends import backend_for, rows_exist
+from database_tools.staging import stage_rows, drop_staging, dataframe_rows
+
+def upsert_dimension(conn, table, key_columns, id_column, keys, id_sequence=None):
+    """Insert the missing keys of a dimension table and return the ID of every given key.
+
+    The keys are bulk loaded into a temporary table and a single batch inserts the ones that
+    do not exist yet and reads back the ID of all of them, so the number of round-trips does
+    not depend on the number of keys. New IDs follow the order of the given keys.
+
+    Args:
+        conn (pyodbc.Connection): Database connection.
+        table (str): Name of the dimension table in the dbo schema.
+        key_columns (list of tuple): Pairs (column name, SQL type) of the natural key of the table.
+        id_column (str): Name of the ID column of the table.
+        keys (list of array-like): Unique values of each key column, aligned with key_columns.
+        id_sequence (str, optional): Sequence that generates the IDs of the new rows.
+            Default is MAX(id_column) plus the position of the new key.
+
+    Returns:
+        dict: A dictionary mapping every key (a scalar for single-column keys, a tuple otherwise) to its ID.
+    """
+    cursor = conn.cursor()
+    key_names = [name for name, _ in key_columns]
+    keys = pd.DataFrame({name: list(values) for name, values in zip(key_names, keys)})
+    if keys.empty:
+        return {}
+    keys.insert(0, 'Fila', range(len(keys)))
+    staging_table = stage_rows(
+        cursor,
+        '#DimensionLote',
+        [('Fila', 'INT')] + list(key_columns),
+        dataframe_rows(keys, list(keys.columns))
+    )
+    ids = dict(backend_for(conn).insert_dimension_rows(
+        cursor, table, id_column, key_names, staging_table, id_sequence
+    ))
+    drop_staging(cursor, staging_table)
+    conn.commit()
+
+    key_values = keys[key_names].itertuples(index=False, name=None)
+    if len(key_names) == 1:
+        key_values = (key[0] for key in key_values)
+    return {key: ids.get(row) for row, key in enumerate(key_values)}
 
 def update_processes(conn, df):
     """Update processes in the database and update the input DataFrame with process IDs.
@@ -11,38 +66,11 @@ def update_processes(conn, df):
     Returns:
         pd.DataFrame: Updated DataFrame with 'IdProceso' column.
     """
-    print("Updating the Procesos table.")
-    cursor = conn.cursor()
-    cursor.execute('SELECT IdProceso, NombreProceso FROM dbo.Procesos')
-    existing_processes = cursor.fetchall()
-    existing_processes_dict = {row[1]: row[0] for row in existing_processes}
-    nombres_proceso_unicos = df['NombreProceso'].unique()
-    new_processes = [proc for proc in nombres_proceso_unicos if proc not in existing_processes_dict]
-    if new_processes:
-        cursor.execute("""
-            CREATE TABLE #TempProcesos (
-                IdProceso INT,
-                NombreProceso NVARCHAR(255)
-            )
-        """)
-        data_to_insert = [
-            (len(existing_processes_dict) + i + 1, proc)
-            for i, proc in enumerate(new_processes)
-        ]
-        cursor.executemany("""
-            INSERT INTO #TempProcesos (IdProceso, NombreProceso)
-            VALUES (?, ?)
-        """, data_to_insert)
-        cursor.execute("""
-            INSERT INTO dbo.Procesos (IdProceso, NombreProceso)
-            SELECT t.IdProceso, t.NombreProceso
-            FROM #TempProcesos t
-        """)
-        cursor.execute("DROP TABLE #TempProcesos")
-        conn.commit()
-        for id_proc, proc in data_to_insert:
-            existing_processes_dict[proc] = id_proc
-    df['IdProceso'] = df['NombreProceso'].map(existing_processes_dict)
+    log_progress("Updating the Procesos table.")
+    process_ids = upsert_dimension(
+        conn, 'Procesos', [('NombreProceso', 'NVARCHAR(100)')], 'IdProceso', [df['NombreProceso'].unique()]
+    )
+    df['IdProceso'] = df['NombreProceso'].map(process_ids)
     return df
 
 def update_groups(conn, df):
@@ -55,21 +83,11 @@ def update_groups(conn, df):
     Returns:
         pd.DataFrame: Updated DataFrame with 'IdGrupo' column.
     """
-    print("Updating the Grupos table.")
-    cursor = conn.cursor()
-    cursor.execute('SELECT IdGrupo, NombreGrupo FROM dbo.Grupos')
-    existing_groups = cursor.fetchall()
-    existing_groups_dict = {row[1]: row[0] for row in existing_groups}
-    nombres_grupo_unicos = df['NombreGrupo'].unique()
-    new_groups = [grp for grp in nombres_grupo_unicos if grp not in existing_groups_dict]
-    if new_groups:
-        for grp in new_groups:
-            new_id = len(existing_groups_dict) + 1
-            cursor.execute('INSERT INTO dbo.Grupos (IdGrupo, NombreGrupo) VALUES (?, ?)',
-                           (new_id, grp))
-            existing_groups_dict[grp] = new_id
-        conn.commit()
-    df['IdGrupo'] = df['NombreGrupo'].map(existing_groups_dict)
+    log_progress("Updating the Grupos table.")
+    group_ids = upsert_dimension(
+        conn, 'Grupos', [('NombreGrupo', 'NVARCHAR(100)')], 'IdGrupo', [df['NombreGrupo'].unique()]
+    )
+    df['IdGrupo'] = df['NombreGrupo'].map(group_ids)
     return df
 
 def update_procesos_grupos(conn, df):
@@ -82,33 +100,16 @@ def update_procesos_grupos(conn, df):
     Returns:
         None
     """
-    print("Updating the ProcesosGrupos table.")
-    cursor = conn.cursor()
-    df = df.drop_duplicates(subset=['IdProceso', 'IdGrupo'])
-    data_to_insert = [
-        (row['IdProceso'], row['IdGrupo'])
-        for _, row in df.iterrows()
-    ]
-    cursor.execute("""
-        CREATE TABLE #TempProcesosGrupos (
-            IdProceso INT,
-            IdGrupo INT
-        )
-    """)
-    cursor.executemany("""
-        INSERT INTO #TempProcesosGrupos (IdProceso, IdGrupo)
-        VALUES (?, ?)
-    """, data_to_insert)
-    cursor.execute("""
-        INSERT INTO dbo.ProcesosGrupos (IdProcesoGrupo, IdProceso, IdGrupo)
-        SELECT NEXT VALUE FOR proceso_grupo_seq, t.IdProceso, t.IdGrupo
-        FROM #TempProcesosGrupos t
-        LEFT JOIN dbo.ProcesosGrupos pg
-        ON t.IdProceso = pg.IdProceso AND t.IdGrupo = pg.IdGrupo
-        WHERE pg.IdProceso IS NULL AND pg.IdGrupo IS NULL
-    """)
-    cursor.execute("DROP TABLE #TempProcesosGrupos")
-    conn.commit()
+    log_progress("Updating the ProcesosGrupos table.")
+    pairs = df[['IdProceso', 'IdGrupo']].drop_duplicates().astype(int)
+    upsert_dimension(
+        conn,
+        'ProcesosGrupos',
+        [('IdProceso', 'INT'), ('IdGrupo', 'INT')],
+        'IdProcesoGrupo',
+        [pairs['IdProceso'].to_numpy(), pairs['IdGrupo'].to_numpy()],
+        id_sequence='proceso_grupo_seq'
+    )
 
 def update_fechas(conn, df):
     """
@@ -116,6 +117,8 @@ def update_fechas(conn, df):
     If the last date in the DataFrame is the first day of the month,
     insert the dates of the next month into the database with their respective IdFecha,
     the purpose of this is to help the forecasting model to predict the next month.
+    Dates of the DataFrame after the last date of the table are inserted first, up to the end of their month.
+    The dates are generated and bulk inserted with the calendar_dimension helpers.
 
     Args:
         conn (pyodbc.Connection): Database connection.
@@ -124,61 +127,81 @@ def update_fechas(conn, df):
     Returns:
         pd.DataFrame: Updated DataFrame with 'IdFecha' column.
     """
-    print("Updating the Fechas table.")
+    log_progress("Updating the Fechas table.")
     cursor = conn.cursor()
-    unique_dates = list(set(pd.to_datetime(df['Fecha']).dt.date))
-    cursor.execute('SELECT COUNT(*) FROM dbo.Fechas')
-    if cursor.fetchone()[0] == 0:
-        unique_dates = sorted(unique_dates)
-        last_date = unique_dates[-1]
-        current_month_dates = pd.date_range(
+    fechas = pd.to_datetime(df['Fecha']).dt.normalize()
+    last_id_fecha = max_id_fecha(cursor)
+    if last_id_fecha == 0:
+        last_date = fechas.max()
+        calendar_dates = fechas.unique().tolist()
+        calendar_dates.extend(pd.date_range(
             start=last_date + pd.Timedelta(days=1),
             end=last_date + pd.offsets.MonthEnd(0)
-        )
-        next_month_dates = pd.date_range(
-            start=last_date + pd.offsets.MonthBegin(1),
-            end=(last_date + pd.offsets.MonthBegin(2)) - pd.Timedelta(days=1)
-        )
-        unique_dates.extend(current_month_dates)
-        unique_dates.extend(next_month_dates)
-        for idx, date in enumerate(unique_dates, start=1):
-            cursor.execute(
-                'INSERT INTO dbo.Fechas (IdFecha, Fecha) VALUES (?, ?)',
-                (idx, date)
-            )
+        ))
+        calendar_dates.extend(month_dates(last_date + pd.offsets.MonthBegin(1)))
+        insert_calendar(cursor, build_calendar(calendar_dates, 1))
         conn.commit()
-        cursor.execute('SELECT IdFecha, Fecha FROM dbo.Fechas')
-        existing_dates = cursor.fetchall()
-        existing_dates_dict = {row[1]: row[0] for row in existing_dates}
-        df['IdFecha'] = pd.to_datetime(df['Fecha']).dt.date.map(existing_dates_dict)
+        df['IdFecha'] = fechas.dt.date.map(date_ids(cursor))
     else:
-        cursor.execute('SELECT IdFecha, Fecha FROM dbo.Fechas')
-        existing_dates = cursor.fetchall()
-        existing_dates_dict = {row[1]: row[0] for row in existing_dates}
-        df['IdFecha'] = pd.to_datetime(df['Fecha']).dt.date.map(existing_dates_dict)
-        if any(date.day == 1 for date in unique_dates):
-            print("Inserting the next month dates into the Fechas table.")
+        # Dates after the last stored one, e.g. when the data is loaded in chunks, are appended
+        # up to the end of their month, so the table keeps ending on a full month
+        cursor.execute('SELECT MAX(Fecha) FROM dbo.Fechas;')
+        last_db_date = pd.to_datetime(cursor.fetchone()[0])
+        if fechas.max() > last_db_date:
+            new_dates = pd.date_range(
+                start=last_db_date + pd.Timedelta(days=1),
+                end=fechas.max() + pd.offsets.MonthEnd(0)
+            )
+            insert_calendar(cursor, build_calendar(new_dates, last_id_fecha + 1))
+            conn.commit()
+            last_id_fecha = max_id_fecha(cursor)
+        df['IdFecha'] = fechas.dt.date.map(date_ids(cursor))
+        if (fechas.dt.day == 1).any():
+            log_progress("Inserting the next month dates into the Fechas table.")
             cursor.execute('SELECT MAX(Fecha) FROM dbo.Fechas;')
             last_db_date = cursor.fetchone()[0]
             if last_db_date:
-                last_db_date = pd.to_datetime(last_db_date)
-                next_month = last_db_date + pd.offsets.MonthBegin(1)
-                next_month_dates = pd.date_range(
-                    start=next_month,
-                    end=(next_month + pd.offsets.MonthBegin(1)) - pd.Timedelta(days=1)
-                )
-                cursor.execute('SELECT MAX(IdFecha) FROM dbo.Fechas;')
-                last_id_fecha = cursor.fetchone()[0] or 0
-                new_id_fecha = last_id_fecha + 1
-                for date in next_month_dates:
-                    cursor.execute(
-                        'INSERT INTO dbo.Fechas (IdFecha, Fecha) VALUES (?, ?)',
-                        (new_id_fecha, date)
-                    )
-                    new_id_fecha += 1
+                next_month = pd.to_datetime(last_db_date) + pd.offsets.MonthBegin(1)
+                insert_calendar(cursor, build_calendar(month_dates(next_month), last_id_fecha + 1))
                 conn.commit()
     return df
 
+# Dimension updates that only depend on the source columns, with the column they read and the ID they add
+INDEPENDENT_DIMENSIONS = [
+    (update_processes, 'NombreProceso', 'IdProceso'),
+    (update_groups, 'NombreGrupo', 'IdGrupo'),
+    (update_fechas, 'Fecha', 'IdFecha')
+]
+
+def update_dimensions_concurrently(connections, df):
+    """
+    Runs update_processes, update_groups and update_fechas at the same time, each in its own thread and
+    on its own connection, so their round trips overlap. Every update works on a copy of the only
+    column it reads, and the IDs are added to the DataFrame once all of them finish.
+
+    Args:
+        connections (list of pyodbc.Connection): One connection per independent dimension, not used by other threads.
+        df (pd.DataFrame): Input DataFrame containing 'NombreProceso', 'NombreGrupo' and 'Fecha' columns.
+
+    Returns:
+        pd.DataFrame: Updated DataFrame with 'IdProceso', 'IdGrupo' and 'IdFecha' columns.
+    """
+    def run(update, conn, column_df, id_column):
+        with stage(update.__name__, rows_in=len(column_df)) as record:
+            ids = update(conn, column_df)[id_column]
+            record.rows_out = len(ids)
+        return ids
+
+    with ThreadPoolExecutor(max_workers=len(INDEPENDENT_DIMENSIONS)) as executor:
+        futures = [
+            (id_column, executor.submit(with_stage_path(run), update, conn, df[[column]].copy(), id_column))
+            for (update, column, id_column), conn in zip(INDEPENDENT_DIMENSIONS, connections)
+        ]
+        ids = {id_column: future.result() for id_column, future in futures}
+    for id_column, values in ids.items():
+        df[id_column] = values.to_numpy()
+    return df
+
 def add_day_of_week_id(df):
     """
     Add a column 'IdDiaSemana' to the DataFrame based on the day of the week.
@@ -189,24 +212,15 @@ def add_day_of_week_id(df):
     Returns:
         pd.DataFrame: Updated DataFrame with 'IdDiaSemana' column.
     """
-    mapeo_dias = {
-        'Monday': 1,
-        'Tuesday': 2,
-        'Wednesday': 3,
-        'Thursday': 4,
-        'Friday': 5,
-        'Saturday': 6,
-        'Sunday': 7
-    }
-    df['DiaSemana'] = df['Fecha'].dt.day_name()
-    df['IdDiaSemana'] = df['DiaSemana'].map(mapeo_dias)
-    df = df.drop(columns=['DiaSemana'])
+    df['IdDiaSemana'] = day_of_week_ids(df['Fecha']).to_numpy()
     return df
 
 def filter_existing_rows(df, conn):
     """
     Filters out rows from the DataFrame that already exist in the database.
     In case the data does not exist in the database, the function returns the input DataFrame.
+    Otherwise the keys of the batch are staged in a temporary table and the rows that are not
+    in dbo.ConsumosMIPS are resolved with a single anti-join.
 
     Parameters:
     df (pd.DataFrame): The input DataFrame.
@@ -215,40 +229,44 @@ def filter_existing_rows(df, conn):
     Returns:
     pd.DataFrame: The DataFrame with rows not existing in the database.
     """
-    print("Identifying if the data already exists.")
-    rows_to_remove = []
+    log_progress("Identifying if the data already exists.")
     cursor = conn.cursor()
     unique_id_fecha_df = list(set(df['IdFecha'].astype(int).tolist()))
     placeholders = ', '.join('?' for _ in unique_id_fecha_df)
-    query = f'SELECT TOP 1 1 FROM dbo.ConsumosMIPS WHERE IdFecha IN ({placeholders})'
-    cursor.execute(query, *unique_id_fecha_df)
-    if cursor.fetchone() is None:
-        print(
+    if not rows_exist(cursor, f'FROM dbo.ConsumosMIPS WHERE IdFecha IN ({placeholders})', unique_id_fecha_df):
+        log_progress(
             "The new data from the dataset is able to be inserted."
         )
         return df
-    print("The data already exists in the database. Filtering out the existing data.")
-    for index, row in df.iterrows():
-        query = """
-        SELECT 1 FROM dbo.ConsumosMIPS
-        WHERE IdProceso = ? AND IdGrupo = ? AND IdFecha = ? AND IdDiaSemana = ?
-        """
-        cursor.execute(
-            query,
-            (int(row['IdProceso']),
-             int(row['IdGrupo']),
-             int(row['IdFecha']),
-             int(row['IdDiaSemana']))
+    log_progress("The data already exists in the database. Filtering out the existing data.")
+    keys = df[['IdProceso', 'IdGrupo', 'IdFecha', 'IdDiaSemana']].astype(int)
+    keys.insert(0, 'Fila', range(len(df)))
+    staging_table = stage_rows(
+        cursor,
+        '#ClavesLote',
+        [('Fila', 'INT'), ('IdProceso', 'INT'), ('IdGrupo', 'INT'), ('IdFecha', 'INT'), ('IdDiaSemana', 'INT')],
+        dataframe_rows(keys, list(keys.columns))
+    )
+    cursor.execute(f"""
+        SELECT l.Fila
+        FROM {staging_table} l
+        WHERE NOT EXISTS (
+            SELECT 1 FROM dbo.ConsumosMIPS c
+            WHERE c.IdProceso = l.IdProceso AND c.IdGrupo = l.IdGrupo
+            AND c.IdFecha = l.IdFecha AND c.IdDiaSemana = l.IdDiaSemana
         )
-        result = cursor.fetchone()
-        if result:
-            rows_to_remove.append(index)
-    df.drop(rows_to_remove, inplace=True)
-    if len(rows_to_remove) > 0:
-        print(
-            f"{len(rows_to_remove)} row(s) you are trying to insert in the database already exist. "
+        ORDER BY l.Fila
+    """)
+    rows_to_keep = [row[0] for row in cursor.fetchall()]
+    drop_staging(cursor, staging_table)
+
+    removed = len(df) - len(rows_to_keep)
+    df = df.iloc[rows_to_keep]
+    if df.empty:
+        log_progress("All data already exists in the database. Please provide a different dataset.", logging.WARNING)
+    elif removed > 0:
+        log_progress(
+            f"{removed} row(s) you are trying to insert in the database already exist. "
             "No duplicated keys admitted. They won't be inserted."
         )
-    elif len(rows_to_remove) == len(df):
-        print("All data already exists in the database. Please provide a different dataset.")
     return df
@@ -0,0 +1,208 @@
+"""DETECTOR-DE-NOVEDADES/detection_tools/normality.py"""
+import os
+import numpy as np
+import scipy.stats as stats
+from detection_tools.robust_stats import group_offsets, segment_codes, segment_shapiro_normal
+from monitoring_tools.instrumentation import count_event, log_progress
+
+# Columns of the running central moments of a series: mean and sums of the powers of the deviations.
+MOMENT_COLUMNS = ['Media', 'M2', 'M3', 'M4']
+
+def normality_method() -> str:
+    """
+    Reads the normality test used to choose the labeling method of the series.
+
+    Returns:
+        str: 'shapiro' (the Shapiro-Wilk test on the whole history, the default) or 'moments'
+        (the D'Agostino-Pearson test on the running moments of the series, see moments_normal).
+    """
+    method = (os.getenv('NORMALITY_TEST') or 'shapiro').strip().lower()
+    if method not in ('shapiro', 'moments'):
+        raise ValueError(f"NORMALITY_TEST must be 'shapiro' or 'moments', not {method!r}.")
+    return method
+
+def shapiro_recheck_every() -> int:
+    """
+    Reads how often the Shapiro-Wilk test is run again on the series labeled with the moments test.
+
+    Returns:
+        int: A series is checked every time its number of values reaches a multiple of NORMALITY_RECHECK_EVERY.
+        0 (the default) disables the check.
+    """
+    return int(os.getenv('NORMALITY_RECHECK_EVERY') or 0)
+
+def segment_moments(values: np.ndarray, offsets: np.ndarray) -> dict:
+    """
+    Calculates the count, mean and sums of the 2nd, 3rd and 4th powers of the deviations from the mean
+    of every group of values stored group after group.
+
+    Parameters:
+    values (np.ndarray): Values of every group, one group after the other.
+    offsets (np.ndarray): Group boundaries, of length n_groups + 1.
+
+    Returns:
+    dict: Arrays of length n_groups with the keys 'n', 'mean', 'm2', 'm3' and 'm4'. The mean of the
+    empty groups is NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    codes = segment_codes(offsets)
+    n_groups = len(offsets) - 1
+    n = np.diff(offsets).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(codes, weights=values, minlength=n_groups) / n
+    deviations = values - mean[codes]
+    squares = deviations * deviations
+    return {
+        'n': n,
+        'mean': mean,
+        'm2': np.bincount(codes, weights=squares, minlength=n_groups),
+        'm3': np.bincount(codes, weights=squares * deviations, minlength=n_groups),
+        'm4': np.bincount(codes, weights=squares * squares, minlength=n_groups)
+    }
+
+def merge_moments(a: dict, b: dict) -> dict:
+    """
+    Combines the moments of two disjoint sets of values of the same groups, so the moments of a series
+    are updated with the ones of its new values without reading its history.
+
+    Parameters:
+    a (dict): Moments of the first set (see segment_moments).
+    b (dict): Moments of the second set, with arrays of the same length.
+
+    Returns:
+    dict: The moments of the union of both sets. They are NaN where the moments of a non-empty set are unknown.
+    """
+    n_a, n_b = np.asarray(a['n'], dtype=np.float64), np.asarray(b['n'], dtype=np.float64)
+    n = n_a + n_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(n_b > 0, b['mean'], 0) - np.where(n_a > 0, a['mean'], 0)
+        # Weights of the other set in the update; 0 when either set is empty
+        w_a = np.where(n > 0, n_a / n, 0)
+        w_b = np.where(n > 0, n_b / n, 0)
+    m2_a, m2_b = np.asarray(a['m2'], dtype=np.float64), np.asarray(b['m2'], dtype=np.float64)
+    m3_a, m3_b = np.asarray(a['m3'], dtype=np.float64), np.asarray(b['m3'], dtype=np.float64)
+    cross = n_a * w_b * delta * delta
+    return {
+        'n': n,
+        'mean': np.where(n > 0, np.where(n_a > 0, a['mean'], 0) + w_b * delta, np.nan),
+        'm2': m2_a + m2_b + cross,
+        'm3': m3_a + m3_b + cross * delta * (w_a - w_b) + 3 * delta * (w_a * m2_b - w_b * m2_a),
+        'm4': (np.asarray(a['m4'], dtype=np.float64) + np.asarray(b['m4'], dtype=np.float64)
+               + cross * delta * delta * (w_a * w_a - w_a * w_b + w_b * w_b)
+               + 6 * delta * delta * (w_a * w_a * m2_b + w_b * w_b * m2_a)
+               + 4 * delta * (w_a * m3_b - w_b * m3_a))
+    }
+
+def moments_normal(n: np.ndarray, m2: np.ndarray, m3: np.ndarray, m4: np.ndarray, alpha: float = 0.05) -> np.ndarray:
+    """
+    Decides, from the running moments of every series, whether the D'Agostino-Pearson K² test does not
+    reject normality (p-value > alpha). The statistic combines the tests of the skewness and the kurtosis
+    of scipy.stats.skewtest and scipy.stats.kurtosistest, so the decision is the one of scipy.stats.normaltest
+    on the values, computed in O(1) per series.
+
+    Parameters:
+    n (np.ndarray): Number of values of every series.
+    m2, m3, m4 (np.ndarray): Sums of the 2nd, 3rd and 4th powers of the deviations from the mean.
+    alpha (float, optional): Significance level. Default is 0.05.
+
+    Returns:
+    np.ndarray: Boolean array, True for the series that look Gaussian. The series with less than
+    20 values, no spread or unknown moments are False.
+    """
+    n = np.asarray(n, dtype=np.float64)
+    m2, m3, m4 = (np.asarray(m, dtype=np.float64) for m in (m2, m3, m4))
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        variance = m2 / n
+        skewness = (m3 / n) / variance ** 1.5
+        kurtosis = (m4 / n) / (variance * variance)
+
+        y = skewness * np.sqrt((n + 1) * (n + 3) / (6.0 * (n - 2)))
+        beta2 = 3.0 * (n * n + 27 * n - 70) * (n + 1) * (n + 3) / ((n - 2) * (n + 5) * (n + 7) * (n + 9))
+        w2 = -1 + np.sqrt(2 * (beta2 - 1))
+        delta = 1 / np.sqrt(0.5 * np.log(w2))
+        alpha_y = np.sqrt(2.0 / (w2 - 1))
+        y = np.where(y == 0, 1, y)
+        z_skewness = delta * np.log(y / alpha_y + np.sqrt((y / alpha_y) ** 2 + 1))
+
+        expected = 3.0 * (n - 1) / (n + 1)
+        variance_b2 = 24.0 * n * (n - 2) * (n - 3) / ((n + 1) * (n + 1) * (n + 3) * (n + 5))
+        x = (kurtosis - expected) / np.sqrt(variance_b2)
+        sqrt_beta1 = 6.0 * (n * n - 5 * n + 2) / ((n + 7) * (n + 9)) * np.sqrt(6.0 * (n + 3) * (n + 5) / (n * (n - 2) * (n - 3)))
+        a = 6.0 + 8.0 / sqrt_beta1 * (2.0 / sqrt_beta1 + np.sqrt(1 + 4.0 / (sqrt_beta1 * sqrt_beta1)))
+        denominator = 1 + x * np.sqrt(2 / (a - 4.0))
+        term = np.sign(denominator) * np.where(denominator == 0, np.nan, np.cbrt((1 - 2.0 / a) / np.abs(denominator)))
+        z_kurtosis = (1 - 2 / (9.0 * a) - term) / np.sqrt(2 / (9.0 * a))
+
+        p_value = stats.chi2.sf(z_skewness * z_skewness + z_kurtosis * z_kurtosis, 2)
+    return (n >= 20) & (m2 > 0) & (p_value > alpha)
+
+def recheck_normality(normal: np.ndarray, shapiro_normal: np.ndarray, checked: np.ndarray):
+    """
+    Compares the moments decision with the Shapiro-Wilk decision on the checked series and adds the
+    result to the run report, as the events 'normality_rechecks' and 'normality_disagreements', and to the log.
+
+    Parameters:
+    normal (np.ndarray): Decision of the moments test of every series.
+    shapiro_normal (np.ndarray): Decision of the Shapiro-Wilk test, for the checked series.
+    checked (np.ndarray): Boolean array with the series that were checked.
+
+    Returns:
+    int: The number of checked series where both decisions differ.
+    """
+    disagreements = int((normal != shapiro_normal)[checked].sum())
+    count_event('normality_rechecks', int(checked.sum()))
+    count_event('normality_disagreements', disagreements)
+    if checked.any():
+        log_progress(f"Normality recheck: the moments and Shapiro-Wilk tests disagree on {disagreements} of {int(checked.sum())} series.")
+    return disagreements
+
+def segment_normal(values: np.ndarray, offsets: np.ndarray, selected: np.ndarray, moments: dict = None, added: np.ndarray = None) -> np.ndarray:
+    """
+    Decides, for the selected groups of values stored group after group, whether they look Gaussian with
+    the test of NORMALITY_TEST (see normality_method). With the moments test, the groups whose number of
+    values reached a multiple of NORMALITY_RECHECK_EVERY with the last values added are also tested with
+    Shapiro-Wilk, and the disagreements are reported (see recheck_normality). The moments decision is kept.
+
+    Parameters:
+    values (np.ndarray): Values of every group, one group after the other, in their stored order.
+    offsets (np.ndarray): Group boundaries, of length n_groups + 1.
+    selected (np.ndarray): Boolean array of length n_groups with the groups to test.
+    They need at least 20 values and some spread.
+    moments (dict, optional): Moments of the groups (see segment_moments). Default is computed from the values.
+    added (np.ndarray, optional): Number of values added to every group since its last decision.
+    Default is every value, so every group with NORMALITY_RECHECK_EVERY values or more is checked.
+
+    Returns:
+    np.ndarray: Boolean array of length n_groups, True for the selected groups that look Gaussian.
+    """
+    if normality_method() == 'shapiro':
+        return segment_shapiro_normal(values, offsets, selected)
+
+    moments = segment_moments(values, offsets) if moments is None else moments
+    normal = selected & moments_normal(moments['n'], moments['m2'], moments['m3'], moments['m4'])
+    every = shapiro_recheck_every()
+    if every > 0:
+        sizes = np.diff(offsets)
+        added = sizes if added is None else np.asarray(added, dtype=np.int64)
+        checked = selected & (sizes // every > (sizes - added) // every)
+        recheck_normality(normal, segment_shapiro_normal(values, offsets, checked), checked)
+    return normal
+
+def group_normal(codes: np.ndarray, values: np.ndarray, n_groups: int, selected: np.ndarray) -> np.ndarray:
+    """
+    Decides, for the selected groups, whether they look Gaussian with the test of NORMALITY_TEST
+    (see segment_normal). The values of every group are taken in the order they appear in `values`.
+
+    Parameters:
+    codes (np.ndarray): Dense group code (0 .. n_groups - 1) of every value.
+    values (np.ndarray): Values in their original order.
+    n_groups (int): Number of groups.
+    selected (np.ndarray): Boolean array of length n_groups with the groups to test.
+
+    Returns:
+    np.ndarray: Boolean array of length n_groups, True for the selected groups that look Gaussian.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(codes, kind='stable')
+    return segment_normal(values[order], group_offsets(codes, n_groups), selected)
@@ -0,0 +1,213 @@
+"""DETECTOR-DE-NOVEDADES/detection_tools/quantile_sketch.py"""
+import math
+import numpy as np
+
+MIN_CAPACITY = 32
+
+def capacity_for_error(epsilon: float) -> int:
+    """
+    Calculates the capacity k of a QuantileSketch whose normalized rank error is approximately epsilon.
+
+    Parameters:
+    epsilon (float): Target rank error, as a fraction of the number of values (e.g. 0.01 for 1%).
+
+    Returns:
+    int: The capacity k, never lower than MIN_CAPACITY.
+    """
+    return max(MIN_CAPACITY, int(math.ceil(2.0 / epsilon)))
+
+class QuantileSketch:
+    """
+    Compact and mergeable quantile sketch (KLL) of the consumptions of one series.
+
+    The sketch keeps a hierarchy of compactors. Every value stored at level h represents 2**h values
+    of the series, so the memory grows with the capacity k and not with the number of values.
+    While no compaction has happened (at most k values) the sketch holds every value and its
+    statistics are exact.
+
+    Parameters:
+    k (int): Capacity of the top compactor. Bigger values reduce the error (see capacity_for_error).
+    """
+
+    def __init__(self, k: int = 200):
+        self.k = max(MIN_CAPACITY, int(k))
+        self.n = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.levels = [[]]
+        self.offsets = [0]
+
+    @classmethod
+    def from_values(cls, values, k: int = 200):
+        """
+        Builds a sketch from an array of values.
+
+        Parameters:
+        values (array-like): Values of the series, in the order they were observed.
+        k (int): Capacity of the sketch.
+
+        Returns:
+        QuantileSketch: The sketch holding the values.
+        """
+        sketch = cls(k)
+        sketch.update(values)
+        return sketch
+
+    def _capacity(self, level: int) -> int:
+        height = len(self.levels) - level - 1
+        return int(math.ceil((2 / 3) ** height * self.k)) + 1
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(level) for level in range(len(self.levels)))
+
+    def _compress(self):
+        for level, items in enumerate(self.levels):
+            if len(items) >= self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append([])
+                    self.offsets.append(0)
+                items.sort()
+                leftover = [items.pop()] if len(items) % 2 else []
+                # Alternating the kept half of each level makes the sketch deterministic and unbiased on average.
+                offset = self.offsets[level]
+                self.offsets[level] = 1 - offset
+                self.levels[level + 1].extend(items[offset::2])
+                self.levels[level] = leftover
+                break
+
+    def update(self, values):
+        """
+        Adds one or many new values to the sketch.
+
+        Parameters:
+        values (float or array-like): New values of the series.
+        """
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        for value in values.tolist():
+            self.levels[0].append(value)
+            self.n += 1
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+            if sum(len(items) for items in self.levels) >= self._max_size():
+                self._compress()
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one, as if its values had been added to it.
+
+        Parameters:
+        other (QuantileSketch): Sketch of the values to add.
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+            self.offsets.append(0)
+        for level, items in enumerate(other.levels):
+            self.levels[level].extend(items)
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while sum(len(items) for items in self.levels) >= self._max_size():
+            self._compress()
+
+    @property
+    def is_exact(self) -> bool:
+        """bool: True while the sketch holds every value of the series."""
+        return len(self.levels[0]) == self.n
+
+    def _weighted_items(self):
+        items = np.concatenate([np.asarray(level, dtype=np.float64) for level in self.levels])
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.float64) for h, level in enumerate(self.levels)])
+        return items, weights
+
+    @staticmethod
+    def _weighted_quantile(items, weights, q):
+        order = np.argsort(items, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        return items[order][min(position, len(items) - 1)]
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates the q-quantile of the series. It is exact (same as np.quantile) while is_exact is True.
+
+        Parameters:
+        q (float): Quantile to estimate, between 0 and 1.
+
+        Returns:
+        float: The estimated quantile, NaN for an empty sketch.
+        """
+        if self.n == 0:
+            return np.nan
+        if self.is_exact:
+            return float(np.quantile(self.levels[0], q))
+        items, weights = self._weighted_items()
+        return float(self._weighted_quantile(items, weights, q))
+
+    def median(self) -> float:
+        """
+        Estimates the median of the series. It is exact (same as np.median) while is_exact is True.
+
+        Returns:
+        float: The estimated median, NaN for an empty sketch.
+        """
+        if self.n == 0:
+            return np.nan
+        if self.is_exact:
+            return float(np.median(self.levels[0]))
+        return self.quantile(0.5)
+
+    def median_abs_deviation(self) -> float:
+        """
+        Estimates the median of |x - median| of the series. It is exact (same as
+        scipy.stats.median_abs_deviation) while is_exact is True.
+
+        Returns:
+        float: The estimated median absolute deviation, NaN for an empty sketch.
+        """
+        if self.n == 0:
+            return np.nan
+        median = self.median()
+        if self.is_exact:
+            return float(np.median(np.abs(np.asarray(self.levels[0]) - median)))
+        items, weights = self._weighted_items()
+        return float(self._weighted_quantile(np.abs(items - median), weights, 0.5))
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the sketch to store it in the database.
+
+        Returns:
+        bytes: The serialized sketch (see from_bytes).
+        """
+        header = np.array(
+            [self.k, self.n, len(self.levels)] + [len(level) for level in self.levels] + self.offsets,
+            dtype=np.int64
+        )
+        values = np.array([self.min, self.max] + [value for level in self.levels for value in level], dtype=np.float64)
+        return header.tobytes() + values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Deserializes a sketch stored with to_bytes.
+
+        Parameters:
+        data (bytes): The serialized sketch.
+
+        Returns:
+        QuantileSketch: The sketch.
+        """
+        k, n, n_levels = np.frombuffer(data, dtype=np.int64, count=3).tolist()
+        header = np.frombuffer(data, dtype=np.int64, count=3 + 2 * n_levels).tolist()
+        sizes = header[3:3 + n_levels]
+        values = np.frombuffer(data, dtype=np.float64, offset=8 * len(header)).tolist()
+
+        sketch = cls(k)
+        sketch.n = n
+        sketch.min, sketch.max = values[0], values[1]
+        bounds = np.concatenate([[2], 2 + np.cumsum(sizes)]).tolist()
+        sketch.levels = [values[bounds[h]:bounds[h + 1]] for h in range(n_levels)]
+        sketch.offsets = header[3 + n_levels:]
+        return sketch
@@ -0,0 +1,210 @@
+"""DETECTOR-DE-NOVEDADES/detection_tools/robust_stats.py"""
+import numpy as np
+import scipy.stats as stats
+
+def group_offsets(codes: np.ndarray, n_groups: int) -> np.ndarray:
+    """
+    Calculates the boundaries of every group once the values are sorted by group.
+
+    Parameters:
+    codes (np.ndarray): Dense group code (0 .. n_groups - 1) of every value.
+    n_groups (int): Number of groups.
+
+    Returns:
+    np.ndarray: Array of length n_groups + 1, the values of the group g are at offsets[g]:offsets[g + 1].
+    """
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(np.asarray(codes, dtype=np.int64), minlength=n_groups), out=offsets[1:])
+    return offsets
+
+def segment_codes(offsets: np.ndarray) -> np.ndarray:
+    """
+    Calculates the group code of every value of a segmented array, the inverse of group_offsets.
+
+    Parameters:
+    offsets (np.ndarray): Group boundaries, of length n_groups + 1.
+
+    Returns:
+    np.ndarray: The group code (0 .. n_groups - 1) of every value.
+    """
+    return np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+
+def group_values(codes: np.ndarray, values: np.ndarray, n_groups: int):
+    """
+    Sorts the values by group and, inside each group, in ascending order.
+
+    Parameters:
+    codes (np.ndarray): Dense group code (0 .. n_groups - 1) of every value.
+    values (np.ndarray): Values to be grouped.
+    n_groups (int): Number of groups.
+
+    Returns:
+    tuple: A tuple containing:
+        - sorted_values (np.ndarray): The values sorted by group and value.
+        - offsets (np.ndarray): Array of length n_groups + 1, the values of the group g
+          are sorted_values[offsets[g]:offsets[g + 1]].
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.lexsort((values, codes))
+    return values[order], group_offsets(codes, n_groups)
+
+def segment_quantile(sorted_values: np.ndarray, offsets: np.ndarray, q: float) -> np.ndarray:
+    """
+    Calculates the q-quantile of every group with the same linear interpolation used by
+    np.quantile, so the results are identical to calling it group by group.
+
+    Parameters:
+    sorted_values (np.ndarray): Values sorted by group and value (see group_values).
+    offsets (np.ndarray): Group boundaries (see group_values).
+    q (float): Quantile to compute, between 0 and 1.
+
+    Returns:
+    np.ndarray: The q-quantile of each group, NaN for empty groups.
+    """
+    counts = np.diff(offsets)
+    result = np.full(len(counts), np.nan)
+    not_empty = counts > 0
+    n = counts[not_empty]
+    starts = offsets[:-1][not_empty]
+
+    virtual_index = (n - 1) * q
+    previous_index = np.floor(virtual_index).astype(np.int64)
+    next_index = np.minimum(previous_index + 1, n - 1)
+    gamma = virtual_index - previous_index
+
+    a = sorted_values[starts + previous_index]
+    b = sorted_values[starts + next_index]
+    diff_b_a = b - a
+    interpolation = a + diff_b_a * gamma
+    upper_half = gamma >= 0.5
+    interpolation[upper_half] = (b - diff_b_a * (1 - gamma))[upper_half]
+
+    result[not_empty] = interpolation
+    return result
+
+def segment_median(sorted_values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Calculates the median of every group, identical to np.median applied group by group.
+
+    Parameters:
+    sorted_values (np.ndarray): Values sorted by group and value (see group_values).
+    offsets (np.ndarray): Group boundaries (see group_values).
+
+    Returns:
+    np.ndarray: The median of each group, NaN for empty groups.
+    """
+    counts = np.diff(offsets)
+    result = np.full(len(counts), np.nan)
+    not_empty = counts > 0
+    n = counts[not_empty]
+    starts = offsets[:-1][not_empty]
+    low = sorted_values[starts + (n - 1) // 2]
+    high = sorted_values[starts + n // 2]
+    result[not_empty] = (low + high) / 2
+    return result
+
+def segment_ptp(sorted_values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Calculates the range (max - min) of every group.
+
+    Parameters:
+    sorted_values (np.ndarray): Values sorted by group and value (see group_values).
+    offsets (np.ndarray): Group boundaries (see group_values).
+
+    Returns:
+    np.ndarray: The range of each group, NaN for empty groups.
+    """
+    counts = np.diff(offsets)
+    result = np.full(len(counts), np.nan)
+    not_empty = counts > 0
+    result[not_empty] = sorted_values[offsets[1:][not_empty] - 1] - sorted_values[offsets[:-1][not_empty]]
+    return result
+
+def group_robust_stats(codes: np.ndarray, values: np.ndarray, n_groups: int) -> dict:
+    """
+    Calculates, in one vectorized pass, the robust statistics used to label atypical values
+    for every group: size, median, median absolute deviation, first and third quartile and range.
+
+    The median and the MAD match np.median and scipy.stats.median_abs_deviation (scale 1),
+    and the quartiles match np.quantile, so the labels are the same as computing them group by group.
+
+    Parameters:
+    codes (np.ndarray): Dense group code (0 .. n_groups - 1) of every value.
+    values (np.ndarray): Values to be summarized.
+    n_groups (int): Number of groups.
+
+    Returns:
+    dict: A dictionary of arrays of length n_groups with the keys
+        'n', 'median', 'mad', 'q1', 'q3' and 'ptp'.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    sorted_values, offsets = group_values(codes, values, n_groups)
+    median = segment_median(sorted_values, offsets)
+
+    deviations = np.abs(values - median[codes])
+    sorted_deviations, _ = group_values(codes, deviations, n_groups)
+
+    return {
+        'n': np.diff(offsets),
+        'median': median,
+        'mad': segment_median(sorted_deviations, offsets),
+        'q1': segment_quantile(sorted_values, offsets, 0.25),
+        'q3': segment_quantile(sorted_values, offsets, 0.75),
+        'ptp': segment_ptp(sorted_values, offsets)
+    }
+
+def segment_robust_stats(values: np.ndarray, offsets: np.ndarray) -> dict:
+    """
+    Calculates the statistics of group_robust_stats for values that are already stored group after group
+    (e.g. the histories of a SeriesIndex), in any order inside each group.
+
+    Parameters:
+    values (np.ndarray): Values of every group, one group after the other.
+    offsets (np.ndarray): Group boundaries, of length n_groups + 1.
+
+    Returns:
+    dict: The statistics of group_robust_stats.
+    """
+    return group_robust_stats(segment_codes(offsets), values, len(offsets) - 1)
+
+def segment_shapiro_normal(values: np.ndarray, offsets: np.ndarray, selected: np.ndarray) -> np.ndarray:
+    """
+    Decides, for the selected groups of values stored group after group, whether the Shapiro-Wilk test
+    does not reject normality (p-value > 0.05). Each test receives the values of its group in their stored order.
+
+    Parameters:
+    values (np.ndarray): Values of every group, one group after the other.
+    offsets (np.ndarray): Group boundaries, of length n_groups + 1.
+    selected (np.ndarray): Boolean array of length n_groups with the groups to test. They need at least 3 values.
+
+    Returns:
+    np.ndarray: Boolean array of length n_groups, True for the selected groups that look Gaussian.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    normal = np.zeros(len(offsets) - 1, dtype=bool)
+    for code in np.flatnonzero(selected):
+        normal[code] = stats.shapiro(values[offsets[code]:offsets[code + 1]])[1] > 0.05
+    return normal
+
+def group_shapiro_normal(codes: np.ndarray, values: np.ndarray, n_groups: int, selected: np.ndarray) -> np.ndarray:
+    """
+    Decides, for the selected groups, whether the Shapiro-Wilk test does not reject normality (p-value > 0.05).
+
+    The test receives the values of every group in the order they appear in `values`, the same input
+    it would get if the group was filtered from the original data.
+
+    Parameters:
+    codes (np.ndarray): Dense group code (0 .. n_groups - 1) of every value.
+    values (np.ndarray): Values in their original order.
+    n_groups (int): Number of groups.
+    selected (np.ndarray): Boolean array of length n_groups with the groups to test. They need at least 3 values.
+
+    Returns:
+    np.ndarray: Boolean array of length n_groups, True for the selected groups that look Gaussian.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(codes, kind='stable')
+    return segment_shapiro_normal(values[order], group_offsets(codes, n_groups), selected)
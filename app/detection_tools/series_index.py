@@ -0,0 +1,165 @@
+"""DETECTOR-DE-NOVEDADES/detection_tools/series_index.py"""
+import numpy as np
+from detection_tools.robust_stats import group_offsets
+
+class SeriesIndex:
+    """
+    Stored consumptions of a set of series in CSR layout: every (IdProceso, IdGrupo, IdDiaSemana) key has a
+    dense id, and the values of the series with id g are values[offsets[g]:offsets[g + 1]], in the order they
+    were observed. The values of all the series are a single float64 array, so an observation takes 8 bytes
+    and the statistics of many series are computed with segmented operations (see robust_stats).
+
+    Parameters:
+    keys (np.ndarray, optional): Array of shape (n_series, 3) with the key of every id.
+    values (np.ndarray, optional): Values of every series, one series after the other.
+    offsets (np.ndarray, optional): Boundaries of the series, of length n_series + 1.
+    """
+
+    def __init__(self, keys=None, values=None, offsets=None):
+        self.keys = np.empty((0, 3), dtype=np.int64) if keys is None else np.asarray(keys, dtype=np.int64).reshape(-1, 3)
+        self.values = np.empty(0, dtype=np.float64) if values is None else np.asarray(values, dtype=np.float64)
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64) if offsets is None else np.asarray(offsets, dtype=np.int64)
+        self._ids = {key: series_id for series_id, key in enumerate(map(tuple, self.keys.tolist()))}
+
+    @classmethod
+    def from_rows(cls, keys, values):
+        """
+        Builds the index from observations in the order they were stored.
+
+        Parameters:
+        keys (np.ndarray): Array of shape (n_values, 3) with the key of every value.
+        values (np.ndarray): The values.
+
+        Returns:
+        SeriesIndex: The index, with the ids in ascending order of the keys.
+        """
+        keys = np.asarray(keys, dtype=np.int64).reshape(-1, 3)
+        if len(keys) == 0:
+            return cls()
+        unique_keys, codes = np.unique(keys, axis=0, return_inverse=True)
+        codes = codes.reshape(-1)
+        order = np.argsort(codes, kind='stable')
+        return cls(unique_keys, np.asarray(values, dtype=np.float64)[order], group_offsets(codes, len(unique_keys)))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return tuple(int(value) for value in key) in self._ids
+
+    def sizes(self):
+        """
+        Returns:
+            np.ndarray: The number of values of every series.
+        """
+        return np.diff(self.offsets)
+
+    def ids(self, keys):
+        """
+        Finds the ids of some keys.
+
+        Parameters:
+        keys (np.ndarray): Array of shape (n, 3) with the keys.
+
+        Returns:
+        np.ndarray: The id of every key, -1 for the keys that are not in the index.
+        """
+        keys = np.asarray(keys, dtype=np.int64).reshape(-1, 3)
+        return np.fromiter((self._ids.get(key, -1) for key in map(tuple, keys.tolist())), dtype=np.int64, count=len(keys))
+
+    def series(self, series_id):
+        """
+        Returns:
+            np.ndarray: A view of the values of a series, in the order they were observed.
+        """
+        return self.values[self.offsets[series_id]:self.offsets[series_id + 1]]
+
+    def gather(self, ids):
+        """
+        Copies the values of some series, one series after the other, in the order of the given ids.
+
+        Parameters:
+        ids (np.ndarray): Ids of the series.
+
+        Returns:
+        tuple: The values and the boundaries of the selected series (see SeriesIndex).
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = self.offsets[ids]
+        sizes = self.offsets[ids + 1] - starts
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        # Position of every selected value: the start of its series plus its rank inside it
+        positions = np.repeat(starts - offsets[:-1], sizes) + np.arange(offsets[-1])
+        return self.values[positions], offsets
+
+    def subset(self, keys):
+        """
+        Returns a new index with the series of the given keys that are in this one.
+
+        Parameters:
+        keys (np.ndarray): Array of shape (n, 3) with the keys.
+
+        Returns:
+        SeriesIndex: The index of the selected series.
+        """
+        ids = self.ids(keys)
+        ids = np.unique(ids[ids >= 0])
+        values, offsets = self.gather(ids)
+        return SeriesIndex(self.keys[ids], values, offsets)
+
+    def append(self, keys, values):
+        """
+        Adds new observations at the end of their series, creating the series that are not in the index.
+        The values are inserted at the end of the segment of each series and the offsets are rebuilt.
+
+        Parameters:
+        keys (np.ndarray): Array of shape (n, 3) with the key of every value.
+        values (np.ndarray): The values, in the order they were observed.
+
+        Returns:
+        np.ndarray: The id of every value.
+        """
+        keys = np.asarray(keys, dtype=np.int64).reshape(-1, 3)
+        values = np.asarray(values, dtype=np.float64)
+        ids = self.ids(keys)
+        n_series = len(self.keys)
+        new_keys = []
+        for row in np.flatnonzero(ids < 0):
+            key = tuple(keys[row].tolist())
+            if key not in self._ids:
+                self._ids[key] = len(self._ids)
+                new_keys.append(key)
+            ids[row] = self._ids[key]
+        if new_keys:
+            self.keys = np.concatenate([self.keys, np.array(new_keys, dtype=np.int64)])
+
+        # np.insert keeps the order of the values inserted at the same position, so the values are sorted
+        # by series first: the new series are appended at the end one after the other.
+        order = np.argsort(ids, kind='stable')
+        positions = np.where(ids < n_series, self.offsets[np.minimum(ids, n_series - 1) + 1], self.offsets[-1])[order]
+        self.values = np.insert(self.values, positions, values[order])
+        sizes = np.bincount(ids, minlength=len(self.keys))
+        sizes[:n_series] += np.diff(self.offsets)
+        self.offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.offsets[1:])
+        return ids
+
+    def merge(self, other):
+        """
+        Returns a new index with the series of both indexes. The series of other replace the ones of
+        this index with the same key.
+
+        Parameters:
+        other (SeriesIndex): The index with the new or updated series.
+
+        Returns:
+        SeriesIndex: The merged index, with the kept series of this index first.
+        """
+        kept = np.flatnonzero(other.ids(self.keys) < 0)
+        values, offsets = self.gather(kept)
+        return SeriesIndex(
+            np.concatenate([self.keys[kept], other.keys]),
+            np.concatenate([values, other.values]),
+            np.concatenate([offsets, offsets[-1] + other.offsets[1:]])
+        )
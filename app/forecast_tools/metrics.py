@@ -65,6 +65,9 @@ def mape(n: int, y_true: float, y_pred:float, last_metric: dict) -> float:
     float: The updated MAPE value.
     """
     """"""
+    if y_true == 0:
+        # The percentage error is undefined for a zero actual, it adds a zero term
+        return (n - 1) * last_metric / n
     return (n - 1) * last_metric / n + (100 / n) * abs((y_true - y_pred) / y_true)
 
 def smape(n: int, y_true: float, y_pred:float, last_metric: dict) -> float:
@@ -83,6 +86,9 @@ def smape(n: int, y_true: float, y_pred:float, last_metric: dict) -> float:
         float: The updated sMAPE value.
     """
     """"""
+    if abs(y_true) + abs(y_pred) == 0:
+        # A zero actual predicted as zero is a perfect prediction
+        return ((n - 1) / n) * last_metric
     return ((n - 1) / n) * last_metric + (200 / n) * (abs(y_true - y_pred) / (abs(y_true) + abs(y_pred)))
 
 def metrics(n: int, y_true: float, y_pred: float, last_metrics: dict) -> dict:
@@ -110,3 +116,178 @@ def metrics(n: int, y_true: float, y_pred: float, last_metrics: dict) -> dict:
         "MAPE": mape(n, y_true, y_pred, last_metrics["MAPE"]),
         "sMAPE": smape(n, y_true, y_pred, last_metrics["sMAPE"])
     }
+
+METRIC_NAMES = ["MAE", "MSE", "RMSE", "MAPE", "sMAPE"]
+
+def error_terms(y_true, y_pred) -> dict:
+    """
+    Calculate the term that every observation adds to each metric.
+
+    Zero actuals add a zero term to MAPE, and a zero actual predicted as zero adds a zero term to sMAPE,
+    the same as the scalar functions.
+
+    Args:
+        y_true (array-like): The actual values.
+        y_pred (array-like): The predicted values.
+
+    Returns:
+        dict: A dictionary of arrays with the keys "absolute", "squared", "percentage" and "symmetric".
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    absolute_error = np.abs(y_true - y_pred)
+    denominator = np.abs(y_true) + np.abs(y_pred)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage = np.where(y_true != 0, 100 * (absolute_error / np.abs(y_true)), 0.0)
+        symmetric = np.where(denominator != 0, 200 * (absolute_error / denominator), 0.0)
+    return {
+        "absolute": absolute_error,
+        "squared": (y_true - y_pred) ** 2,
+        "percentage": percentage,
+        "symmetric": symmetric
+    }
+
+def observation_counts(length: int, resets=None, initial_count: int = 0) -> np.ndarray:
+    """
+    Calculate the number of observations n of the running metrics at every position.
+
+    Args:
+        length (int): Number of observations.
+        resets (array-like, optional): Boolean array, True at the observations that restart the metrics.
+        initial_count (int, optional): Observations summarized by the metrics before the first one. Default is 0.
+
+    Returns:
+        np.ndarray: The value of n at every observation.
+    """
+    positions = np.arange(length)
+    if resets is None:
+        return positions + initial_count + 1
+    resets = np.asarray(resets, dtype=bool)
+    last_reset = np.maximum.accumulate(np.where(resets, positions, -1))
+    return np.where(last_reset >= 0, positions - last_reset + 1, positions + initial_count + 1)
+
+class MetricsAccumulator:
+    """
+    Running state of the forecasting metrics: the number of observations and the sums of the
+    absolute, squared, percentage and symmetric percentage errors. Adding an observation is an O(1)
+    update and the metrics are the sums divided by the count, the same values metrics() reaches
+    when it is fed one observation at a time. The state is stored with every row of
+    dbo.MetricasPredicciones, so calculate_metrics resumes from it.
+
+    Args:
+        count (int, optional): Number of observations. Default is 0.
+        sums (dict, optional): Sums of the error terms, with the keys of error_terms. Default is all zeros.
+    """
+
+    TERMS = ("absolute", "squared", "percentage", "symmetric")
+
+    def __init__(self, count: int = 0, sums: dict = None):
+        self.count = int(count)
+        self.sums = {term: float((sums or {}).get(term, 0.0)) for term in self.TERMS}
+
+    @classmethod
+    def from_metrics(cls, last_metrics: dict, count: int):
+        """
+        Build the accumulator summarized by a stored row of metrics.
+
+        Args:
+            last_metrics (dict): The stored metrics.
+            count (int): The number of observations of the stored metrics.
+
+        Returns:
+            MetricsAccumulator: The accumulator.
+        """
+        return cls(count, {
+            "absolute": last_metrics["MAE"] * count,
+            "squared": last_metrics["MSE"] * count,
+            "percentage": last_metrics["MAPE"] * count,
+            "symmetric": last_metrics["sMAPE"] * count
+        })
+
+    def update(self, y_true, y_pred):
+        """
+        Add one or many observations.
+
+        Args:
+            y_true (float or array-like): The actual values.
+            y_pred (float or array-like): The predicted values.
+
+        Returns:
+            MetricsAccumulator: The accumulator itself.
+        """
+        terms = error_terms(np.atleast_1d(y_true), np.atleast_1d(y_pred))
+        self.count += len(terms["absolute"])
+        for term in self.TERMS:
+            self.sums[term] += float(terms[term].sum())
+        return self
+
+    def running(self, y_true, y_pred, resets=None) -> dict:
+        """
+        Add a sequence of observations, restarting at the given ones, and calculate the state and the
+        metrics after every observation at once, with cumulative sums.
+
+        Args:
+            y_true (array-like): The actual values.
+            y_pred (array-like): The predicted values.
+            resets (array-like, optional): Boolean array, True at the observations that restart the metrics.
+
+        Returns:
+            dict: The arrays "count", "sums" (a dictionary with the keys of TERMS) and "metrics"
+            (a dictionary with the keys of METRIC_NAMES) at every observation.
+        """
+        terms = error_terms(y_true, y_pred)
+        length = len(terms["absolute"])
+        counts = observation_counts(length, resets, self.count)
+        resets = np.zeros(length, dtype=bool) if resets is None else np.asarray(resets, dtype=bool)
+        group_start = np.maximum.accumulate(np.where(resets, np.arange(length), 0))
+        # The current sums only carry over to the observations before the first restart
+        carried = np.cumsum(resets) == 0
+
+        sums = {}
+        for term in self.TERMS:
+            cumulative = np.cumsum(terms[term])
+            before_group = cumulative[group_start] - terms[term][group_start]
+            sums[term] = cumulative - before_group + np.where(carried, self.sums[term], 0.0)
+
+        if length:
+            self.count = int(counts[-1])
+            self.sums = {term: float(sums[term][-1]) for term in self.TERMS}
+        return {
+            "count": counts,
+            "sums": sums,
+            "metrics": {
+                "MAE": sums["absolute"] / counts,
+                "MSE": sums["squared"] / counts,
+                "RMSE": np.sqrt(sums["squared"] / counts),
+                "MAPE": sums["percentage"] / counts,
+                "sMAPE": sums["symmetric"] / counts
+            }
+        }
+
+    def reset(self):
+        """
+        Restart the metrics, e.g. at the beginning of a month.
+
+        Returns:
+            MetricsAccumulator: The accumulator itself.
+        """
+        self.count = 0
+        self.sums = dict.fromkeys(self.TERMS, 0.0)
+        return self
+
+    def metrics(self) -> dict:
+        """
+        Calculate the current metrics.
+
+        Returns:
+            dict: A dictionary with the keys "MAE", "MSE", "RMSE", "MAPE" and "sMAPE", all zero without observations.
+        """
+        if self.count == 0:
+            return dict.fromkeys(METRIC_NAMES, 0.0)
+        return {
+            "MAE": self.sums["absolute"] / self.count,
+            "MSE": self.sums["squared"] / self.count,
+            "RMSE": float(np.sqrt(self.sums["squared"] / self.count)),
+            "MAPE": self.sums["percentage"] / self.count,
+            "sMAPE": self.sums["symmetric"] / self.count
+        }
@@ -0,0 +1,141 @@
+"""DETECTOR-DE-NOVEDADES/forecast_tools/model_store.py"""
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+from prophet import Prophet
+from prophet.serialize import model_from_json, model_to_json
+from monitoring_tools.instrumentation import log_progress
+
+def model_store_path():
+    """
+    Returns the directory of the fitted models: MODEL_STORE_PATH, or the 'modelos' folder of the
+    persistent volume PATH_HOSTPATH. None disables the store.
+
+    Returns:
+    str: The directory, or None.
+    """
+    path = os.getenv('MODEL_STORE_PATH')
+    if not path and os.getenv('PATH_HOSTPATH'):
+        path = os.path.join(os.getenv('PATH_HOSTPATH'), 'modelos')
+    return path or None
+
+def _model_file(store_path: str, key) -> str:
+    name = '_'.join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+    return os.path.join(store_path, f"{name}.json")
+
+def history_hash(history: pd.DataFrame, country: str) -> str:
+    """
+    Calculates the hash of the input of a fit: the dates and values of the history and the holidays country.
+
+    Parameters:
+    history (pd.DataFrame): History with the columns 'ds' and 'y'.
+    country (str): Country whose holidays are added to the model.
+
+    Returns:
+    str: The hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256(country.encode())
+    digest.update(pd.to_datetime(history['ds']).to_numpy(dtype='datetime64[ns]').tobytes())
+    digest.update(history['y'].to_numpy(dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def load_model(key):
+    """
+    Loads the last fitted model of a series from the store.
+
+    Parameters:
+    key: Key of the series, e.g. 'Total' or ('Grupo', 3).
+
+    Returns:
+    tuple: The model (Prophet) and its metadata (dict with 'hash' and 'watermark'), or (None, None).
+    """
+    store_path = model_store_path()
+    if store_path is None or not os.path.exists(_model_file(store_path, key)):
+        return None, None
+    try:
+        with open(_model_file(store_path, key), encoding='utf-8') as file:
+            stored = json.load(file)
+        return model_from_json(stored['model']), {'hash': stored['hash'], 'watermark': stored['watermark']}
+    except (OSError, ValueError, KeyError) as e:
+        log_progress(f"The stored model of {key} could not be read: {e}", logging.WARNING)
+        return None, None
+
+def save_model(key, model: Prophet, input_hash: str, watermark: str):
+    """
+    Saves a fitted model in the store, replacing the previous one of the series.
+
+    Parameters:
+    key: Key of the series.
+    model (Prophet): The fitted model.
+    input_hash (str): Hash of the input of the fit (see history_hash).
+    watermark (str): Last date of the history the model was fitted with.
+    """
+    store_path = model_store_path()
+    if store_path is None:
+        return
+    os.makedirs(store_path, exist_ok=True)
+    file_name = _model_file(store_path, key)
+    with open(f"{file_name}.tmp", 'w', encoding='utf-8') as file:
+        json.dump({'hash': input_hash, 'watermark': watermark, 'model': model_to_json(model)}, file)
+    os.replace(f"{file_name}.tmp", file_name)
+
+def warm_start_params(model: Prophet) -> dict:
+    """
+    Extracts the fitted parameters of a model to initialize the next fit.
+
+    Parameters:
+    model (Prophet): The fitted model.
+
+    Returns:
+    dict: The initial values of k, m, sigma_obs, delta and beta.
+    """
+    params = {}
+    for name in ['k', 'm', 'sigma_obs']:
+        params[name] = model.params[name][0][0] if model.mcmc_samples == 0 else np.mean(model.params[name])
+    for name in ['delta', 'beta']:
+        params[name] = model.params[name][0] if model.mcmc_samples == 0 else np.mean(model.params[name], axis=0)
+    return params
+
+def fit_prophet(key, history: pd.DataFrame, country: str = 'CO') -> Prophet:
+    """
+    Returns a Prophet model fitted to the history of a series, reusing the model store:
+    - If the stored model was fitted with the same input, it is returned without refitting.
+    - Otherwise the new fit is initialized with the parameters of the stored model (warm start),
+      falling back to a cold fit if they do not match the new model.
+    The fitted model is saved for the next run.
+
+    Parameters:
+    key: Key of the series, e.g. 'Total' or ('Grupo', 3).
+    history (pd.DataFrame): History with the columns 'ds' and 'y', sorted by 'ds'.
+    country (str): Country whose holidays are added to the model. Default is 'CO'.
+
+    Returns:
+    Prophet: The fitted model.
+    """
+    input_hash = history_hash(history, country)
+    stored_model, metadata = load_model(key)
+    if stored_model is not None and metadata['hash'] == input_hash:
+        log_progress(f"The input of {key} did not change. Reusing the stored model.")
+        return stored_model
+
+    model = Prophet()
+    model.add_country_holidays(country_name=country)
+    if stored_model is None:
+        model.fit(history)
+    else:
+        try:
+            model.fit(history, init=warm_start_params(stored_model))
+        except Exception as e:
+            log_progress(f"The warm start of {key} failed ({e}). Fitting from scratch.", logging.WARNING)
+            model = Prophet()
+            model.add_country_holidays(country_name=country)
+            model.fit(history)
+
+    try:
+        save_model(key, model, input_hash, str(pd.Timestamp(history['ds'].iloc[-1]).date()))
+    except OSError as e:
+        log_progress(f"The model of {key} could not be stored: {e}", logging.WARNING)
+    return model
@@ -0,0 +1,104 @@
+"""DETECTOR-DE-NOVEDADES/forecast_tools/series_forecasting.py"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from prophet import Prophet
+from threadpoolctl import threadpool_limits
+from forecast_tools.model_store import fit_prophet
+
+# Environment variables read by the BLAS/OpenMP runtimes when they start
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+def limit_worker_threads(blas_threads: int):
+    """
+    Limits the BLAS/OpenMP threads of a worker process, so the workers do not oversubscribe the CPUs.
+    It is used as the initializer of the process pool.
+
+    Parameters:
+    blas_threads (int): Maximum number of threads of each native thread pool in the worker.
+    """
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = str(blas_threads)
+    threadpool_limits(limits=blas_threads)
+
+def fit_and_predict(history: pd.DataFrame, future_dates: pd.DataFrame, country: str = 'CO', key=None) -> pd.DataFrame:
+    """
+    Fits a Prophet model to the history of one series and predicts the given dates.
+    As in the forecast of the total consumption, the first predicted date takes the last known value.
+
+    Parameters:
+    history (pd.DataFrame): Daily history of the series with the columns 'ds' and 'y', sorted by 'ds'.
+    future_dates (pd.DataFrame): Dates to predict, in the column 'ds'.
+    country (str): Country whose holidays are added to the model. Default is 'CO'.
+    key (optional): Key of the series in the model store (see model_store.fit_prophet).
+    If None, the model is fitted from scratch and not stored. Default is None.
+
+    Returns:
+    pd.DataFrame: The predictions with the columns 'Fecha', 'Prediccion', 'LimInf' and 'LimSup'.
+    """
+    if key is None:
+        model = Prophet()
+        model.add_country_holidays(country_name=country)
+        model.fit(history)
+    else:
+        model = fit_prophet(key, history, country)
+
+    forecast = model.predict(future_dates[['ds']])
+    forecast = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].rename(
+        columns={'ds': 'Fecha', 'yhat': 'Prediccion', 'yhat_lower': 'LimInf', 'yhat_upper': 'LimSup'}
+    )
+    last_value = history['y'].iloc[-1]
+    forecast.loc[0, ['Prediccion', 'LimInf', 'LimSup']] = last_value
+    return forecast
+
+def _forecast_one(key, history: pd.DataFrame, future_dates: pd.DataFrame):
+    """
+    Runs fit_and_predict in a worker and returns the error instead of raising it,
+    so a failing series does not stop the others.
+    """
+    try:
+        return key, fit_and_predict(history, future_dates, key=key), None
+    except Exception as e:
+        return key, None, f"{type(e).__name__}: {e}"
+
+def forecast_series(series: dict, future_dates: pd.DataFrame, workers: int = None, blas_threads: int = 1):
+    """
+    Forecasts many series in parallel, one Prophet fit per series, over a pool of processes.
+
+    Parameters:
+    series (dict): A dictionary mapping the key of each series to its history (see fit_and_predict).
+    future_dates (pd.DataFrame): Dates to predict, in the column 'ds'.
+    workers (int, optional): Number of worker processes. Default is the number of CPUs.
+    blas_threads (int, optional): BLAS/OpenMP threads of each worker. Default is 1.
+
+    Returns:
+    tuple: A tuple containing:
+        - forecasts (dict): The predictions of every series that was forecast (see fit_and_predict).
+        - failures (dict): The error message of every series that failed.
+    """
+    forecasts = {}
+    failures = {}
+    if not series:
+        return forecasts, failures
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(series)))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=limit_worker_threads,
+        initargs=(blas_threads,)
+    ) as executor:
+        futures = {
+            executor.submit(_forecast_one, key, history, future_dates): key
+            for key, history in series.items()
+        }
+        for future in as_completed(futures):
+            try:
+                key, forecast, error = future.result()
+            except Exception as e:
+                # The worker died (e.g. out of memory) before returning
+                key, forecast, error = futures[future], None, f"{type(e).__name__}: {e}"
+            if error is None:
+                forecasts[key] = forecast
+            else:
+                failures[key] = error
+    return forecasts, failures
@@ -1,67 +1,177 @@
 """DETECTOR-DE-NOVEDADES/main.py"""
+import logging
+import os
 import time
 from dotenv import load_dotenv
-from main_functions.forecasting import predictions_orchestrator
-from main_functions.novelty_detection import detect_atypical_values
-from main_functions.inserting_data import (
-    check_tables_exist,
-    fetch_new_data,
-    update_database
-)
-from database_tools.connections import (
-    connect_to_insert_data,
-    connect_to_fetch_data,
-    connect_to_insert_forecasting_data
-)
+from main_functions.new_data_check import has_new_data
+from database_tools.connections import EXTRACTION, INSERTION, ConnectionManager
+from monitoring_tools.instrumentation import configure_logging, log_progress, stage, start_run
 
 load_dotenv()
 
+def update_consumption_data(conn_insert, conn_fetch, manager=None):
+    """
+    Fetches the new data, stores it and labels its atypical values.
+
+    When EXTRACTION_CHUNK_ROWS is set, the source view is read in date ordered chunks of that many rows
+    and every chunk is stored and labeled while the next ones are read in a background thread, up to
+    EXTRACTION_PREFETCH_CHUNKS chunks ahead (default 2, 0 reads each chunk only when it is needed).
+    The statistics of the initial load are computed per segment (see SEGMENT_DATE_RANGES), so its chunks are
+    reduced to the numeric columns and every segment is labeled and inserted as soon as the stream, ordered
+    by date, moves past it. Only the rows of one segment are held at a time. The processes with a single row,
+    which are labeled together across segments, are found beforehand with an aggregate query.
+
+    With a manager and a backend that writes to several tables at once, the Procesos, Grupos and Fechas
+    tables of every batch are updated concurrently on three extra pooled connections.
+
+    Args:
+        conn_insert: A connection object to the database for inserting data.
+        conn_fetch: A connection object to the database for fetching data.
+        manager (ConnectionManager, optional): Lends the connections of the concurrent dimension updates.
+
+    Returns:
+        bool: True if there was new data to update.
+    """
+    # Imported here so the runs without new data do not load pandas and scipy
+    import pandas as pd
+    from contextlib import ExitStack, closing
+    from database_tools.backends import backend_for, rows_exist
+    from database_tools.update_tables import INDEPENDENT_DIMENSIONS
+    from main_functions.novelty_detection import detect_atypical_values, detect_initial_load_segment, segment_numbers
+    from main_functions.inserting_data import (
+        compact_new_data,
+        fetch_new_data,
+        fetch_new_data_chunks,
+        fetch_single_executions,
+        prefetch_chunks,
+        update_database
+    )
+
+    with ExitStack() as stack:
+        dimension_connections = None
+        if manager is not None and backend_for(conn_insert).concurrent_writes:
+            dimension_connections = [
+                stack.enter_context(manager.raw_connection(INSERTION)) for _ in INDEPENDENT_DIMENSIONS
+            ]
+
+        chunk_rows = int(os.getenv('EXTRACTION_CHUNK_ROWS') or 0)
+        if chunk_rows <= 0:
+            with stage('extraction') as record:
+                new_data = fetch_new_data(conn_insert, conn_fetch)
+                record.rows_out = len(new_data)
+            updated_data = update_database(conn_insert, new_data, dimension_connections)
+            if updated_data.empty:
+                return False
+            log_progress(detect_atypical_values(conn_insert, updated_data))
+            return True
+
+        initial_load = not rows_exist(conn_insert.cursor(), 'FROM dbo.ConsumosMIPS')
+        if initial_load:
+            with stage('fetch_single_executions') as record:
+                single_executions = fetch_single_executions(conn_insert, conn_fetch)
+                record.rows_out = len(single_executions)
+            single_names = set(single_executions['NombreProceso'])
+            single_values = single_executions['total_mipsFecha'].to_numpy(dtype=float)
+            single_processes = set()
+        # Rows of the segment of the initial load being read, and its number
+        segment_data = []
+        current_segment = None
+
+        def flush_segment():
+            if segment_data:
+                log_progress(detect_initial_load_segment(
+                    conn_insert, pd.concat(segment_data, ignore_index=True), single_processes, single_values
+                ))
+                segment_data.clear()
+
+        updated = False
+        chunks = fetch_new_data_chunks(conn_insert, conn_fetch, chunk_rows)
+        prefetch = int(os.getenv('EXTRACTION_PREFETCH_CHUNKS') or 2)
+        if prefetch > 0:
+            chunks = stack.enter_context(closing(prefetch_chunks(chunks, prefetch)))
+        while True:
+            # With the prefetch, this is the time spent waiting for the reader
+            with stage('extraction') as record:
+                new_data = next(chunks, None)
+                record.rows_out = 0 if new_data is None else len(new_data)
+            if new_data is None:
+                break
+            updated_data = update_database(conn_insert, new_data, dimension_connections)
+            if updated_data.empty:
+                continue
+            updated = True
+            if not initial_load:
+                log_progress(detect_atypical_values(conn_insert, updated_data))
+                continue
+            single_processes.update(updated_data.loc[updated_data['NombreProceso'].isin(single_names), 'IdProceso'])
+            compact_data = compact_new_data(updated_data)
+            segments = segment_numbers(compact_data['Fecha'])
+            for segment in sorted(set(segments.tolist())):
+                if segment != current_segment:
+                    flush_segment()
+                    current_segment = segment
+                segment_data.append(compact_data[segments == segment])
+        flush_segment()
+        return updated
+
 def main():
     """
     Main function to update consumption data and execute forecasting.
 
     This function performs the following steps:
-    1. Creates connections to the databases for inserting data, fetching data, and inserting forecasting data.
-    2. Updates the consumption data by checking if the necessary tables exist, fetching new data, and updating the database.
-    3. Executes the forecasting process using the updated data.
+    1. Borrows the connections to the databases for inserting data and fetching data from a ConnectionManager.
+    2. Checks whether the source has new dates, and exits early if it does not.
+    3. Updates the consumption data by checking if the necessary tables exist, fetching new data, and updating the database.
+    4. Borrows the connection for inserting forecasting data and executes the forecasting process using the updated data.
+
+    The modules of the data update and the forecasting (pandas, scipy, prophet) are only imported after step 2.
 
-    If a database or file error occurs, it catches the exception and prints an error message.
+    If a database or file error occurs, it catches the exception and logs a warning before retrying.
+    The progress messages are logged to the standard output (see monitoring_tools.instrumentation.configure_logging).
 
-    Finally, it ensures that all database connections are closed.
+    Finally, the connections are returned to the pool and the pool is closed. Every stage is measured in a
+    run report (wall time, rows, queries, fetched bytes and peak memory), which is written as JSON and as a
+    Prometheus textfile (see monitoring_tools.instrumentation.report_paths), also when the execution fails.
 
     Raises:
         pyodbc.DatabaseError: If a database error occurs.
         FileNotFoundError: If a file-related error occurs.
     """
-    while True:
-        try:
-            print("Updating Consumption Data...")
-            conn_insert = connect_to_insert_data()
-            conn_fetch = connect_to_fetch_data()
-            conn_insert_predictions = connect_to_insert_forecasting_data()
-            check_tables_exist(conn_insert)
-            new_data = fetch_new_data(conn_insert, conn_fetch)
-            updated_data = update_database(conn_insert, new_data)
-            print(detect_atypical_values(conn_insert, updated_data))
-            if updated_data.empty:
-                print("No new data to update")
-                break
-            print("")
-            print("Executing Forecasting...")
-            predictions_orchestrator(conn_insert, conn_insert_predictions)
-            print("Forecasting executed successfully")
-            break
-        except FileNotFoundError as e:
-            print(f"A database or file error occurred: {e}")
-            print("Retrying in 5 seconds...")
-            time.sleep(5)
-        finally:
-            try:
-                conn_insert.close()
-                conn_fetch.close()
-                conn_insert_predictions.close()
-            except NameError:
-                pass
+    configure_logging()
+    report = start_run()
+    status = 'failure'
+    try:
+        with ConnectionManager() as manager, stage('main'):
+            while True:
+                try:
+                    log_progress("Updating Consumption Data...")
+                    with manager.raw_connection(INSERTION) as conn_insert, manager.connection(EXTRACTION) as conn_fetch:
+                        with stage('new_data_check'):
+                            new_data = has_new_data(conn_insert, conn_fetch)
+                        if not new_data:
+                            log_progress("No new data to update")
+                            break
+                        from main_functions.inserting_data import check_tables_exist
+                        with stage('check_tables_exist'):
+                            check_tables_exist(conn_insert)
+                        with stage('update_consumption_data'):
+                            updated = update_consumption_data(conn_insert, conn_fetch, manager)
+                        if not updated:
+                            log_progress("No new data to update")
+                            break
+                        log_progress("Executing Forecasting...")
+                        from main_functions.forecasting import predictions_orchestrator
+                        with manager.connection(INSERTION) as conn_insert_predictions, stage('predictions_orchestrator'):
+                            predictions_orchestrator(conn_insert, conn_insert_predictions)
+                        log_progress("Forecasting executed successfully")
+                    break
+                except FileNotFoundError as e:
+                    log_progress(f"A database or file error occurred: {e}. Retrying in 5 seconds...", logging.WARNING)
+                    time.sleep(5)
+        status = 'success'
+    finally:
+        report.finish(status)
+        report.write()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,258 @@
+"""DETECTOR-DE-NOVEDADES/main_functions/backfill.py"""
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from database_tools.backends import backend_for, rows_exist
+from database_tools.bulk_load import CONSUMPTION_COLUMNS
+from database_tools.connections import EXTRACTION, INSERTION, ConnectionManager
+from database_tools.history_store import open_history_store
+from database_tools.id_allocator import allocate_ids
+from database_tools.stats_cache import SERIES_KEYS
+from monitoring_tools.instrumentation import configure_logging, fetched, log_progress, stage, start_run, with_stage_path
+from main_functions.inserting_data import SOURCE_COLUMNS, check_tables_exist, update_database
+from main_functions.novelty_detection import (
+    detect_atypical_values,
+    fetch_series_history,
+    insert_consumptions,
+    label_by_date,
+    prepare_series_stats,
+    series_sketch_capacity,
+    series_start_id_fecha,
+    store_series_stats
+)
+
+load_dotenv()
+
+def date_range_query(start_date, end_date):
+    """
+    Builds the query of the rows of the source view between two dates, both included.
+
+    Args:
+        start_date (datetime-like): First date.
+        end_date (datetime-like): Last date.
+
+    Returns:
+        str: The SELECT statement.
+    """
+    start_date = pd.Timestamp(start_date).strftime('%Y-%m-%d')
+    end_date = pd.Timestamp(end_date).strftime('%Y-%m-%d')
+    return f"""SELECT {', '.join(SOURCE_COLUMNS)} FROM dbo.refrescarprocesos_10dias WHERE Fecha >= '{start_date}' AND Fecha <= '{end_date}';"""
+
+def delete_date_range(conn_insert, start_date, end_date):
+    """
+    Deletes the stored consumptions between two dates, both included, so they are inserted and labeled again.
+    The series statistics become outdated and are rebuilt by the next load.
+
+    Args:
+        conn_insert: A connection object to the database for inserting data.
+        start_date (datetime-like): First date.
+        end_date (datetime-like): Last date.
+
+    Returns:
+        int: The number of deleted rows.
+    """
+    cursor = conn_insert.cursor()
+    cursor.execute("""
+        DELETE FROM dbo.ConsumosMIPS
+        WHERE IdFecha IN (SELECT IdFecha FROM dbo.Fechas WHERE Fecha >= ? AND Fecha <= ?);
+    """, (pd.Timestamp(start_date).strftime('%Y-%m-%d'), pd.Timestamp(end_date).strftime('%Y-%m-%d')))
+    deleted = cursor.rowcount
+    conn_insert.commit()
+    return deleted
+
+def partition_series(df, partitions):
+    """
+    Splits the rows into partitions by series (IdProceso, IdGrupo, IdDiaSemana), so every series, with
+    all its dates, is in exactly one partition. The series are assigned from the largest to the smallest
+    to the partition with the fewest rows, which keeps the partitions about the same size.
+
+    Args:
+        df (pd.DataFrame): The rows, with the columns 'IdProceso', 'IdGrupo' and 'IdDiaSemana'.
+        partitions (int): Maximum number of partitions.
+
+    Returns:
+        list of pd.DataFrame: The partitions that received rows.
+    """
+    codes = df.groupby(SERIES_KEYS, sort=True).ngroup().to_numpy()
+    sizes = np.bincount(codes)
+    assignment = np.empty(len(sizes), dtype=np.int64)
+    loads = np.zeros(max(1, min(partitions, len(sizes))), dtype=np.int64)
+    for code in np.argsort(-sizes, kind='stable'):
+        partition = int(loads.argmin())
+        assignment[code] = partition
+        loads[partition] += sizes[code]
+    row_partitions = assignment[codes]
+    return [df[row_partitions == partition] for partition in range(len(loads))]
+
+def label_partition(conn, df, series_stats, history, start_id_fecha, sketch_capacity=None, insert=True, store=None):
+    """
+    Labels the rows of one partition date by date, with the statistics and history of its series only,
+    and inserts them in a single bulk load on the given connection.
+
+    Args:
+        conn: The connection of the partition, used to read its history and to insert its rows.
+        df (pd.DataFrame): The rows of the partition, with the columns of dbo.ConsumosMIPS.
+        series_stats (pd.DataFrame): Statistics of every series.
+        history (SeriesIndex): Stored consumptions of the series of the partition, or None to read them with conn.
+        start_id_fecha (int): First IdFecha taken into account by the statistics.
+        sketch_capacity (int, optional): Capacity of the quantile sketches. Default is None.
+        insert (bool, optional): Whether to insert the labeled rows. Default is True.
+        store (HistoryStore, optional): History store the history is read from.
+
+    Returns:
+        tuple: The labeled rows, the refreshed statistics of the series of the partition and the
+        counters of label_with_series_stats.
+    """
+    with stage('label_partition', rows_in=len(df)) as record:
+        keys = pd.MultiIndex.from_frame(df[SERIES_KEYS].drop_duplicates().astype(np.int64))
+        series_stats = series_stats[series_stats.index.isin(keys)]
+        if history is None:
+            history = fetch_series_history(conn.cursor(), df, series_stats, start_id_fecha, sketch_capacity, store)
+            # Ends the read transaction, so the partition holds no locks while it labels
+            conn.commit()
+
+        labeled = []
+        series_stats, updated_keys, counters = label_by_date(
+            df, series_stats, history, sketch_capacity, labeled.append, progress=False
+        )
+        labeled = pd.concat(labeled)
+        if insert:
+            insert_consumptions(conn, labeled)
+        record.rows_out = len(labeled)
+    return labeled, series_stats.loc[list(updated_keys)], counters
+
+def backfill_atypical_values(conn_insert, df, manager=None, workers=None):
+    """
+    Labels and inserts the rows of a date range with the rules of the incremental load, partitioned by
+    series instead of by date. Every series depends only on its own history, so each partition walks its
+    dates in order on its own and the labels are the same as with detect_atypical_values.
+
+    The partitions run on a pool of worker threads, each with its own pooled connection of the manager,
+    which reads the history of its series and, when the backend writes from several connections at once,
+    inserts its rows. Otherwise the rows of all the partitions are inserted at the end on conn_insert.
+    The IDs are allocated up front in the order of detect_atypical_values, and the series statistics are
+    saved once every partition is stored. If a partition fails, the rows already inserted are kept and the
+    statistics are rebuilt by the next load.
+
+    An initial load (empty dbo.ConsumosMIPS) is labeled by detect_atypical_values.
+
+    Args:
+        conn_insert: A connection object to the database for inserting data.
+        df (pd.DataFrame): The rows returned by update_database.
+        manager (ConnectionManager, optional): Lends the connections of the workers. Without it, the
+            partitions are labeled one after the other on conn_insert.
+        workers (int, optional): Number of partitions and workers. Default is BACKFILL_WORKERS or 4.
+
+    Returns:
+        str: A message indicating the result of the operation.
+    """
+    if df.empty:
+        return df
+
+    cursor = conn_insert.cursor()
+    if not rows_exist(cursor, 'FROM dbo.ConsumosMIPS'):
+        return detect_atypical_values(conn_insert, df)
+
+    workers = int(workers or os.getenv('BACKFILL_WORKERS') or 4)
+    with stage('backfill_atypical_values', rows_in=len(df)) as record:
+        df = df.rename(columns={'total_mipsFecha': 'ConsumoMIPS', 'total_ejecucionesFecha': 'Ejecuciones'})
+        df = df.sort_values(by=['Fecha', 'IdProceso'], ascending=[True, True])
+        df['IdAtipico'] = 0
+        df['IdConsumo'] = list(allocate_ids(cursor, 'dbo.consumos_seq', len(df)))
+        conn_insert.commit()
+        df = df[[name for name, _ in CONSUMPTION_COLUMNS]]
+
+        start_id_fecha = series_start_id_fecha(cursor)
+        sketch_capacity = series_sketch_capacity()
+        # Reconciled here, before the partitions insert and append their rows
+        store = open_history_store(cursor)
+        series_stats, history = prepare_series_stats(conn_insert, start_id_fecha, sketch_capacity, store)
+
+        partitions = partition_series(df, workers)
+        concurrent = manager is not None and len(partitions) > 1
+        insert = not concurrent or backend_for(conn_insert).concurrent_writes
+        log_progress(f"Backfilling {len(df)} rows of {df['IdFecha'].nunique()} dates in {len(partitions)} partitions.")
+
+        def run_partition(partition):
+            partition_history = None
+            if history is not None:
+                partition_history = history.subset(partition[SERIES_KEYS].drop_duplicates().to_numpy(dtype=np.int64))
+            connection = manager.raw_connection(INSERTION) if concurrent else nullcontext(conn_insert)
+            with connection as conn:
+                return label_partition(
+                    conn, partition, series_stats, partition_history, start_id_fecha, sketch_capacity, insert, store
+                )
+
+        if concurrent:
+            with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+                futures = [executor.submit(with_stage_path(run_partition), partition) for partition in partitions]
+                results = [future.result() for future in futures]
+        else:
+            results = [run_partition(partition) for partition in partitions]
+
+        if not insert:
+            insert_consumptions(conn_insert, pd.concat([result[0] for result in results]).sort_values('IdConsumo'))
+
+        refreshed = pd.concat([result[1] for result in results])
+        series_stats = pd.concat([series_stats.drop(refreshed.index, errors='ignore'), refreshed])
+        store_series_stats(conn_insert, series_stats, set(refreshed.index), start_id_fecha, sketch_capacity)
+        t, m, ma, n = np.sum([result[2] for result in results], axis=0)
+        record.rows_out = len(df)
+
+    return f'Data backfilled successfully. {t + m + ma + n} processes were labeled. {m} using the MAD method, {ma} using the MAD Adjusted, and {n} processes were labeled using the IQR method.'
+
+def backfill(start_date, end_date, workers=None, replace=False):
+    """
+    Backfills a range of dates from the source view: the dates that are missing in dbo.ConsumosMIPS are
+    stored and labeled, partitioned by series over a pool of workers (see backfill_atypical_values).
+    With replace, the stored consumptions of the range are deleted first, so a corrected range is
+    ingested again. The forecasts are not updated; the next run of main.py does it.
+
+    Args:
+        start_date (datetime-like): First date of the range.
+        end_date (datetime-like): Last date of the range.
+        workers (int, optional): Number of partitions and workers. Default is BACKFILL_WORKERS or 4.
+        replace (bool, optional): Whether to delete the stored consumptions of the range first. Default is False.
+    """
+    report = start_run()
+    status = 'failure'
+    try:
+        with ConnectionManager() as manager, stage('backfill'):
+            with manager.raw_connection(INSERTION) as conn_insert, manager.connection(EXTRACTION) as conn_fetch:
+                with stage('check_tables_exist'):
+                    check_tables_exist(conn_insert)
+                log_progress(f"Fetching the data from {start_date} to {end_date}...")
+                with stage('extraction') as record:
+                    new_data = fetched(pd.read_sql(date_range_query(start_date, end_date), conn_fetch))
+                    record.rows_out = len(new_data)
+                if new_data.empty:
+                    log_progress("The source has no data in the range.")
+                else:
+                    if replace:
+                        log_progress(f"{delete_date_range(conn_insert, start_date, end_date)} stored consumptions of the range were deleted.")
+                    updated_data = update_database(conn_insert, new_data)
+                    if updated_data.empty:
+                        log_progress("The range is already stored.")
+                    else:
+                        log_progress(backfill_atypical_values(conn_insert, updated_data, manager, workers))
+        status = 'success'
+    finally:
+        report.finish(status)
+        report.write()
+
+def main():
+    parser = argparse.ArgumentParser(description='Stores and labels a range of dates of the source view.')
+    parser.add_argument('start_date', help='First date of the range, YYYY-MM-DD.')
+    parser.add_argument('end_date', help='Last date of the range, YYYY-MM-DD.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of partitions and workers. Default is BACKFILL_WORKERS or 4.')
+    parser.add_argument('--replace', action='store_true', help='Delete the stored consumptions of the range first.')
+    args = parser.parse_args()
+    configure_logging()
+    backfill(args.start_date, args.end_date, args.workers, args.replace)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,23 @@
 "DETECTOR-DE-NOVEDADES/main_functions/forecasting.py"
+import logging
+import os
+import numpy as np
 import pandas as pd
-from prophet import Prophet
 from sqlalchemy.exc import OperationalError, PendingRollbackError
-from forecast_tools.metrics import metrics
-from database_tools.connections import connect_to_insert_forecasting_data, connect_to_insert_data
+from forecast_tools.metrics import METRIC_NAMES, MetricsAccumulator
+from forecast_tools.model_store import fit_prophet
+from forecast_tools.series_forecasting import forecast_series
+from database_tools.backends import backend_for
+from database_tools.connections import INSERTION, ConnectionManager, bulk_cursor
+from database_tools.history_store import open_history_store
 from database_tools.update_tables import add_day_of_week_id
+from database_tools.id_allocator import allocate_ids, restart_sequence
+from database_tools.staging import dataframe_rows
+from monitoring_tools.instrumentation import configure_logging, fetched, log_progress, stage, start_run
 
+# Columns of dbo.MetricasPredicciones with the state of the MetricsAccumulator of every row: the number
+# of observations and the sums of the terms of MetricsAccumulator.TERMS
+STATE_COLUMNS = ['Observaciones', 'SumaErrorAbsoluto', 'SumaErrorCuadratico', 'SumaErrorPorcentual', 'SumaErrorPorcentualSimetrico']
 
 def parameters(conn):
     """
@@ -26,7 +38,7 @@ def parameters(conn):
             - min_id_fecha (int): The minimum `IdFecha` from `dbo.PrediccionesMIPS`.
             - max_id_fecha (int): The maximum `IdFecha` from `dbo.ConsumosMIPS`.
     """
-    print("Finding Parameters...")
+    log_progress("Finding Parameters...")
     cursor = conn.cursor()
 
     #Fetching count of predictions from dbo.PrediccionesMIPS
@@ -43,20 +55,21 @@ def parameters(conn):
 
     return predictions_count, min_id_fecha, max_id_fecha
 
-def forecast_and_insert(max_id_fecha, conn, engine):
+def forecast_and_insert(max_id_fecha, conn, engine, store=None):
     """
     Forecasts future values of ConsumoMIPS and inserts the predictions into the database.
     Parameters:
     max_id_fecha (int): The maximum IdFecha to consider for fetching historical data.
     conn (pyodbc.Connection): The database connection object.
     engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object for executing SQL queries.
+    store (HistoryStore, optional): History store the daily totals are computed from, instead of dbo.ConsumosMIPS.
     Returns:
     None
     This function performs the following steps:
     1. Fetches historical ConsumoMIPS data up to the specified max_id_fecha.
     2. Fetches corresponding dates for the historical data.
     3. Prepares the data for the Prophet forecasting model.
-    4. Fits the Prophet model to the historical data.
+    4. Fits the Prophet model to the historical data, warm-started from the stored model (see model_store).
     5. Fetches future dates for prediction.
     6. Predicts future ConsumoMIPS values using the fitted Prophet model.
     7. Adjusts the first row of the forecast to match the last known historical value.
@@ -64,54 +77,50 @@ def forecast_and_insert(max_id_fecha, conn, engine):
     9. Inserts the forecasted values into the database in bulk.
     10. Handles any exceptions that occur during the process and rolls back the transaction if necessary.
     """
-    print("Forecasting and Inserting...")
+    log_progress("Forecasting and Inserting...")
     cursor = conn.cursor()
     try:
-        cursor.execute("""ALTER SEQUENCE predicciones_seq
-                       RESTART WITH 1
-                       INCREMENT BY 1
-                       MINVALUE 1
-                       MAXVALUE 100000
-                       CYCLE;""")
-        print("Fetching data from ConsumosMIPS")
-        query = f"""
-            SELECT IdFecha, SUM(ConsumoMIPS) as ConsumoMIPS FROM dbo.ConsumosMIPS
-            WHERE IdFecha <= {max_id_fecha}
-            GROUP BY IdFecha;
-            """
-        data = pd.read_sql(query, engine)
-        print("data fetched successfully")
+        restart_sequence(cursor, 'predicciones_seq')
+        if store is not None:
+            log_progress("Reading data from the history store")
+            data = store.read(['IdFecha', 'ConsumoMIPS'], end_id_fecha=max_id_fecha)
+            data = data.groupby('IdFecha', as_index=False)['ConsumoMIPS'].sum()
+        else:
+            log_progress("Fetching data from ConsumosMIPS")
+            query = f"""
+                SELECT IdFecha, SUM(ConsumoMIPS) as ConsumoMIPS FROM dbo.ConsumosMIPS
+                WHERE IdFecha <= {max_id_fecha}
+                GROUP BY IdFecha;
+                """
+            data = fetched(pd.read_sql(query, engine))
+        log_progress("data fetched successfully")
         
         # Add the Fecha column to the data
         date_query = f"""
         SELECT IdFecha, Fecha FROM dbo.Fechas
         WHERE IdFecha <= {max_id_fecha};
         """
-        date_data = pd.read_sql(date_query, engine)
+        date_data = fetched(pd.read_sql(date_query, engine))
         data = data.merge(date_data, on='IdFecha', how='left')
         
         # Preparing the data for the Prophet model
         data['Fecha'] = pd.to_datetime(data['Fecha'], format='%Y-%m-%d')
         # Sort the data by IdFecha in ascending order
         data = data.sort_values(by='IdFecha')
-        print(data.tail())
         prophet_df = data[['Fecha', 'ConsumoMIPS']].rename(columns={'Fecha': 'ds', 'ConsumoMIPS': 'y'})
-        print(prophet_df)
         
-        # Fitting the Prophet model
-        model = Prophet()
-        model.add_country_holidays(country_name='CO')
-        model.fit(prophet_df)
+        # Fitting the Prophet model, reusing the stored model when the history did not change
+        model = fit_prophet('Total', prophet_df, country='CO')
 
         # Predicting the future values
         future_dates_query = f"""
         SELECT IdFecha, Fecha as ds FROM dbo.Fechas
         WHERE IdFecha >= {max_id_fecha};
         """
-        future_dates = pd.read_sql(future_dates_query, engine)
+        future_dates = fetched(pd.read_sql(future_dates_query, engine))
 
         # Predicting the future values
-        print("Forecasting")
+        log_progress("Forecasting")
         forecast = model.predict(future_dates)
         forecast = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
         forecast = forecast.rename(columns={'ds': 'Fecha', 'yhat': 'Prediccion', 'yhat_lower': 'LimInf', 'yhat_upper': 'LimSup'})
@@ -127,14 +136,13 @@ def forecast_and_insert(max_id_fecha, conn, engine):
         future_dates = add_day_of_week_id(future_dates)
         forecast = forecast.merge(future_dates, on='Fecha', how='left')
         
-        # Add IdPrediccion column using the sequence predicciones_seq
-        forecast['IdPrediccion'] = [cursor.execute("SELECT NEXT VALUE FOR predicciones_seq").fetchone()[0] for _ in range(len(forecast))]
+        # Add IdPrediccion column reserving a block of the sequence predicciones_seq
+        forecast['IdPrediccion'] = list(allocate_ids(cursor, 'dbo.predicciones_seq', len(forecast)))
 
         # Reorder the columns to match the table structure
         forecast = forecast[['IdPrediccion', 'IdFecha', 'IdDiaSemana', 'Prediccion', 'LimInf', 'LimSup']]
-        print(forecast.head())  
         # Inserting forecast into the database in bulk
-        print("Inserting forecast into the database")
+        log_progress("Inserting forecast into the database")
         forecast_to_insert = [
             (
                 int(row['IdPrediccion']),
@@ -146,21 +154,22 @@ def forecast_and_insert(max_id_fecha, conn, engine):
             )
             for _, row in forecast.iterrows()
         ]
-        cursor.executemany("""
-            INSERT INTO dbo.PrediccionesMIPS (IdPrediccion, IdFecha, IdDiaSemana, Prediccion, LimInf, LimSup)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, forecast_to_insert)
+        with bulk_cursor(conn) as insert_cursor:
+            insert_cursor.executemany("""
+                INSERT INTO dbo.PrediccionesMIPS (IdPrediccion, IdFecha, IdDiaSemana, Prediccion, LimInf, LimSup)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, forecast_to_insert)
         conn.commit()
-        print("Forecast inserted successfully")
+        log_progress("Forecast inserted successfully")
 
     except OperationalError as e:
-        print(f"OperationalError: {e}")
+        log_progress(f"OperationalError: {e}", logging.ERROR)
         conn.rollback()
     except PendingRollbackError as e:
-        print(f"PendingRollbackError: {e}")
+        log_progress(f"PendingRollbackError: {e}", logging.ERROR)
         conn.rollback()
     except Exception as e:
-        print(f"Error in forecast_and_insert: {e}")
+        log_progress(f"Error in forecast_and_insert: {e}", logging.ERROR)
         conn.rollback()
 
     return
@@ -171,6 +180,12 @@ def calculate_metrics(min_id_fecha, max_id_fecha, conn):
     This function calculates metrics such as MAE, MSE, RMSE, MAPE, and sMAPE for a range of dates
     and inserts them into the MetricasPredicciones table in the database. It handles both the cases
     where the table is initially empty and where it already contains data.
+
+    The daily actuals and predictions of the whole range are fetched in one query, the running
+    metrics are computed with cumulative sums (category 0 restarts every month, category 1 never
+    restarts) and all the rows are written with one bulk insert. Every row stores the state of its
+    MetricsAccumulator (the number of observations and the error sums) and the next run resumes from
+    the state of the rows of min_id_fecha.
     Parameters:
     min_id_fecha (int): The minimum IdFecha value to start calculating metrics from.
     max_id_fecha (int): The maximum IdFecha value to calculate metrics up to.
@@ -178,236 +193,249 @@ def calculate_metrics(min_id_fecha, max_id_fecha, conn):
     Returns:
     None
     """
-    print("Calculating Metrics...")
+    log_progress("Calculating Metrics...")
     cursor = conn.cursor()
 
     # Check if the MetricasPredicciones table is empty
-    cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) AS count FROM dbo.MetricasPredicciones;")
     metrics_count = cursor.fetchone()[0]
 
+    # Fetch the month, day, y_true and y_pred of every date, including min_id_fecha to detect a month change
+    cursor.execute("""
+        SELECT f.IdFecha, f.Fecha, c.ConsumoMIPS, p.Prediccion
+        FROM dbo.Fechas f
+        LEFT JOIN (
+            SELECT IdFecha, SUM(ConsumoMIPS) AS ConsumoMIPS FROM dbo.ConsumosMIPS
+            WHERE IdFecha BETWEEN ? AND ? GROUP BY IdFecha
+        ) c ON c.IdFecha = f.IdFecha
+        LEFT JOIN (
+            SELECT IdFecha, SUM(Prediccion) AS Prediccion FROM dbo.PrediccionesMIPS
+            WHERE IdFecha BETWEEN ? AND ? GROUP BY IdFecha
+        ) p ON p.IdFecha = f.IdFecha
+        WHERE f.IdFecha BETWEEN ? AND ?
+        ORDER BY f.IdFecha;
+    """, (min_id_fecha, max_id_fecha, min_id_fecha, max_id_fecha, min_id_fecha, max_id_fecha))
+    daily = pd.DataFrame(
+        [tuple(row) for row in cursor.fetchall()],
+        columns=['IdFecha', 'Fecha', 'ConsumoMIPS', 'Prediccion']
+    )
+    fechas = pd.to_datetime(daily['Fecha'])
+    daily['Mes'] = fechas.dt.month
+    daily['Dia'] = fechas.dt.day
+    daily['CambioMes'] = daily['Mes'].ne(daily['Mes'].shift())
+    min_id_fecha_day = daily.loc[daily['IdFecha'] == min_id_fecha, 'Dia']
+    daily = daily[daily['IdFecha'] > min_id_fecha]
+
+    missing = daily['ConsumoMIPS'].isna() | daily['Prediccion'].isna()
+    if missing.any():
+        log_progress(f"{int(missing.sum())} date(s) without consumption or prediction. Their metrics won't be calculated.", logging.WARNING)
+        daily = daily[~missing]
+    if daily.empty:
+        log_progress("Metrics calculated successfully")
+        return
+
+    y_true = daily['ConsumoMIPS'].to_numpy(dtype=np.float64)
+    y_pred = daily['Prediccion'].to_numpy(dtype=np.float64)
+
     if metrics_count == 0:
-        print("The MetricasPredicciones table is empty.")
-
-        metric_categories = 2
-
-        cursor.execute("""ALTER SEQUENCE metricas_seq 
-        RESTART WITH 1
-        INCREMENT BY 1
-        MINVALUE 1
-        MAXVALUE 100000
-        CYCLE;""")
-
-        cursor.execute("SELECT NEXT VALUE FOR metricas_seq")
-        id_metrica = int(cursor.fetchone()[0])  
-
-        n = 1
-
-        last_metrics = {
-            "MAE": 0,
-            "MSE": 0,
-            "RMSE": 0,
-            "MAPE": 0,
-            "sMAPE": 0
-        }
-
-        for id_fecha in range(min_id_fecha + 1, max_id_fecha + 1):
-            print(f"Calculating metrics for IdFecha: {id_fecha}")
-            print(f"This is the id_metrica: {id_metrica}")
-
-            # Fetch y_true and y_pred
-            cursor.execute(f"SELECT SUM(ConsumoMIPS) FROM dbo.ConsumosMIPS WHERE IdFecha = {id_fecha};")
-            y_true = cursor.fetchone()[0]
-            print(f"y_true: {y_true}")
-
-            cursor.execute(f"SELECT Prediccion FROM dbo.PrediccionesMIPS WHERE IdFecha = {id_fecha};")
-            y_pred = cursor.fetchone()[0]
-            print(f"y_pred: {y_pred}")
-
-            metrics_result = metrics(n=n, y_true=y_true, y_pred=y_pred, last_metrics=last_metrics)
-
-            for category in range(metric_categories):
-
-                print("Inserting metrics...")
-                cursor.execute("""
-                    INSERT INTO dbo.MetricasPredicciones 
-                    (IdMetrica, IdFecha, IdCategoriaMetrica, MAE, MSE, RMSE, MAPE, sMAPE)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    id_metrica,
-                    id_fecha,
-                    category,
-                    float(metrics_result['MAE']),
-                    float(metrics_result['MSE']),
-                    float(metrics_result['RMSE']),
-                    float(metrics_result['MAPE']),
-                    float(metrics_result['sMAPE'])
-                ))
-                conn.commit()
-                if id_fecha < max_id_fecha + 1:
-                    cursor.execute("SELECT NEXT VALUE FOR metricas_seq")
-                    id_metrica = cursor.fetchone()[0]
-                print(id_metrica)
-
-            n += 1
-            last_metrics = metrics_result
+        log_progress("The MetricasPredicciones table is empty.")
+        restart_sequence(cursor, 'metricas_seq')
+
+        # Both categories accumulate from the first date
+        accumulators = {0: MetricsAccumulator(), 1: MetricsAccumulator()}
+        resets = {0: None, 1: None}
 
     else:
-        print("The MetricasPredicciones table is not empty.")
-        cursor.execute("SELECT NEXT VALUE FOR metricas_seq")
-        id_metrica = int(cursor.fetchone()[0])
-
-        for id_fecha in range(min_id_fecha + 1, max_id_fecha + 1):
-
-            cursor.execute(f"""
-                           SELECT MONTH(Fecha), DAY(Fecha) FROM dbo.Fechas
-                           WHERE IdFecha BETWEEN {id_fecha - 1} AND {id_fecha};
-                           """)
-            month_day = cursor.fetchall()
-
-            if month_day[0][0] != month_day[1][0]:
-                n = 1
-                last_metrics = {
-                    "MAE": 0,
-                    "MSE": 0,
-                    "RMSE": 0,
-                    "MAPE": 0,
-                    "sMAPE": 0
-                }
-
-                # Fetch y_true and y_pred
-                cursor.execute(f"SELECT SUM(ConsumoMIPS) FROM dbo.ConsumosMIPS WHERE IdFecha = {id_fecha};")
-                y_true = cursor.fetchone()[0]
-
-                cursor.execute(f"SELECT SUM(Prediccion) FROM dbo.PrediccionesMIPS WHERE IdFecha = {id_fecha};")
-                y_pred = cursor.fetchone()[0]
-
-                metrics_result = metrics(n=n, y_true=y_true, y_pred=y_pred, last_metrics=last_metrics)
-
-                print("Inserting metrics...")
-                cursor.execute("""
-                    INSERT INTO dbo.MetricasPredicciones 
-                    (IdMetrica, IdFecha, IdCategoriaMetrica, MAE, MSE, RMSE, MAPE, sMAPE)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    id_metrica,
-                    id_fecha,
-                    0,
-                    float(metrics_result['MAE']),
-                    float(metrics_result['MSE']),
-                    float(metrics_result['RMSE']),
-                    float(metrics_result['MAPE']),
-                    float(metrics_result['sMAPE'])
-                ))
-                conn.commit()
-                
-                if id_fecha < max_id_fecha + 1:
-                    cursor.execute("SELECT NEXT VALUE FOR metricas_seq")
-                    id_metrica = cursor.fetchone()[0]
-                
+        log_progress("The MetricasPredicciones table is not empty.")
+        cursor.execute(f"""
+            SELECT IdCategoriaMetrica, {', '.join(STATE_COLUMNS)}, {', '.join(METRIC_NAMES)}
+            FROM dbo.MetricasPredicciones
+            WHERE IdFecha = ?;
+        """, (min_id_fecha,))
+        accumulators = {0: MetricsAccumulator(), 1: MetricsAccumulator()}
+        for row in cursor.fetchall():
+            category, count, sums = int(row[0]), row[1], row[2:len(STATE_COLUMNS) + 1]
+            if count is not None:
+                accumulators[category] = MetricsAccumulator(count, dict(zip(MetricsAccumulator.TERMS, sums)))
+                continue
+            # Rows stored before the state columns: the metrics summarize the days of the month (category 0)
+            # or every metric of the category (category 1)
+            if category == 0:
+                count = int(min_id_fecha_day.iloc[0]) if not min_id_fecha_day.empty else 0
             else:
-                # We must find the last n value
-                n = int(month_day[1][1])
-
-                cursor.execute(f"""SELECT * FROM dbo.MetricasPredicciones
-                               WHERE IdFecha = {id_fecha - 1}
-                               AND IdCategoriaMetrica = 0;
-                               """)
-                last_metrics = cursor.fetchall()
-
-                last_metrics = {
-                    "MAE": last_metrics[0][3],
-                    "MSE": last_metrics[0][4],
-                    "RMSE": last_metrics[0][5],
-                    "MAPE": last_metrics[0][6],
-                    "sMAPE": last_metrics[0][7]
-                }
-
-                # Fetch y_true and y_pred
-                cursor.execute(f"SELECT SUM(ConsumoMIPS) FROM dbo.ConsumosMIPS WHERE IdFecha = {id_fecha};")
-                y_true = cursor.fetchone()[0]
-                print(f"y_true: {y_true}")
-
-                cursor.execute(f"SELECT SUM(Prediccion) FROM dbo.PrediccionesMIPS WHERE IdFecha = {id_fecha};")
-                y_pred = cursor.fetchone()[0]
-                print(f"y_pred: {y_pred}")
-
-                metrics_result = metrics(n=n, y_true=y_true, y_pred=y_pred, last_metrics=last_metrics)
-
-                print("Inserting metrics...")
-                cursor.execute("""
-                    INSERT INTO dbo.MetricasPredicciones 
-                    (IdMetrica, IdFecha, IdCategoriaMetrica, MAE, MSE, RMSE, MAPE, sMAPE)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    id_metrica,
-                    id_fecha,
-                    0,
-                    float(metrics_result['MAE']),
-                    float(metrics_result['MSE']),
-                    float(metrics_result['RMSE']),
-                    float(metrics_result['MAPE']),
-                    float(metrics_result['sMAPE'])
-                ))
-                conn.commit()
-                if id_fecha < max_id_fecha + 1:
-                    cursor.execute("SELECT NEXT VALUE FOR metricas_seq")
-                    id_metrica = cursor.fetchone()[0]
-            # Inserting the metrics to the category 1
-
-            cursor.execute("""
-                           SELECT COUNT(*) FROM dbo.MetricasPredicciones
-                           WHERE IdCategoriaMetrica = 1;
-                           """)
-            n = int(cursor.fetchone()[0]) + 1
-
-            cursor.execute(f"""
-                           SELECT * FROM dbo.MetricasPredicciones
-                           WHERE IdFecha = {id_fecha - 1}
-                           AND IdCategoriaMetrica = 1;
-                           """)
-            last_metrics = cursor.fetchall()
-            last_metrics = {
-                "MAE": last_metrics[0][3],
-                "MSE": last_metrics[0][4],
-                "RMSE": last_metrics[0][5],
-                "MAPE": last_metrics[0][6],
-                "sMAPE": last_metrics[0][7]
-            }
-
-            cursor.execute(f"SELECT SUM(ConsumoMIPS) FROM dbo.ConsumosMIPS WHERE IdFecha = {id_fecha};")
-            y_true = cursor.fetchone()[0]
-            print(f"y_true: {y_true}")
-
-            cursor.execute(f"SELECT SUM(Prediccion) FROM dbo.PrediccionesMIPS WHERE IdFecha = {id_fecha};")
-            y_pred = cursor.fetchone()[0]
-            print(f"y_pred: {y_pred}")
-
-            metrics_result = metrics(n=n, y_true=y_true, y_pred=y_pred, last_metrics=last_metrics)
-
-            print("Inserting metrics...")
-            cursor.execute("""
-                INSERT INTO dbo.MetricasPredicciones 
-                (IdMetrica, IdFecha, IdCategoriaMetrica, MAE, MSE, RMSE, MAPE, sMAPE)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                id_metrica,
+                cursor.execute("SELECT COUNT(*) FROM dbo.MetricasPredicciones WHERE IdCategoriaMetrica = 1;")
+                count = int(cursor.fetchone()[0])
+            last_metrics = dict(zip(METRIC_NAMES, (float(value) for value in row[len(STATE_COLUMNS) + 1:])))
+            accumulators[category] = MetricsAccumulator.from_metrics(last_metrics, count)
+
+        # Category 0 restarts every month, category 1 never restarts
+        resets = {0: daily['CambioMes'].to_numpy(), 1: None}
+
+    running = {
+        category: accumulator.running(y_true, y_pred, resets[category])
+        for category, accumulator in accumulators.items()
+    }
+
+    # One metric of category 0 and one of category 1 per date, with the state they resume from
+    metric_ids = iter(allocate_ids(cursor, 'dbo.metricas_seq', 2 * len(daily)))
+    metrics_to_insert = []
+    for position, id_fecha in enumerate(daily['IdFecha'].astype(int).tolist()):
+        for category in (0, 1):
+            values = running[category]
+            metrics_to_insert.append((
+                next(metric_ids),
                 id_fecha,
-                1,
-                float(metrics_result['MAE']),
-                float(metrics_result['MSE']),
-                float(metrics_result['RMSE']),
-                float(metrics_result['MAPE']),
-                float(metrics_result['sMAPE'])
+                category,
+                *(float(values['metrics'][name][position]) for name in METRIC_NAMES),
+                int(values['count'][position]),
+                *(float(values['sums'][term][position]) for term in MetricsAccumulator.TERMS)
             ))
-            conn.commit()
-            
-            if id_fecha < max_id_fecha + 1:
-                cursor.execute("SELECT NEXT VALUE FOR metricas_seq")
-                id_metrica = cursor.fetchone()[0]
 
-    return print("Metrics calculated successfully")
+    log_progress("Inserting metrics...")
+    with bulk_cursor(conn) as insert_cursor:
+        insert_cursor.executemany(f"""
+            INSERT INTO dbo.MetricasPredicciones
+            (IdMetrica, IdFecha, IdCategoriaMetrica, {', '.join(METRIC_NAMES)}, {', '.join(STATE_COLUMNS)})
+            VALUES ({', '.join('?' for _ in range(3 + len(METRIC_NAMES) + len(STATE_COLUMNS)))})
+        """, metrics_to_insert)
+    conn.commit()
+    log_progress("Metrics calculated successfully")
     
+def fetch_series_histories(max_id_fecha, engine, top_processes=0, store=None):
+    """
+    Fetches the daily consumption of every group and, optionally, of the processes with the highest
+    total consumption, to forecast them separately.
+
+    Parameters:
+    max_id_fecha (int): The maximum IdFecha to consider for fetching historical data.
+    engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object for executing SQL queries.
+    top_processes (int, optional): Number of processes to forecast besides the groups. Default is 0.
+    store (HistoryStore, optional): History store the daily consumptions are computed from, instead of dbo.ConsumosMIPS.
+
+    Returns:
+    dict: A dictionary mapping ('Grupo', IdGrupo) and ('Proceso', IdProceso) keys to a DataFrame
+    with the columns 'ds' and 'y', sorted by date.
+    """
+    if store is not None:
+        return store_series_histories(max_id_fecha, engine, top_processes, store)
+
+    queries = {
+        'Grupo': f"""
+            SELECT c.IdGrupo AS IdSerie, f.Fecha AS ds, SUM(c.ConsumoMIPS) AS y
+            FROM dbo.ConsumosMIPS c
+            INNER JOIN dbo.Fechas f ON f.IdFecha = c.IdFecha
+            WHERE c.IdFecha <= {max_id_fecha}
+            GROUP BY c.IdGrupo, f.Fecha;
+        """
+    }
+    if top_processes > 0:
+        top_query = backend_for(engine).limit(f"""
+            SELECT IdProceso FROM dbo.ConsumosMIPS
+            WHERE IdFecha <= {max_id_fecha}
+            GROUP BY IdProceso
+            ORDER BY SUM(ConsumoMIPS) DESC""", top_processes)
+        queries['Proceso'] = f"""
+            SELECT c.IdProceso AS IdSerie, f.Fecha AS ds, SUM(c.ConsumoMIPS) AS y
+            FROM dbo.ConsumosMIPS c
+            INNER JOIN dbo.Fechas f ON f.IdFecha = c.IdFecha
+            WHERE c.IdFecha <= {max_id_fecha}
+            AND c.IdProceso IN ({top_query})
+            GROUP BY c.IdProceso, f.Fecha;
+        """
+
+    histories = {}
+    for series_type, query in queries.items():
+        data = fetched(pd.read_sql(query, engine))
+        data['ds'] = pd.to_datetime(data['ds'], format='%Y-%m-%d')
+        for id_serie, history in data.sort_values(by='ds').groupby('IdSerie'):
+            histories[(series_type, int(id_serie))] = history[['ds', 'y']].reset_index(drop=True)
+    return histories
+
+def store_series_histories(max_id_fecha, engine, top_processes, store):
+    """
+    Computes the histories of fetch_series_histories from the columns of the history store.
+    Only the dates are read from the database.
+    """
+    data = store.read(['IdProceso', 'IdGrupo', 'IdFecha', 'ConsumoMIPS'], end_id_fecha=max_id_fecha)
+    dates = fetched(pd.read_sql(f"SELECT IdFecha, Fecha FROM dbo.Fechas WHERE IdFecha <= {max_id_fecha};", engine))
+    dates = pd.Series(pd.to_datetime(dates['Fecha'], format='%Y-%m-%d').to_numpy(), index=dates['IdFecha'].astype(np.int64))
+
+    series_columns = {'Grupo': 'IdGrupo'}
+    if top_processes > 0:
+        top = data.groupby('IdProceso')['ConsumoMIPS'].sum().nlargest(top_processes).index
+        series_columns['Proceso'] = 'IdProceso'
+
+    histories = {}
+    for series_type, column in series_columns.items():
+        rows = data if series_type == 'Grupo' else data[data['IdProceso'].isin(top)]
+        daily = rows.groupby([column, 'IdFecha'], as_index=False)['ConsumoMIPS'].sum()
+        daily['ds'] = dates.reindex(daily['IdFecha'].to_numpy()).to_numpy()
+        daily = daily.rename(columns={column: 'IdSerie', 'ConsumoMIPS': 'y'})
+        for id_serie, history in daily.sort_values(by='ds').groupby('IdSerie'):
+            histories[(series_type, int(id_serie))] = history[['ds', 'y']].reset_index(drop=True)
+    return histories
+
+def forecast_series_and_insert(max_id_fecha, conn, engine, store=None):
+    """
+    Forecasts the consumption of every group (and of the FORECAST_TOP_PROCESSES processes with the highest
+    consumption) and replaces the content of the PrediccionesSeries table with the predictions.
+
+    The Prophet fits run in parallel over FORECAST_WORKERS processes (default: the number of CPUs), each one
+    limited to FORECAST_BLAS_THREADS BLAS threads (default 1). A series that fails is reported and skipped.
+    Parameters:
+    max_id_fecha (int): The maximum IdFecha to consider for fetching historical data.
+    conn (pyodbc.Connection): The database connection object.
+    engine (sqlalchemy.engine.Engine): The SQLAlchemy engine object for executing SQL queries.
+    store (HistoryStore, optional): History store the histories are computed from.
+    Returns:
+    None
+    """
+    log_progress("Forecasting series and Inserting...")
+    top_processes = int(os.getenv('FORECAST_TOP_PROCESSES') or 0)
+    workers = int(os.getenv('FORECAST_WORKERS') or 0) or None
+    blas_threads = int(os.getenv('FORECAST_BLAS_THREADS') or 1)
+
+    histories = fetch_series_histories(max_id_fecha, engine, top_processes, store)
+    future_dates = fetched(pd.read_sql(f"""
+        SELECT IdFecha, Fecha as ds FROM dbo.Fechas
+        WHERE IdFecha >= {max_id_fecha};
+        """, engine))
+    future_dates['ds'] = pd.to_datetime(future_dates['ds'], format='%Y-%m-%d')
+
+    log_progress(f"Forecasting {len(histories)} series")
+    forecasts, failures = forecast_series(histories, future_dates, workers, blas_threads)
+    for (series_type, id_serie), error in failures.items():
+        log_progress(f"The forecast of {series_type} {id_serie} failed: {error}", logging.WARNING)
+    if not forecasts:
+        log_progress("No series were forecast")
+        return
+
+    future_dates = add_day_of_week_id(future_dates.rename(columns={'ds': 'Fecha'}))
+    forecast = pd.concat(
+        [
+            forecast.assign(TipoSerie=series_type, IdSerie=id_serie)
+            for (series_type, id_serie), forecast in forecasts.items()
+        ],
+        ignore_index=True
+    ).merge(future_dates, on='Fecha', how='left')
+    forecast = forecast.astype({'IdSerie': 'int', 'IdFecha': 'int', 'IdDiaSemana': 'int'})
+
+    log_progress("Inserting series forecast into the database")
+    try:
+        with bulk_cursor(conn) as cursor:
+            cursor.execute("DELETE FROM dbo.PrediccionesSeries;")
+            cursor.executemany("""
+                INSERT INTO dbo.PrediccionesSeries (TipoSerie, IdSerie, IdFecha, IdDiaSemana, Prediccion, LimInf, LimSup)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, dataframe_rows(
+                forecast, ['TipoSerie', 'IdSerie', 'IdFecha', 'IdDiaSemana', 'Prediccion', 'LimInf', 'LimSup']
+            ))
+        conn.commit()
+        log_progress(f"Forecast of {len(forecasts)} series inserted successfully")
+    except Exception as e:
+        log_progress(f"Error in forecast_series_and_insert: {e}", logging.ERROR)
+        conn.rollback()
+
 def predictions_orchestrator(conn, engine):
     """
     Orchestrates the prediction process by either resetting the prediction sequence
@@ -422,55 +450,61 @@ def predictions_orchestrator(conn, engine):
         - Executes SQL commands to reset the prediction sequence if no predictions exist.
         - Calls the `forecast_and_insert` function to generate and insert new forecasts.
         - Calls the `calculate_metrics` function to compute metrics if predictions exist.
+        - Calls the `forecast_series_and_insert` function when FORECAST_BY_GROUP is enabled.
+        - With HISTORY_STORE_PATH set, both forecasts read the consumptions from the local history store.
     """
-    print("Predictive Model Executed")
+    log_progress("Predictive Model Executed")
     
     #Calling the parameters function
-    predictions_count, min_id_fecha, max_id_fecha = parameters(conn)
+    with stage('parameters'):
+        predictions_count, min_id_fecha, max_id_fecha = parameters(conn)
 
     #Creating a cursor object
     cursor = conn.cursor()
 
-    if predictions_count == 0:
-        return forecast_and_insert(max_id_fecha, conn, engine)
+    if predictions_count != 0:
+        with stage('calculate_metrics', rows_in=predictions_count):
+            calculate_metrics(min_id_fecha, max_id_fecha, conn)
+            cursor.execute("""DELETE FROM dbo.PrediccionesMIPS;""")
+    with stage('open_history_store'):
+        store = open_history_store(cursor)
+    with stage('forecast_and_insert'):
+        forecast_and_insert(max_id_fecha, conn, engine, store)
 
-    else:
-        calculate_metrics(min_id_fecha, max_id_fecha, conn)
-        cursor.execute("""DELETE FROM dbo.PrediccionesMIPS;""")
-        return forecast_and_insert(max_id_fecha, conn, engine)
+    if os.getenv('FORECAST_BY_GROUP', '').lower() in ('1', 'true', 'yes'):
+        with stage('forecast_series_and_insert'):
+            forecast_series_and_insert(max_id_fecha, conn, engine, store)
 
 def main():
     """
     Main function to update consumption data and execute forecasting.
 
     This function performs the following steps:
-    1. Creates connections to the databases for inserting data, fetching data, and inserting forecasting data.
-    2. Updates the consumption data by checking if the necessary tables exist, fetching new data, and updating the database.
-    3. Executes the forecasting process using the updated data.
+    1. Borrows the connections for inserting data and inserting forecasting data from a ConnectionManager.
+    2. Executes the forecasting process using the stored data.
 
-    If a database or file error occurs, it catches the exception and prints an error message.
-
-    Finally, it ensures that all database connections are closed.
+    Finally, the connections are returned to the pool and the pool is closed, and the run report is written.
+    The progress messages are logged to the standard output (see monitoring_tools.instrumentation.configure_logging).
 
     Raises:
         pyodbc.DatabaseError: If a database error occurs.
         FileNotFoundError: If a file-related error occurs.
     """
-    while True:
-        try:
-            print("Connecting to databases...")
-            conn_insert = connect_to_insert_data()
-            conn_insert_predictions = connect_to_insert_forecasting_data()
-            print("Executing Forecasting...")
-            predictions_orchestrator(conn_insert, conn_insert_predictions)
-            print("Forecasting executed successfully")
-            break
-        finally:
-            try:
-                conn_insert.close()
-                conn_insert_predictions.close()
-            except NameError:
-                pass
+    configure_logging()
+    report = start_run()
+    status = 'failure'
+    try:
+        log_progress("Connecting to databases...")
+        with ConnectionManager() as manager:
+            with manager.raw_connection(INSERTION) as conn_insert, manager.connection(INSERTION) as conn_insert_predictions:
+                log_progress("Executing Forecasting...")
+                with stage('predictions_orchestrator'):
+                    predictions_orchestrator(conn_insert, conn_insert_predictions)
+                log_progress("Forecasting executed successfully")
+        status = 'success'
+    finally:
+        report.finish(status)
+        report.write()
 
 if __name__ == "__main__":
     main()
@@ -1,22 +1,31 @@
 """DETECTOR-DE-NOVEDADES/main_functions/inserting_data.py"""
+import logging
+import threading
+from queue import Full, Queue
 import pandas as pd
-from database_tools.create_tables import create_tables
+from database_tools.backends import backend_for
+from database_tools.create_tables import CORE_TABLES, create_tables, create_auxiliary_tables
 from database_tools.delete_tables import delete_tables
+from monitoring_tools.instrumentation import fetched, log_progress, stage, with_stage_path
 from database_tools.update_tables import (
-    update_processes,
-    update_groups,
+    INDEPENDENT_DIMENSIONS,
+    update_dimensions_concurrently,
     update_procesos_grupos,
-    update_fechas,
     add_day_of_week_id,
     filter_existing_rows
 )
+
+# Columns of the source view dbo.refrescarprocesos_10dias used by the pipeline
+SOURCE_COLUMNS = ['NombreProceso', 'NombreGrupo', 'Fecha', 'total_ejecucionesFecha', 'total_mipsFecha']
+
 def check_tables_exist(conn):
     """
     Checks if tables exist in the specified database schema and catalog.
 
-    This function queries the information schema to determine if any tables
+    This function queries the information schema to determine how many of the core tables
     exist within the 'dbo' schema of the 'Consumos-PrediccionesMIPS' catalog.
     If no tables are found, it calls the `create_tables` function to create them.
+    The auxiliary tables are created afterwards if they are missing.
 
     Args:
         conn (pyodbc.Connection): A connection object to the database.
@@ -24,71 +33,208 @@ def check_tables_exist(conn):
     Returns:
         str: A message indicating whether the tables exist or not.
     """
-    print("Checking if tables exist...")
+    log_progress("Checking if tables exist...")
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT COUNT(*)
-        FROM information_schema.tables
-        WHERE table_schema = 'dbo' AND table_catalog = 'Consumos-PrediccionesMIPS';
-    """)
-    count = cursor.fetchone()[0]
+    count = backend_for(conn).count_tables(cursor, CORE_TABLES)
     cursor.close()
     conn.commit()
-    print(f"{count} tables exist." if count > 0 else "Tables do not exist.")
+    log_progress(f"{count} tables exist." if count > 0 else "Tables do not exist.")
     if count == 0:
-        print("Tables do not exist.")
         create_tables(conn)
     elif count == 10:
-        print("Tables are already created.")
+        log_progress("Tables are already created.")
     elif count < 10:
-        print("Some tables are missing.")
+        log_progress("Some tables are missing.")
         delete_tables(conn)
         create_tables(conn)
     else:
-        print("Unexpected number of tables. More than 10 tables exist.")
+        log_progress("Unexpected number of tables. More than 10 tables exist.", logging.WARNING)
+    create_auxiliary_tables(conn)
 
-def fetch_new_data(conn_insert, conn_fetch):
+def new_data_query(conn_insert):
     """
-    Fetches new data from the specified SQL Server database using the fetch connection,
-    and processes it using the insert connection.
+    Builds the query of the new data of the source view: the whole history up to the initial
+    load date when ConsumosMIPS is empty, otherwise the dates after the last stored one.
 
     Args:
         conn_insert: A connection object to the database for inserting data.
-        conn_fetch: A connection object to the database for fetching data.
 
     Returns:
-        pd.DataFrame: A DataFrame containing the results of the executed SQL query.
+        str: The SELECT statement, with the explicit column list of the view and no terminator.
     """
-    print("Fetching new data...")
     cursor = conn_insert.cursor()
     cursor.execute('SELECT COUNT(*) FROM dbo.ConsumosMIPS')
     count = cursor.fetchone()[0]
+    columns = ', '.join(SOURCE_COLUMNS)
 
     if count == 0:
-        query = ("""SELECT * FROM dbo.refrescarprocesos_10dias Where Fecha <= '2024-10-31';""")
+        return f"""SELECT {columns} FROM dbo.refrescarprocesos_10dias Where Fecha <= '2024-10-31'"""
 
-    else:
-        cursor.execute('SELECT MAX(IdFecha) FROM dbo.ConsumosMIPS')
-        last_id_fecha = cursor.fetchone()[0]
-        cursor.execute(f'SELECT Fecha FROM dbo.Fechas WHERE IdFecha = {last_id_fecha}')
-        last_date = cursor.fetchone()[0]
-        query = (f"""SELECT * FROM dbo.refrescarprocesos_10dias WHERE Fecha > '{last_date}';""")
+    cursor.execute('SELECT MAX(IdFecha) FROM dbo.ConsumosMIPS')
+    last_id_fecha = cursor.fetchone()[0]
+    cursor.execute(f'SELECT Fecha FROM dbo.Fechas WHERE IdFecha = {last_id_fecha}')
+    last_date = cursor.fetchone()[0]
+    return f"""SELECT {columns} FROM dbo.refrescarprocesos_10dias WHERE Fecha > '{last_date}'"""
+
+def fetch_new_data(conn_insert, conn_fetch):
+    """
+    Fetches new data from the specified SQL Server database using the fetch connection,
+    and processes it using the insert connection.
+
+    Args:
+        conn_insert: A connection object to the database for inserting data.
+        conn_fetch: A connection object to the database for fetching data.
+
+    Returns:
+        pd.DataFrame: A DataFrame containing the results of the executed SQL query.
+    """
+    log_progress("Fetching new data...")
+    query = f"{new_data_query(conn_insert)};"
 
-    df = pd.read_sql(query, conn_fetch)
+    df = fetched(pd.read_sql(query, conn_fetch))
     
     if df.empty:
-        print("Data is already updated with the last data available.")
+        log_progress("Data is already updated with the last data available.")
         return df
     
     return df
 
-def update_database(conn, df):
+def fetch_new_data_chunks(conn_insert, conn_fetch, chunk_rows):
+    """
+    Fetches the new data in date order and yields it in chunks of about chunk_rows rows, so only one
+    chunk is held in memory at a time. A date is never split between two chunks: the rows of the
+    last date of a chunk are carried over to the next one.
+
+    The query is built from conn_insert right away, so the returned iterator only uses conn_fetch
+    and can be consumed from another thread (see prefetch_chunks).
+
+    Args:
+        conn_insert: A connection object to the database for inserting data.
+        conn_fetch: A connection object to the database for fetching data.
+        chunk_rows (int): Number of rows read from the source view at a time.
+
+    Returns:
+        iterator of pd.DataFrame: The rows of one or more complete dates.
+    """
+    log_progress("Fetching new data in chunks...")
+    query = f"{new_data_query(conn_insert)} ORDER BY Fecha;"
+    return _read_date_chunks(query, conn_fetch, chunk_rows)
+
+def fetch_single_executions(conn_insert, conn_fetch):
+    """
+    Fetches the processes with a single row in the new data, and the consumption of that row, with an
+    aggregate query, so the initial load can be labeled one segment at a time without reading it whole
+    (see novelty_detection.detect_initial_load_segment).
+
+    Args:
+        conn_insert: A connection object to the database for inserting data.
+        conn_fetch: A connection object to the database for fetching data.
+
+    Returns:
+        pd.DataFrame: The columns 'NombreProceso' and 'total_mipsFecha', one row per process.
+    """
+    query = f"""
+        SELECT NombreProceso, MIN(total_mipsFecha) AS total_mipsFecha
+        FROM ({new_data_query(conn_insert)}) nuevos
+        GROUP BY NombreProceso
+        HAVING COUNT(*) = 1;
+    """
+    return fetched(pd.read_sql(query, conn_fetch))
+
+def _read_date_chunks(query, conn_fetch, chunk_rows):
+    pending = None
+    for chunk in pd.read_sql(query, conn_fetch, chunksize=chunk_rows):
+        fetched(chunk)
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        complete = chunk['Fecha'] != chunk['Fecha'].iloc[-1]
+        pending = chunk[~complete]
+        if complete.any():
+            yield chunk[complete].reset_index(drop=True)
+
+    if pending is None:
+        log_progress("Data is already updated with the last data available.")
+    elif not pending.empty:
+        yield pending.reset_index(drop=True)
+
+def prefetch_chunks(chunks, queue_size):
+    """
+    Reads the chunks of an iterator in a background thread while the caller processes the previous ones,
+    so the extraction of the next chunk overlaps the labeling and insert of the current one. At most
+    queue_size chunks wait in the queue: the reader blocks when it is full, which bounds the memory.
+    An error of the reader is raised in the caller, and the reader stops if the caller stops early.
+
+    Args:
+        chunks (iterator): The chunks, e.g. returned by fetch_new_data_chunks. Only the reader thread uses it.
+        queue_size (int): Maximum number of chunks read ahead.
+
+    Yields:
+        The chunks, in the same order.
+    """
+    queue = Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for chunk in chunks:
+                if not put(('chunk', chunk)):
+                    break
+            put(('done', None))
+        except Exception as error:
+            put(('error', error))
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    reader = threading.Thread(target=with_stage_path(read), name='extraction-reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            kind, item = queue.get()
+            if kind == 'done':
+                break
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        reader.join()
+
+def compact_new_data(df):
+    """
+    Keeps only the columns needed to detect atypical values, with the smallest numeric types,
+    once the names of the processes and groups were replaced by their IDs.
+
+    Args:
+        df (pd.DataFrame): Data returned by update_database.
+
+    Returns:
+        pd.DataFrame: The compacted data.
+    """
+    df = df[['IdProceso', 'IdGrupo', 'IdFecha', 'IdDiaSemana', 'Fecha', 'total_ejecucionesFecha', 'total_mipsFecha']].copy()
+    for column in ['IdProceso', 'IdGrupo', 'IdFecha', 'IdDiaSemana', 'total_ejecucionesFecha']:
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+    return df
+
+def update_database(conn, df, dimension_connections=None):
     """
     Updates the database with the provided DataFrame.
 
     Args:
         conn: A database connection object.
         df: A pandas DataFrame containing the data to be updated.
+        dimension_connections (list, optional): Three extra connections. When given, the Procesos, Grupos
+            and Fechas tables are updated at the same time, one connection each. Default is to update them
+            one after the other on conn.
 
     Returns:
         pd.DataFrame: A DataFrame with the updated data.
@@ -96,11 +242,20 @@ def update_database(conn, df):
     if df.empty:
         return df
     
-    df = add_day_of_week_id(df)
-    df = update_processes(conn, df)
-    df = update_groups(conn, df)
-    df = update_fechas(conn, df)
-    update_procesos_grupos(conn, df)
-    df = filter_existing_rows(df, conn)
-    
+    with stage('update_database', rows_in=len(df)) as record:
+        df = add_day_of_week_id(df)
+        if dimension_connections:
+            df = update_dimensions_concurrently(dimension_connections, df)
+        else:
+            for update, _, _ in INDEPENDENT_DIMENSIONS:
+                with stage(update.__name__, rows_in=len(df)) as dimension_record:
+                    df = update(conn, df)
+                    dimension_record.rows_out = len(df)
+        with stage('update_procesos_grupos', rows_in=len(df)):
+            update_procesos_grupos(conn, df)
+        with stage('filter_existing_rows', rows_in=len(df)) as filter_record:
+            df = filter_existing_rows(df, conn)
+            filter_record.rows_out = len(df)
+        record.rows_out = len(df)
+
     return df
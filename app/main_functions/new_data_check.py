@@ -0,0 +1,51 @@
+"""DETECTOR-DE-NOVEDADES/main_functions/new_data_check.py"""
+from sqlalchemy import text
+from database_tools.backends import backend_for
+
+# This module runs before anything else on every execution, so it must not import pandas,
+# scipy or prophet: most executions end here when the source has no new dates.
+
+def last_stored_date(conn_insert):
+    """
+    Returns the last date stored in dbo.ConsumosMIPS.
+
+    Args:
+        conn_insert (pyodbc.Connection): A connection object to the database for inserting data.
+
+    Returns:
+        datetime.date: The last stored date, or None if the table does not exist or is empty.
+    """
+    cursor = conn_insert.cursor()
+    backend = backend_for(conn_insert)
+    if not (backend.table_exists(cursor, 'ConsumosMIPS') and backend.table_exists(cursor, 'Fechas')):
+        cursor.close()
+        return None
+    cursor.execute("""
+        SELECT Fecha FROM dbo.Fechas
+        WHERE IdFecha = (SELECT MAX(IdFecha) FROM dbo.ConsumosMIPS);
+    """)
+    row = cursor.fetchone()
+    cursor.close()
+    conn_insert.commit()
+    return row[0] if row else None
+
+def has_new_data(conn_insert, conn_fetch):
+    """
+    Checks whether the source view has dates after the last stored one, reading a single row.
+    The initial load (no stored data) always has new data.
+
+    Args:
+        conn_insert (pyodbc.Connection): A connection object to the database for inserting data.
+        conn_fetch (sqlalchemy.engine.Connection): A connection object to the database for fetching data.
+
+    Returns:
+        bool: True if there is new data to update.
+    """
+    last_date = last_stored_date(conn_insert)
+    if last_date is None:
+        return True
+    result = conn_fetch.execute(
+        text('SELECT CASE WHEN EXISTS (SELECT 1 FROM dbo.refrescarprocesos_10dias WHERE Fecha > :last_date) THEN 1 ELSE 0 END'),
+        {'last_date': last_date}
+    )
+    return bool(result.scalar())
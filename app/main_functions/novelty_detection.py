@@ -1,7 +1,47 @@
 """DETECTOR-DE-NOVEDADES/main_functions/novelty_detector.py"""
+import os
 import pandas as pd
 import numpy as np
 import scipy.stats as stats
+from detection_tools.normality import (
+    group_normal,
+    merge_moments,
+    moments_normal,
+    normality_method,
+    segment_moments,
+    segment_normal,
+    shapiro_recheck_every
+)
+from detection_tools.robust_stats import group_robust_stats, segment_robust_stats
+from detection_tools.series_index import SeriesIndex
+from detection_tools.quantile_sketch import QuantileSketch, capacity_for_error
+from database_tools.backends import rows_exist
+from database_tools.bulk_load import CONSUMPTION_COLUMNS, bulk_insert
+from database_tools.history_store import append_history, open_history_store
+from database_tools.id_allocator import allocate_ids
+from monitoring_tools.instrumentation import log_progress, stage
+from database_tools.staging import stage_rows, drop_staging
+from database_tools.stats_cache import (
+    SERIES_KEYS,
+    STATS_COLUMNS,
+    consumption_watermark,
+    load_series_stats,
+    save_series_stats,
+    cache_series_stats
+)
+
+# Series with less stored consumptions than this are always labeled from their exact history.
+SKETCH_MIN_POINTS = 20
+
+SEGMENT_DATE_RANGES = [
+    ('2021-01-01', '2022-05-29'),
+    ('2022-05-29', '2023-04-03'),
+    ('2023-04-03', '2023-07-01'),
+    ('2023-07-01', '2024-11-01')
+]
+
+# First date taken into account by the statistics of the incremental load: the start of the last segment.
+SERIES_START_DATE = SEGMENT_DATE_RANGES[-1][0]
 
 def segment_data(df):
     """
@@ -16,19 +56,85 @@ def segment_data(df):
 
     df.loc[:, 'Fecha'] = pd.to_datetime(df['Fecha'])
     segments = []
-    date_ranges = [
-        ('2021-01-01', '2022-05-29'),
-        ('2022-05-29', '2023-04-03'),
-        ('2023-04-03', '2023-07-01'),
-        ('2023-07-01', '2024-11-01')
-    ]
-
-    for start_date, end_date in date_ranges:
+
+    for start_date, end_date in SEGMENT_DATE_RANGES:
         segment = df[(df['Fecha'] >= start_date) & (df['Fecha'] < end_date)]
         segments.append(segment)
 
     return segments
 
+def segment_numbers(fechas) -> np.ndarray:
+    """
+    Finds the segment of SEGMENT_DATE_RANGES of every date.
+
+    Parameters:
+    fechas (array-like): The dates.
+
+    Returns:
+    np.ndarray: The segment number of every date, -1 for the dates before the first segment and
+    len(SEGMENT_DATE_RANGES) for the dates after the last one.
+    """
+    edges = np.array(
+        [start for start, _ in SEGMENT_DATE_RANGES] + [SEGMENT_DATE_RANGES[-1][1]],
+        dtype='datetime64[ns]'
+    )
+    fechas = pd.to_datetime(pd.Series(fechas)).to_numpy().astype('datetime64[ns]')
+    return np.searchsorted(edges, fechas, side='right') - 1
+
+def atypical_bounds(method, median=np.nan, mad=np.nan, q1=np.nan, q3=np.nan):
+    """
+    Calculates the lower and upper bounds of the typical values for one or many series.
+    Parameters:
+    method (str or array-like): Method of each series. Options are 'MAD' (Median Absolute Deviation),
+    'MADadj' (MAD plus one, used when all the stored values are equal) and 'IQR' (Interquartile Range).
+    median (float or array-like): Median of each series, used by the MAD and MADadj methods.
+    mad (float or array-like): Median absolute deviation of each series, used by the MAD and MADadj methods.
+    q1 (float or array-like): First quartile of each series, used by the IQR method.
+    q3 (float or array-like): Third quartile of each series, used by the IQR method.
+    Returns:
+    tuple: The arrays (lower_bound, upper_bound) with one value per series.
+    """
+    method = np.asarray(method)
+    unknown = ~np.isin(method, ['MAD', 'MADadj', 'IQR'])
+    if unknown.any():
+        raise ValueError(f"Unknown method(s) for labeling atypical values: {np.unique(method[unknown])}")
+    median, mad, q1, q3 = (np.asarray(value, dtype=np.float64) for value in (median, mad, q1, q3))
+
+    epsilon = 1
+    iqr = q3 - q1
+    lower_bound = np.select(
+        [method == 'MADadj', method == 'IQR'],
+        [median - 3 * (mad + epsilon), q1 - 3 * iqr],
+        default=median - 3 * mad
+    )
+    upper_bound = np.select(
+        [method == 'MADadj', method == 'IQR'],
+        [median + 3 * (mad + epsilon), q3 + 3 * iqr],
+        default=median + 3 * mad
+    )
+    return lower_bound, upper_bound
+
+def label_atypical_array(values, lower_bound, upper_bound, series=None) -> np.ndarray:
+    """
+    Labels an array of consumptions against the bounds of their series in a single vectorized call.
+    Parameters:
+    values (array-like): Consumptions to label.
+    lower_bound (array-like): Lower bound of each series (see atypical_bounds).
+    upper_bound (array-like): Upper bound of each series (see atypical_bounds).
+    series (array-like, optional): Position in the bound arrays of the series of each value. If None,
+    the bounds are expected to be aligned with the values (or to be scalars). Default is None.
+    Returns:
+    np.ndarray: Array of labels where -1 indicates a low atypical value, 1 indicates a high atypical value,
+    and 0 indicates a typical value.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    lower_bound = np.asarray(lower_bound, dtype=np.float64)
+    upper_bound = np.asarray(upper_bound, dtype=np.float64)
+    if series is not None:
+        lower_bound = lower_bound[series]
+        upper_bound = upper_bound[series]
+    return np.select([values < lower_bound, values > upper_bound], [-1, 1], default=0)
+
 def label_atypical_values(new_consumptions, method='MAD', stored_consumptions=None):
     """
     Labels atypical values based on the 'ConsumoMIPS' column of the new_consumptions DataFrame.
@@ -36,7 +142,7 @@ def label_atypical_values(new_consumptions, method='MAD', stored_consumptions=No
     new_consumptions (pd.DataFrame): DataFrame containing the new consumption data with a 
     'ConsumoMIPS' column.
     method (str, optional): Method to use for detecting atypical values. Options are 'MAD' 
-    (Median Absolute Deviation) and 'IQR' (Interquartile Range). Default is 'MAD'.
+    (Median Absolute Deviation), 'MADadj' (MAD Adjusted) and 'IQR' (Interquartile Range). Default is 'MAD'.
     stored_consumptions (array-like, optional): Array-like object containing stored 
     consumption values to use for calculating the median and MAD or IQR. If None, calculations are based 
     on new_consumptions. Default is None.
@@ -44,8 +150,8 @@ def label_atypical_values(new_consumptions, method='MAD', stored_consumptions=No
     pd.DataFrame: The input DataFrame with an additional column 'IdAtipico' where -1 indicates
     a low atypical value, 1 indicates a high atypical value, and 0 indicates a typical value.
     """
-    
-    if method == 'MAD':
+    m = mad = q1 = q3 = np.nan
+    if method in ('MAD', 'MADadj'):
         if stored_consumptions is None:
             m = new_consumptions['ConsumoMIPS'].median()
             mad = stats.median_abs_deviation(new_consumptions['ConsumoMIPS'])
@@ -53,31 +159,6 @@ def label_atypical_values(new_consumptions, method='MAD', stored_consumptions=No
             m = np.median(stored_consumptions)
             mad = stats.median_abs_deviation(stored_consumptions)
 
-        def label_value(x):
-            if x < m - 3 * mad:
-                return -1
-            elif x > m + 3 * mad:
-                return 1
-            else:
-                return 0
-            
-    elif method == 'MADadj':
-        if stored_consumptions is None:
-            m = new_consumptions['ConsumoMIPS'].median()
-            mad = stats.median_abs_deviation(new_consumptions['ConsumoMIPS'])
-        else:
-            m = np.median(stored_consumptions)
-            mad = stats.median_abs_deviation(stored_consumptions)
-
-        def label_value(x):
-            epsilon = 1
-            if x < m - 3 * (mad + epsilon):
-                return -1
-            elif x > m + 3 * (mad + epsilon):
-                return 1
-            else:
-                return 0
-
     elif method == 'IQR':
         if stored_consumptions is None:
             q1 = new_consumptions['ConsumoMIPS'].quantile(0.25)
@@ -85,22 +166,536 @@ def label_atypical_values(new_consumptions, method='MAD', stored_consumptions=No
         else:
             q1 = np.quantile(stored_consumptions, 0.25)
             q3 = np.quantile(stored_consumptions, 0.75)
-        
-        iqr = q3 - q1
-        lower_bound = q1 - 3 * iqr
-        upper_bound = q3 + 3 * iqr
-        
-        def label_value(x):
-            if x < lower_bound:
-                return -1
-            elif x > upper_bound:
-                return 1
-            else:
-                return 0
-
-    new_consumptions.loc[:, 'IdAtipico'] = new_consumptions['ConsumoMIPS'].apply(label_value).values
+
+    lower_bound, upper_bound = atypical_bounds(method, m, mad, q1, q3)
+    new_consumptions.loc[:, 'IdAtipico'] = label_atypical_array(new_consumptions['ConsumoMIPS'], lower_bound, upper_bound)
     return new_consumptions
 
+def label_initial_load(df: pd.DataFrame, single_processes=None, single_values=None):
+    """
+    Labels the atypical values of the initial load in one vectorized pass.
+
+    The rows are grouped by segment (see SEGMENT_DATE_RANGES), IdProceso, IdGrupo and IdDiaSemana
+    and every group is labeled with the rules of the initial load:
+    - The processes with a single row in the whole load are labeled together using the MAD method.
+    - Groups with one row use the MAD method over all the rows of the process in the segment.
+    - Groups with less than 20 rows use the MAD method.
+    - Groups with 20 rows or more use the MAD Adjusted method when all their values are equal,
+      the IQR method when the normality test (see detection_tools.normality.segment_normal) does not
+      reject normality, and the MAD method otherwise.
+    The rows of processes with more than one row that fall outside every segment are discarded.
+
+    When the load is labeled one segment at a time (see detect_initial_load_segment), the processes with
+    a single row and their values are found beforehand in the whole load and given as arguments.
+
+    Parameters:
+    df (pd.DataFrame): The initial load with the columns 'IdProceso', 'IdGrupo', 'IdDiaSemana',
+    'ConsumoMIPS' and 'Fecha'.
+    single_processes (collection, optional): IdProceso of the processes with a single row in the whole load.
+    Default is found from df.
+    single_values (np.ndarray, optional): ConsumoMIPS of the rows of those processes, in the whole load.
+    Default is taken from df.
+
+    Returns:
+    tuple: A tuple containing:
+        - labeled (pd.DataFrame): The rows to insert with the 'IdAtipico' column filled.
+        - segments (np.ndarray): The segment number of every labeled row. The processes with a single
+          row are assigned to the first segment.
+        - counters (tuple): The number of groups labeled using the MAD, MAD Adjusted and IQR methods.
+    """
+    values = df['ConsumoMIPS'].to_numpy(dtype=np.float64)
+    labels = np.zeros(len(df), dtype=np.int64)
+
+    if single_processes is None:
+        one_execution = df['IdProceso'].map(df['IdProceso'].value_counts()).to_numpy() == 1
+    else:
+        one_execution = df['IdProceso'].isin(single_processes).to_numpy()
+    if one_execution.any():
+        pooled_values = values[one_execution] if single_values is None else np.asarray(single_values, dtype=np.float64)
+        pooled = group_robust_stats(np.zeros(len(pooled_values)), pooled_values, 1)
+        lower_bound, upper_bound = atypical_bounds('MAD', pooled['median'], pooled['mad'])
+        labels[one_execution] = label_atypical_array(values[one_execution], lower_bound, upper_bound)
+
+    segment = segment_numbers(df['Fecha'])
+    in_segment = (segment >= 0) & (segment < len(SEGMENT_DATE_RANGES))
+
+    has_keys = df[['IdProceso', 'IdGrupo', 'IdDiaSemana']].notna().all(axis=1).to_numpy()
+    multi_execution = ~one_execution & in_segment & has_keys
+
+    keys = df.loc[multi_execution, ['IdProceso', 'IdGrupo', 'IdDiaSemana']].assign(Segmento=segment[multi_execution])
+    series_codes = keys.groupby(['Segmento', 'IdProceso', 'IdGrupo', 'IdDiaSemana'], sort=False).ngroup().to_numpy()
+    process_codes = keys.groupby(['Segmento', 'IdProceso'], sort=False).ngroup().to_numpy()
+    n_series = series_codes.max() + 1 if len(series_codes) else 0
+    n_processes = process_codes.max() + 1 if len(process_codes) else 0
+    series_values = values[multi_execution]
+
+    series_stats = group_robust_stats(series_codes, series_values, n_series)
+    process_stats = group_robust_stats(process_codes, series_values, n_processes)
+    series_process = np.zeros(n_series, dtype=np.int64)
+    series_process[series_codes] = process_codes
+
+    size = series_stats['n']
+    single = size == 1
+    small = (size > 1) & (size < 20)
+    constant = (size >= 20) & (series_stats['ptp'] == 0)
+    tested = (size >= 20) & ~constant
+
+    normal = group_normal(series_codes, series_values, n_series, tested)
+
+    median = np.where(single, process_stats['median'][series_process], series_stats['median'])
+    mad = np.where(single, process_stats['mad'][series_process], series_stats['mad'])
+    method = np.select([constant, tested & normal], ['MADadj', 'IQR'], default='MAD')
+    lower_bound, upper_bound = atypical_bounds(method, median, mad, series_stats['q1'], series_stats['q3'])
+    labels[multi_execution] = label_atypical_array(series_values, lower_bound, upper_bound, series_codes)
+
+    keep = one_execution | multi_execution
+    labeled = df[keep].copy()
+    labeled['IdAtipico'] = labels[keep]
+    segments = np.where(one_execution, 0, segment)[keep]
+    counters = (
+        int(single.sum() + small.sum() + (tested & ~normal).sum()),
+        int(constant.sum()),
+        int((tested & normal).sum())
+    )
+    return labeled, segments, counters
+
+def fetch_stored_consumptions(cursor, df: pd.DataFrame, start_id_fecha: int, store=None) -> SeriesIndex:
+    """
+    Fetches, in a single query, the stored consumptions of every series present in the DataFrame.
+
+    The (IdProceso, IdGrupo, IdDiaSemana) keys of the batch are loaded into a temporary table
+    and joined against dbo.ConsumosMIPS, so the number of round trips does not depend on the number of rows.
+    With a history store, the consumptions are read from its memory mapped columns instead (see store_series_index).
+
+    Parameters:
+    cursor (pyodbc.Cursor): The database cursor.
+    df (pd.DataFrame): DataFrame with the columns 'IdProceso', 'IdGrupo' and 'IdDiaSemana'.
+    If None, the consumptions of every series are fetched.
+    start_id_fecha (int): Only the consumptions with IdFecha greater than or equal to this value are fetched.
+    store (HistoryStore, optional): History store in sync with dbo.ConsumosMIPS (see open_history_store).
+
+    Returns:
+    SeriesIndex: The ConsumoMIPS values of each (IdProceso, IdGrupo, IdDiaSemana) key with stored consumptions,
+    ordered by IdConsumo.
+    """
+    if store is not None:
+        return store_series_index(store, df, start_id_fecha)
+    if df is None:
+        cursor.execute("""
+            SELECT IdProceso, IdGrupo, IdDiaSemana, ConsumoMIPS
+            FROM dbo.ConsumosMIPS
+            WHERE IdFecha >= ?
+            ORDER BY IdConsumo;
+        """, (start_id_fecha,))
+        stored = pd.DataFrame([tuple(row) for row in cursor.fetchall()], columns=SERIES_KEYS + ['ConsumoMIPS'])
+    else:
+        keys = df[SERIES_KEYS].drop_duplicates().astype(int)
+        staging_table = stage_rows(
+            cursor,
+            '#SeriesLote',
+            [('IdProceso', 'INT'), ('IdGrupo', 'INT'), ('IdDiaSemana', 'INT')],
+            list(keys.itertuples(index=False, name=None))
+        )
+        cursor.execute(f"""
+            SELECT c.IdProceso, c.IdGrupo, c.IdDiaSemana, c.ConsumoMIPS
+            FROM dbo.ConsumosMIPS c
+            INNER JOIN {staging_table} s
+            ON c.IdProceso = s.IdProceso AND c.IdGrupo = s.IdGrupo AND c.IdDiaSemana = s.IdDiaSemana
+            WHERE c.IdFecha >= ?
+            ORDER BY c.IdConsumo;
+        """, (start_id_fecha,))
+        stored = pd.DataFrame([tuple(row) for row in cursor.fetchall()], columns=SERIES_KEYS + ['ConsumoMIPS'])
+        drop_staging(cursor, staging_table)
+
+    return SeriesIndex.from_rows(stored[SERIES_KEYS].to_numpy(dtype=np.int64), stored['ConsumoMIPS'].to_numpy(dtype=np.float64))
+
+def store_series_index(store, df: pd.DataFrame, start_id_fecha: int) -> SeriesIndex:
+    """
+    Reads the stored consumptions of the series of a batch from the history store. The months are mapped
+    without copying them (see HistoryStore.read_parts) and only the rows of the series of the batch are
+    copied out of them; they are only sorted by IdConsumo when the months are not stored in that order.
+
+    Parameters:
+    store (HistoryStore): History store in sync with dbo.ConsumosMIPS.
+    df (pd.DataFrame): DataFrame with the columns 'IdProceso', 'IdGrupo' and 'IdDiaSemana'.
+    If None, the consumptions of every series are read.
+    start_id_fecha (int): Only the consumptions with IdFecha greater than or equal to this value are read.
+
+    Returns:
+    SeriesIndex: The ConsumoMIPS values of each key with stored consumptions, ordered by IdConsumo.
+    """
+    batch_keys = None if df is None else pd.MultiIndex.from_frame(df[SERIES_KEYS].drop_duplicates().astype(np.int64))
+    columns = ['IdConsumo'] + SERIES_KEYS + ['ConsumoMIPS']
+    parts = []
+    for part in store.read_parts(columns, start_id_fecha=start_id_fecha):
+        if batch_keys is not None:
+            keep = pd.MultiIndex.from_arrays([part[key] for key in SERIES_KEYS]).isin(batch_keys)
+            part = {name: values[keep] for name, values in part.items()}
+        parts.append(part)
+    if not parts:
+        return SeriesIndex()
+
+    id_consumo = np.concatenate([part['IdConsumo'] for part in parts])
+    keys = np.column_stack([np.concatenate([part[name] for part in parts]) for name in SERIES_KEYS]).astype(np.int64)
+    values = np.concatenate([part['ConsumoMIPS'] for part in parts])
+    if len(id_consumo) > 1 and not np.all(id_consumo[1:] > id_consumo[:-1]):
+        order = np.argsort(id_consumo, kind='stable')
+        keys, values = keys[order], values[order]
+    return SeriesIndex.from_rows(keys, values)
+
+def compute_series_stats(history: SeriesIndex, sketch_capacity: int = None, keys: np.ndarray = None, added: np.ndarray = None) -> pd.DataFrame:
+    """
+    Computes the statistics used to label new consumptions of each series from its stored consumptions.
+
+    Parameters:
+    history (SeriesIndex): Stored ConsumoMIPS values of the series, ordered by IdConsumo (see fetch_stored_consumptions).
+    sketch_capacity (int, optional): Capacity of the quantile sketch built for each series.
+    If None, no sketch is built. Default is None.
+    keys (np.ndarray, optional): Array of shape (n, 3) with the keys of the series to compute, all of them
+    in the index. Default is every series with stored consumptions.
+    added (np.ndarray, optional): Number of values added to each series since its statistics were computed,
+    used to schedule the Shapiro-Wilk recheck (see detection_tools.normality.segment_normal).
+    Default is every value.
+
+    Returns:
+    pd.DataFrame: One row per series, indexed by (IdProceso, IdGrupo, IdDiaSemana), with the columns
+    'N', 'Mediana', 'MAD', 'Q1', 'Q3', 'RangoCero' (all the values are equal), 'Normal' (the normality
+    test does not reject normality), 'Bosquejo' (the serialized QuantileSketch of the series) and
+    'Media', 'M2', 'M3', 'M4' (its running central moments, see detection_tools.normality.segment_moments).
+    'RangoCero' and 'Normal' are only evaluated for series with 20 values or more.
+    """
+    ids = np.flatnonzero(history.sizes() > 0) if keys is None else history.ids(keys)
+    values, offsets = history.gather(ids)
+    sizes = np.diff(offsets)
+
+    series_stats = segment_robust_stats(values, offsets)
+    moments = segment_moments(values, offsets)
+    constant = (sizes >= 20) & (series_stats['ptp'] == 0)
+    normal = segment_normal(values, offsets, (sizes >= 20) & ~constant, moments, added)
+
+    return pd.DataFrame({
+        'N': sizes,
+        'Mediana': series_stats['median'],
+        'MAD': series_stats['mad'],
+        'Q1': series_stats['q1'],
+        'Q3': series_stats['q3'],
+        'RangoCero': constant,
+        'Normal': normal,
+        'Bosquejo': [
+            QuantileSketch.from_values(values[offsets[i]:offsets[i + 1]], sketch_capacity).to_bytes() if sketch_capacity else None
+            for i in range(len(ids))
+        ],
+        'Media': moments['mean'],
+        'M2': moments['m2'],
+        'M3': moments['m3'],
+        'M4': moments['m4']
+    }, index=pd.MultiIndex.from_arrays(list(history.keys[ids].T), names=SERIES_KEYS))
+
+def sketch_series_stats(series_stats: pd.DataFrame, new_consumptions: dict) -> pd.DataFrame:
+    """
+    Updates the statistics of series with a stored quantile sketch without reading their history.
+    The sketch receives the new consumptions and the median, MAD and quartiles are estimated from it,
+    so the cost does not depend on the length of the history. The running moments are merged with the
+    ones of the new consumptions; with the moments normality test (NORMALITY_TEST=moments) the normality
+    decision is taken again from them, otherwise, or when the moments of the series are unknown, it is kept.
+
+    Parameters:
+    series_stats (pd.DataFrame): Current statistics of the series (see compute_series_stats).
+    new_consumptions (dict): A dictionary mapping (IdProceso, IdGrupo, IdDiaSemana) keys with a stored sketch
+    to a np.ndarray with their new ConsumoMIPS values.
+
+    Returns:
+    pd.DataFrame: The updated statistics of the given series, with the same columns as compute_series_stats.
+    """
+    index = pd.MultiIndex.from_frame(pd.DataFrame(list(new_consumptions), columns=SERIES_KEYS, dtype=np.int64))
+    current = series_stats.loc[index]
+    offsets = np.zeros(len(new_consumptions) + 1, dtype=np.int64)
+    np.cumsum([len(consumptions) for consumptions in new_consumptions.values()], out=offsets[1:])
+    moments = merge_moments(
+        {
+            'n': current['N'].to_numpy(dtype=np.float64),
+            'mean': current['Media'].to_numpy(dtype=np.float64),
+            'm2': current['M2'].to_numpy(dtype=np.float64),
+            'm3': current['M3'].to_numpy(dtype=np.float64),
+            'm4': current['M4'].to_numpy(dtype=np.float64)
+        },
+        segment_moments(np.concatenate(list(new_consumptions.values())), offsets)
+    )
+    # The decision is only taken again with the moments test, and when the moments of the series are known
+    retest = (normality_method() == 'moments') & ~np.isnan(moments['m4'])
+    normal = moments_normal(moments['n'], moments['m2'], moments['m3'], moments['m4'])
+
+    rows = []
+    for i, (key, consumptions) in enumerate(new_consumptions.items()):
+        sketch = QuantileSketch.from_bytes(series_stats.at[key, 'Bosquejo'])
+        sketch.update(consumptions)
+        constant = bool(sketch.n >= 20 and sketch.max == sketch.min)
+        rows.append({
+            'N': sketch.n,
+            'Mediana': sketch.median(),
+            'MAD': sketch.median_abs_deviation(),
+            'Q1': sketch.quantile(0.25),
+            'Q3': sketch.quantile(0.75),
+            'RangoCero': constant,
+            'Normal': bool(normal[i] and not constant) if retest[i] else bool(series_stats.at[key, 'Normal']),
+            'Bosquejo': sketch.to_bytes(),
+            'Media': moments['mean'][i],
+            'M2': moments['m2'][i],
+            'M3': moments['m3'][i],
+            'M4': moments['m4'][i]
+        })
+    return pd.DataFrame(rows, columns=STATS_COLUMNS, index=index)
+
+def refresh_series_stats(series_stats: pd.DataFrame, history: SeriesIndex, new_rows: pd.DataFrame, sketch_capacity: int = None):
+    """
+    Refreshes the statistics of the series that received new consumptions.
+
+    The series whose history is in memory (or that have no statistics yet) get the new consumptions appended
+    to their history and are recomputed exactly. The rest are the long series labeled from their quantile sketch,
+    which are updated through it (see sketch_series_stats).
+
+    Parameters:
+    series_stats (pd.DataFrame): Current statistics of the series (see compute_series_stats).
+    history (SeriesIndex): Stored consumptions of the series read from the database, updated in place.
+    new_rows (pd.DataFrame): New rows with the columns 'IdProceso', 'IdGrupo', 'IdDiaSemana' and 'ConsumoMIPS'.
+    sketch_capacity (int, optional): Capacity of the quantile sketches. If None, no sketch is built. Default is None.
+
+    Returns:
+    tuple: The updated statistics of every series and the set of keys that were refreshed.
+    """
+    keys = new_rows[SERIES_KEYS].to_numpy(dtype=np.int64)
+    values = new_rows['ConsumoMIPS'].to_numpy(dtype=np.float64)
+    exact = (history.ids(keys) >= 0) | ~pd.MultiIndex.from_arrays(list(keys.T)).isin(series_stats.index)
+    history.append(keys[exact], values[exact])
+    refreshed_keys, added = np.unique(keys[exact], axis=0, return_counts=True)
+    refreshed = compute_series_stats(history, sketch_capacity, refreshed_keys, added)
+
+    if not exact.all():
+        sketched = {
+            key: consumptions.to_numpy(dtype=np.float64)
+            for key, consumptions in new_rows[~exact].groupby(SERIES_KEYS)['ConsumoMIPS']
+        }
+        refreshed = pd.concat([refreshed, sketch_series_stats(series_stats, sketched)])
+    series_stats = pd.concat([series_stats.drop(refreshed.index, errors='ignore'), refreshed])
+    return series_stats, set(refreshed.index)
+
+def label_with_series_stats(values, series_stats: pd.DataFrame):
+    """
+    Labels new consumptions using the statistics of their series, with the rules of the incremental load:
+    - Series without stored consumptions are labeled as high atypical values.
+    - Series with one stored consumption are atypical when they differ from it by more than 3 MIPS.
+    - Series with less than 20 stored consumptions use the MAD method.
+    - Series with 20 stored consumptions or more use the MAD Adjusted method when all the values are equal,
+      the IQR method when they look Gaussian, and the MAD method otherwise.
+
+    Parameters:
+    values (array-like): New consumptions to label.
+    series_stats (pd.DataFrame): Statistics of the series of each value, aligned with the values
+    (see compute_series_stats). Series without stored consumptions have a missing 'N'.
+
+    Returns:
+    tuple: A tuple containing:
+        - labels (np.ndarray): The label of each value.
+        - counters (tuple): The number of values labeled by comparison with 0 or 1 stored consumptions,
+          and using the MAD, MAD Adjusted and IQR methods.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    size = series_stats['N'].fillna(0).to_numpy()
+    constant = series_stats['RangoCero'].eq(True).to_numpy()
+    normal = series_stats['Normal'].eq(True).to_numpy()
+    median = series_stats['Mediana'].to_numpy(dtype=np.float64)
+
+    large = size >= 20
+    method = np.select([large & constant, large & ~constant & normal], ['MADadj', 'IQR'], default='MAD')
+    lower_bound, upper_bound = atypical_bounds(
+        method,
+        median,
+        series_stats['MAD'].to_numpy(dtype=np.float64),
+        series_stats['Q1'].to_numpy(dtype=np.float64),
+        series_stats['Q3'].to_numpy(dtype=np.float64)
+    )
+    labels = label_atypical_array(values, lower_bound, upper_bound)
+
+    difference = values - median
+    labels = np.select(
+        [size == 0, size == 1],
+        [np.ones_like(labels), np.select([difference > 3, difference < -3], [1, -1], default=0)],
+        default=labels
+    )
+
+    compared = size <= 1
+    counters = (
+        int(compared.sum()),
+        int((~compared & (method == 'MAD')).sum()),
+        int((~compared & (method == 'MADadj')).sum()),
+        int((~compared & (method == 'IQR')).sum())
+    )
+    return labels, counters
+
+def series_start_id_fecha(cursor) -> int:
+    """
+    Returns the first IdFecha taken into account by the statistics of the incremental load (SERIES_START_DATE).
+
+    Raises:
+    ValueError: If the stored dates do not include SERIES_START_DATE, i.e. the initial load did not cover it.
+    """
+    cursor.execute(f"SELECT IdFecha FROM dbo.Fechas WHERE Fecha = '{SERIES_START_DATE}';")
+    row = cursor.fetchone()
+    if row is None:
+        raise ValueError(
+            f"dbo.Fechas has no row for {SERIES_START_DATE}, the first date of the series statistics. "
+            f"The initial load must include that date."
+        )
+    return row[0]
+
+def series_sketch_capacity():
+    """
+    Returns the capacity of the quantile sketches for the SKETCH_EPSILON rank error, or None when it is not set.
+    """
+    sketch_epsilon = float(os.getenv('SKETCH_EPSILON') or 0)
+    return capacity_for_error(sketch_epsilon) if sketch_epsilon > 0 else None
+
+def series_stats_config(sketch_capacity: int = None) -> tuple:
+    """
+    Returns the settings the series statistics depend on: the capacity of the quantile sketches, the
+    normality test and how often the Shapiro-Wilk test is run again (see detection_tools.normality).
+    """
+    return sketch_capacity, normality_method(), shapiro_recheck_every()
+
+def prepare_series_stats(conn_insert, start_id_fecha: int, sketch_capacity: int = None, store=None):
+    """
+    Loads the cached statistics of every series. When they are outdated, they are rebuilt from the whole
+    stored history and saved, and that history is returned too, so it is not read again. The in-process
+    copy of the statistics is also returned with the history kept with it, if any (see store_series_stats).
+
+    Parameters:
+    conn_insert (pyodbc.Connection): The database connection object used for inserting data.
+    start_id_fecha (int): First IdFecha taken into account by the statistics.
+    sketch_capacity (int, optional): Capacity of the quantile sketches. Default is None.
+    store (HistoryStore, optional): History store the stored consumptions are read from.
+
+    Returns:
+    tuple: The statistics of every series and the stored consumptions of every series, or None when
+    the statistics were up to date and their history is not in memory.
+    """
+    cursor = conn_insert.cursor()
+    with stage('load_series_stats'):
+        watermark = consumption_watermark(cursor, start_id_fecha)
+        series_stats, history = load_series_stats(cursor, watermark, start_id_fecha, series_stats_config(sketch_capacity))
+    if series_stats is not None:
+        return series_stats, history
+
+    log_progress("The series statistics are outdated. Rebuilding them.")
+    with stage('rebuild_series_stats'):
+        history = fetch_stored_consumptions(cursor, None, start_id_fecha, store)
+        series_stats = compute_series_stats(history, sketch_capacity)
+        save_series_stats(cursor, series_stats, watermark, replace=True)
+        conn_insert.commit()
+    return series_stats, history
+
+def fetch_series_history(cursor, df: pd.DataFrame, series_stats: pd.DataFrame, start_id_fecha: int, sketch_capacity: int = None, store=None) -> SeriesIndex:
+    """
+    Fetches the stored consumptions of the series of a batch. With quantile sketches, the long series
+    that have one are skipped: they are labeled and refreshed without reading their history.
+
+    Parameters:
+    cursor (pyodbc.Cursor): The database cursor.
+    df (pd.DataFrame): The batch, with the columns 'IdProceso', 'IdGrupo' and 'IdDiaSemana'.
+    series_stats (pd.DataFrame): Statistics of the series (see compute_series_stats).
+    start_id_fecha (int): First IdFecha taken into account by the statistics.
+    sketch_capacity (int, optional): Capacity of the quantile sketches. Default is None.
+    store (HistoryStore, optional): History store the stored consumptions are read from.
+
+    Returns:
+    SeriesIndex: The stored consumptions of the series (see fetch_stored_consumptions).
+    """
+    keys_to_fetch = df[SERIES_KEYS].drop_duplicates().astype(int)
+    if sketch_capacity:
+        cached = series_stats.reindex(pd.MultiIndex.from_frame(keys_to_fetch))
+        sketched = (cached['N'].fillna(0).to_numpy() >= SKETCH_MIN_POINTS) & cached['Bosquejo'].notna().to_numpy()
+        keys_to_fetch = keys_to_fetch[~sketched]
+    with stage('fetch_stored_consumptions', rows_in=len(keys_to_fetch)):
+        return fetch_stored_consumptions(cursor, keys_to_fetch, start_id_fecha, store) if not keys_to_fetch.empty else SeriesIndex()
+
+def label_by_date(df: pd.DataFrame, series_stats: pd.DataFrame, history: SeriesIndex, sketch_capacity: int = None, insert_date=None, progress: bool = True):
+    """
+    Labels the rows of the incremental load one date at a time, in date order: the rows of every date are
+    labeled with the statistics of their series and then added to them, so they are part of the history
+    of the following dates.
+
+    Parameters:
+    df (pd.DataFrame): The rows to label, with the columns of dbo.ConsumosMIPS.
+    series_stats (pd.DataFrame): Statistics of the series (see compute_series_stats).
+    history (SeriesIndex): Stored consumptions of the series read from the database, updated in place.
+    sketch_capacity (int, optional): Capacity of the quantile sketches. Default is None.
+    insert_date (callable, optional): Called with the labeled rows of every date.
+    progress (bool, optional): Whether to log a message per date. Default is True.
+
+    Returns:
+    tuple: The updated statistics of every series, the set of keys that were refreshed and the counters
+    of label_with_series_stats added over all the dates.
+    """
+    totals = (0, 0, 0, 0)
+    updated_keys = set()
+    for id_fecha in sorted(df['IdFecha'].unique()):
+        if progress:
+            log_progress("Detecting atypical values...")
+        df_to_insert = df[df['IdFecha'] == id_fecha].copy()
+        with stage('labeling', rows_in=len(df_to_insert)) as record:
+            keys = pd.MultiIndex.from_frame(df_to_insert[SERIES_KEYS].astype(np.int64))
+            labels, counters = label_with_series_stats(df_to_insert['ConsumoMIPS'], series_stats.reindex(keys))
+            df_to_insert['IdAtipico'] = labels
+            record.rows_out = len(df_to_insert)
+        totals = tuple(total + counter for total, counter in zip(totals, counters))
+
+        if insert_date is not None:
+            insert_date(df_to_insert)
+
+        # The rows of this date are part of the history of the following dates.
+        with stage('refresh_series_stats', rows_in=len(df_to_insert)):
+            series_stats, date_keys = refresh_series_stats(series_stats, history, df_to_insert, sketch_capacity)
+        updated_keys |= date_keys
+    return series_stats, updated_keys, totals
+
+def insert_consumptions(conn, df: pd.DataFrame):
+    """
+    Inserts labeled rows into dbo.ConsumosMIPS with the bulk path of the backend, commits them and
+    appends them to the history store, when it is enabled.
+
+    Parameters:
+    conn (pyodbc.Connection): The database connection object used for inserting data.
+    df (pd.DataFrame): The rows, with the columns of dbo.ConsumosMIPS.
+    """
+    with stage('insert', rows_in=len(df)) as record:
+        cursor = conn.cursor()
+        bulk_insert(cursor, 'dbo.ConsumosMIPS', CONSUMPTION_COLUMNS, df)
+        conn.commit()
+        append_history(cursor, df)
+        record.rows_out = len(df)
+
+def store_series_stats(conn_insert, series_stats: pd.DataFrame, updated_keys: set, start_id_fecha: int, sketch_capacity: int = None, history: SeriesIndex = None):
+    """
+    Saves the refreshed statistics with the current watermark of dbo.ConsumosMIPS, once all the rows
+    they were computed from are inserted, and keeps them in the in-process cache.
+
+    Parameters:
+    conn_insert (pyodbc.Connection): The database connection object used for inserting data.
+    series_stats (pd.DataFrame): Statistics of every series.
+    updated_keys (set): Keys of the series that were refreshed.
+    start_id_fecha (int): First IdFecha taken into account by the statistics.
+    sketch_capacity (int, optional): Capacity of the quantile sketches. Default is None.
+    history (SeriesIndex, optional): Stored consumptions of every series, including the inserted rows,
+    kept in the in-process cache so the next load labels and refreshes its series without reading them.
+    Default is to keep none.
+    """
+    cursor = conn_insert.cursor()
+    log_progress("Updating the EstadisticasSeries table.")
+    with stage('save_series_stats', rows_in=len(updated_keys)):
+        watermark = consumption_watermark(cursor, start_id_fecha)
+        save_series_stats(cursor, series_stats.loc[list(updated_keys)], watermark)
+        conn_insert.commit()
+    cache_series_stats(cursor, series_stats, watermark, start_id_fecha, series_stats_config(sketch_capacity), history)
+
 def detect_atypical_values(conn_insert, df: pd.DataFrame):
     """Detects atypical values in the given DataFrame and inserts the processed data into the database.
     Parameters:
@@ -115,11 +710,45 @@ def detect_atypical_values(conn_insert, df: pd.DataFrame):
     - The function processes the data in segments and labels atypical values using different methods (MAD, IQR) based on the data characteristics.
     - The processed data is inserted into the database in batches to optimize performance.
     - The function handles both initial data insertion and updates to existing data.
-    - It prints progress messages to indicate the status of the operation.
+    - It logs progress messages to indicate the status of the operation (see monitoring_tools.instrumentation.log_progress).
+    - The labeling, the inserts and the statistics cache are measured as stages of the run report.
+    - When HISTORY_STORE_PATH is set, the stored consumptions are read from the local history store
+      (see database_tools.history_store), which receives the inserted rows.
+    """
+    if df.empty:
+        return df
+
+    with stage('detect_atypical_values', rows_in=len(df)) as record:
+        message = _detect_atypical_values(conn_insert, df)
+        record.rows_out = len(df)
+    return message
+
+def detect_initial_load_segment(conn_insert, df: pd.DataFrame, single_processes, single_values):
+    """
+    Labels and inserts the rows of one segment of the initial load (see SEGMENT_DATE_RANGES), or the rows
+    before the first one, when the load is read in date ordered chunks. The segments do not depend on each
+    other, except for the processes with a single row, which are labeled together with the values of the
+    whole load given as arguments. The result is the same as detect_atypical_values on the whole load.
+
+    Parameters:
+    conn_insert (pyodbc.Connection): The database connection object used for inserting data.
+    df (pd.DataFrame): The rows of the segment, as returned by update_database.
+    single_processes (collection): IdProceso of the processes with a single row in the whole load.
+    single_values (np.ndarray): ConsumoMIPS of the rows of those processes.
+
+    Returns:
+    str: A message indicating the result of the operation.
     """
     if df.empty:
         return df
 
+    with stage('detect_atypical_values', rows_in=len(df)) as record:
+        message = _detect_atypical_values(conn_insert, df, True, single_processes, single_values)
+        record.rows_out = len(df)
+    return message
+
+def _detect_atypical_values(conn_insert, df: pd.DataFrame, initial_load=None, single_processes=None, single_values=None):
+    """Body of detect_atypical_values and detect_initial_load_segment, for a DataFrame that is not empty."""
     df = df.rename(columns={'total_mipsFecha': 'ConsumoMIPS', 'total_ejecucionesFecha': 'Ejecuciones'})
     df = df.sort_values(by=['Fecha', 'IdProceso'], ascending=[True, True])
     df['IdAtipico'] = 0
@@ -128,136 +757,52 @@ def detect_atypical_values(conn_insert, df: pd.DataFrame):
     ma = 0
     n = 0
     cursor = conn_insert.cursor()
-    cursor.execute('SELECT MAX(IdConsumo) FROM dbo.ConsumosMIPS')
-    last_id = cursor.fetchone()[0] or 0
-    next_id = last_id + 1
+    if initial_load is None:
+        initial_load = not rows_exist(cursor, 'FROM dbo.ConsumosMIPS')
 
-    df['IdConsumo'] = range(next_id, next_id + len(df))
+    df['IdConsumo'] = list(allocate_ids(cursor, 'dbo.consumos_seq', len(df)))
 
     df_to_insert = pd.DataFrame()
 
-    def insert_data(df_to_insert):
-        cursor.fast_executemany = True
-        
-        insert_query = """
-            INSERT INTO dbo.ConsumosMIPS (IdConsumo, IdProceso, IdGrupo, IdFecha, IdDiaSemana, IdAtipico, Ejecuciones, ConsumoMIPS)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """
-
-        data_to_insert = df_to_insert.astype({
-            'IdConsumo': 'int',
-            'IdProceso': 'int',
-            'IdGrupo': 'int',
-            'IdFecha': 'int',
-            'IdDiaSemana': 'int',
-            'IdAtipico': 'int',
-            'Ejecuciones': 'int',
-            'ConsumoMIPS': 'float'
-        }).to_records(index=False)
-
-        cursor.executemany(insert_query, data_to_insert.tolist())
-        conn_insert.commit()
-
-    if last_id == 0:
+    if initial_load:
         df = df[['IdConsumo', 'IdProceso', 'IdGrupo', 'IdFecha', 'IdDiaSemana', 'IdAtipico', 'Ejecuciones', 'ConsumoMIPS', 'Fecha']]
-        count_df = df['IdProceso'].value_counts().reset_index()
-        count_df.columns = ['IdProceso', 'Count']
-        df_idprocess_one_execution = count_df[count_df['Count'] == 1]
-
-        df_one_execution = df[df['IdProceso'].isin(df_idprocess_one_execution['IdProceso'])]
-        df_one_execution_labeled = label_atypical_values(df_one_execution, method='MAD')
-        df_to_insert = pd.concat([df_to_insert, df_one_execution_labeled])
-
-        df_more_than_one_execution = df[~df['IdProceso'].isin(df_idprocess_one_execution['IdProceso'])]
-        segments = segment_data(df_more_than_one_execution)
-
-        for i, segment in enumerate(segments):
-            print("Detecting atypical values...")
-            for id_process in segment['IdProceso'].unique():
-                process_data = segment[segment['IdProceso'] == id_process]
-                if process_data['IdGrupo'].nunique() > 1:
-                    daily_segments = []
-                    segments_by_group = [process_data[process_data['IdGrupo'] == group] for group in process_data['IdGrupo'].unique()]
-                    for segment_by_group in segments_by_group:
-                        daily_segments_by_group = [segment_by_group[segment_by_group['IdDiaSemana'] == day] for day in segment_by_group['IdDiaSemana'].unique()]
-                        daily_segments.extend(daily_segments_by_group)
-                else:
-                    daily_segments = [process_data[process_data['IdDiaSemana'] == day] for day in process_data['IdDiaSemana'].unique()]
-                for daily_segment in daily_segments:
-                    if len(daily_segment) == 1:
-                        daily_segment = label_atypical_values(daily_segment, method='MAD', stored_consumptions=process_data['ConsumoMIPS'].tolist())
-                        m += 1
-                    elif len(daily_segment) < 20:
-                        daily_segment = label_atypical_values(daily_segment, method='MAD')
-                        m += 1
-                    elif len(daily_segment) >= 20:
-                        data_normal_test = daily_segment['ConsumoMIPS'].tolist()
-                        if np.ptp(data_normal_test) == 0:
-                            daily_segment = label_atypical_values(daily_segment, method='MADadj')
-                            ma += 1
-                        else:
-                            normal_test = stats.shapiro(daily_segment['ConsumoMIPS'].tolist())[1] > 0.05
-                            if normal_test:
-                                daily_segment = label_atypical_values(daily_segment, method='IQR')
-                                n += 1
-                            else:
-                                daily_segment = label_atypical_values(daily_segment, method='MAD')
-                                m += 1
-                    if not daily_segment.empty:
-                        df_to_insert = pd.concat([df_to_insert, daily_segment], ignore_index=True)
-        
-            print("Updating the ConsumosMIPS table.")
-            df_to_insert = df_to_insert[['IdConsumo', 'IdProceso', 'IdGrupo', 'IdFecha', 'IdDiaSemana', 'IdAtipico', 'Ejecuciones', 'ConsumoMIPS']]
-            insert_data(df_to_insert)
-            print(f"Segement number {i+1} loaded")
-            df_to_insert = pd.DataFrame()
+        log_progress("Detecting atypical values...")
+        with stage('labeling', rows_in=len(df)) as record:
+            df_labeled, segments, (m, ma, n) = label_initial_load(df, single_processes, single_values)
+            record.rows_out = len(df_labeled)
+        df_labeled = df_labeled[['IdConsumo', 'IdProceso', 'IdGrupo', 'IdFecha', 'IdDiaSemana', 'IdAtipico', 'Ejecuciones', 'ConsumoMIPS']]
+
+        for i in range(len(SEGMENT_DATE_RANGES)):
+            log_progress("Updating the ConsumosMIPS table.")
+            df_to_insert = df_labeled[segments == i]
+            if not df_to_insert.empty:
+                insert_consumptions(conn_insert, df_to_insert)
+            log_progress(f"Segment number {i+1} loaded")
 
     else:
         df = df[['IdConsumo', 'IdProceso', 'IdGrupo', 'IdFecha', 'IdDiaSemana', 'IdAtipico', 'Ejecuciones', 'ConsumoMIPS']]
         
-        cursor.execute("SELECT IdFecha FROM dbo.Fechas WHERE Fecha = '2023-07-01';")
-        start_id_fecha = cursor.fetchone()[0]
-        for id_fecha in sorted(df['IdFecha'].unique()):
-            print("Detecting atypical values...")
-            data_fecha = df[df['IdFecha'] == id_fecha]
-            for _, row in data_fecha.iterrows():
-                id_process = row['IdProceso']
-                id_group = row['IdGrupo']
-                id_diasemana = row['IdDiaSemana']
-                new_consumption = data_fecha[(data_fecha['IdProceso'] == id_process) & (data_fecha['IdGrupo'] == id_group) & (data_fecha['IdDiaSemana'] == id_diasemana)]
-                cursor.execute(f"""SELECT ConsumoMIPS FROM dbo.ConsumosMIPS WHERE IdProceso = {id_process} AND IdGrupo = {id_group} AND IdDiaSemana = {id_diasemana} AND IdFecha >= {start_id_fecha};""")
-                stored_consumptions = [row[0] for row in cursor.fetchall()]
-                if len(stored_consumptions) == 0:
-                    new_consumption.loc[:, 'IdAtipico'] = 1
-                    t += 1
-                elif len(stored_consumptions) == 1:
-                    t += 1
-                    if (new_consumption['ConsumoMIPS'].values[0] - stored_consumptions[0]) > 3:
-                        new_consumption.loc[:, 'IdAtipico'] = 1
-                    elif (new_consumption['ConsumoMIPS'].values[0] - stored_consumptions[0]) < -3:
-                        new_consumption.loc[:, 'IdAtipico'] = -1
-                    else:
-                        new_consumption.loc[:, 'IdAtipico'] = 0
-                elif len(stored_consumptions) < 20:
-                    new_consumption = label_atypical_values(new_consumption, method='MAD', stored_consumptions=stored_consumptions)
-                    m += 1
-                elif len(stored_consumptions) >= 20:
-                    if np.ptp(stored_consumptions) == 0:
-                        new_consumption = label_atypical_values(new_consumption, method='MADadj', stored_consumptions=stored_consumptions)
-                        ma += 1
-                    else:
-                        normal_test = stats.shapiro(stored_consumptions)[1] > 0.05
-                        if normal_test:
-                            new_consumption = label_atypical_values(new_consumption, method='IQR', stored_consumptions=stored_consumptions)
-                            n += 1
-                        else:
-                            new_consumption = label_atypical_values(new_consumption, method='MAD', stored_consumptions=stored_consumptions)
-                            m += 1
-                
-                df_to_insert = pd.concat([df_to_insert, new_consumption], ignore_index=True)
-            
-            print("Updating the ConsumosMIPS table.")
-            insert_data(df_to_insert)
-            df_to_insert = pd.DataFrame()
+        start_id_fecha = series_start_id_fecha(cursor)
+        sketch_capacity = series_sketch_capacity()
+        store = open_history_store(cursor)
+        series_stats, stored_history = prepare_series_stats(conn_insert, start_id_fecha, sketch_capacity, store)
+        if stored_history is None:
+            history = fetch_series_history(cursor, df, series_stats, start_id_fecha, sketch_capacity, store)
+        else:
+            history = stored_history.subset(df[SERIES_KEYS].drop_duplicates().to_numpy(dtype=np.int64))
+
+        def insert_date(df_to_insert):
+            log_progress("Updating the ConsumosMIPS table.")
+            insert_consumptions(conn_insert, df_to_insert)
+
+        series_stats, updated_keys, (t, m, ma, n) = label_by_date(df, series_stats, history, sketch_capacity, insert_date)
+
+        # Without sketches the whole history stays in memory with the statistics, so the next load of
+        # this process does not read it again
+        if stored_history is not None and not sketch_capacity:
+            stored_history = stored_history.merge(history)
+        else:
+            stored_history = None
+        store_series_stats(conn_insert, series_stats, updated_keys, start_id_fecha, sketch_capacity, stored_history)
 
     return f'Data updated successfully. {t + m + ma + n} processes were labeled. {m} using the MAD method, {ma} using the MAD Adjusted, and {n} processes were labeled using the IQR method.'
@@ -0,0 +1,416 @@
+"""DETECTOR-DE-NOVEDADES/monitoring_tools/instrumentation.py"""
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from sqlalchemy import event
+
+# Prefix of the metrics of the Prometheus textfile
+METRIC_PREFIX = 'novelty_detector'
+STAGE_FIELDS = ['calls', 'seconds', 'rows_in', 'rows_out', 'queries', 'bytes_fetched', 'peak_rss_bytes']
+# Names of the stages open in the current thread (or in the thread that submitted the current task)
+_stage_path = ContextVar('stage_path', default=())
+# Logger of the progress messages of the pipeline (see log_progress)
+logger = logging.getLogger(METRIC_PREFIX)
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident set size of the process and of its finished child processes (the forecast workers).
+
+    Returns:
+        int: The larger of both peaks, in bytes.
+    """
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return unit * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+def row_bytes(row):
+    """
+    Estimates the bytes of a fetched row: the length of the text and binary values and 8 bytes for any other value.
+
+    Args:
+        row (tuple or pyodbc.Row): The row.
+
+    Returns:
+        int: The estimated size.
+    """
+    return sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row)
+
+def report_paths():
+    """
+    Returns the paths of the run report: RUN_REPORT_PATH (JSON) and METRICS_TEXTFILE_PATH (Prometheus textfile),
+    or the files run_report.json and novelty_detector.prom of the persistent volume PATH_HOSTPATH.
+
+    Returns:
+        tuple: The JSON path and the textfile path. None for a file that is not written.
+    """
+    json_path = os.getenv('RUN_REPORT_PATH')
+    textfile_path = os.getenv('METRICS_TEXTFILE_PATH')
+    if os.getenv('PATH_HOSTPATH'):
+        json_path = json_path or os.path.join(os.getenv('PATH_HOSTPATH'), 'run_report.json')
+        textfile_path = textfile_path or os.path.join(os.getenv('PATH_HOSTPATH'), 'novelty_detector.prom')
+    return json_path or None, textfile_path or None
+
+class StageRecord:
+    """
+    Rows of one execution of a stage, set by the instrumented code.
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+class RunReport:
+    """
+    Telemetry of one execution of the pipeline. Every stage is identified by its path of nested stage
+    names (e.g. 'main/update_consumption_data/update_database/update_processes'), and the executions of
+    the same stage (one per chunk or per date) are added together:
+        - calls: number of executions,
+        - seconds: wall time,
+        - rows_in / rows_out: rows received and produced, as reported by the stage,
+        - queries: statements sent to the databases,
+        - bytes_fetched: estimated size of the fetched rows and frames,
+        - peak_rss_bytes: peak resident memory of the process when the stage ended.
+    The queries and bytes of a stage include the ones of its nested stages, and also the ones of the
+    stages running at the same time in other threads. The report also keeps named counters of events
+    of the whole execution (e.g. 'normality_disagreements').
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.status = 'running'
+        self.queries = 0
+        self.bytes_fetched = 0
+        self.stages = {}
+        self.events = {}
+        self._lock = threading.Lock()
+
+    def add_counts(self, queries=0, bytes_fetched=0):
+        """
+        Adds statements and fetched bytes, from any thread.
+        """
+        with self._lock:
+            self.queries += queries
+            self.bytes_fetched += int(bytes_fetched)
+
+    def add_event(self, name, value=1):
+        """
+        Adds occurrences of an event, from any thread.
+        """
+        with self._lock:
+            self.events[name] = self.events.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Measures a stage.
+
+        Args:
+            name (str): Name of the stage, nested under the stages currently open.
+            rows_in (int, optional): Rows received by the stage.
+
+        Yields:
+            StageRecord: Record where the stage sets rows_in and rows_out.
+        """
+        record = StageRecord(name, rows_in)
+        names = _stage_path.get() + (name,)
+        token = _stage_path.set(names)
+        start = time.perf_counter()
+        queries = self.queries
+        bytes_fetched = self.bytes_fetched
+        try:
+            yield record
+        finally:
+            _stage_path.reset(token)
+            seconds = time.perf_counter() - start
+            peak = peak_rss_bytes()
+            with self._lock:
+                totals = self.stages.setdefault('/'.join(names), dict.fromkeys(STAGE_FIELDS, 0))
+                totals['calls'] += 1
+                totals['seconds'] += seconds
+                totals['rows_in'] += record.rows_in or 0
+                totals['rows_out'] += record.rows_out or 0
+                totals['queries'] += self.queries - queries
+                totals['bytes_fetched'] += self.bytes_fetched - bytes_fetched
+                totals['peak_rss_bytes'] = peak
+
+    def finish(self, status):
+        """
+        Closes the report.
+
+        Args:
+            status (str): 'success' or 'failure'.
+        """
+        self.finished_at = time.time()
+        self.status = status
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: The report, ready to be serialized as JSON.
+        """
+        finished_at = self.finished_at or time.time()
+        return {
+            'status': self.status,
+            'started_at': self.started_at,
+            'finished_at': finished_at,
+            'seconds': round(finished_at - self.started_at, 3),
+            'queries': self.queries,
+            'bytes_fetched': self.bytes_fetched,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'events': dict(self.events),
+            'stages': [
+                {'stage': path, **{field: round(value, 3) if field == 'seconds' else value for field, value in totals.items()}}
+                for path, totals in list(self.stages.items())
+            ]
+        }
+
+    def to_prometheus(self):
+        """
+        Renders the report in the Prometheus text format, to be exposed by the node exporter textfile collector.
+
+        Returns:
+            str: The metrics.
+        """
+        report = self.to_dict()
+        lines = [
+            f'# HELP {METRIC_PREFIX}_run_duration_seconds Wall time of the last execution.',
+            f'# TYPE {METRIC_PREFIX}_run_duration_seconds gauge',
+            f'{METRIC_PREFIX}_run_duration_seconds {report["seconds"]}',
+            f'# HELP {METRIC_PREFIX}_run_success Whether the last execution finished successfully.',
+            f'# TYPE {METRIC_PREFIX}_run_success gauge',
+            f'{METRIC_PREFIX}_run_success {int(report["status"] == "success")}',
+            f'# HELP {METRIC_PREFIX}_run_finished_timestamp_seconds End of the last execution.',
+            f'# TYPE {METRIC_PREFIX}_run_finished_timestamp_seconds gauge',
+            f'{METRIC_PREFIX}_run_finished_timestamp_seconds {report["finished_at"]:.0f}',
+            f'# HELP {METRIC_PREFIX}_run_peak_rss_bytes Peak resident memory of the last execution.',
+            f'# TYPE {METRIC_PREFIX}_run_peak_rss_bytes gauge',
+            f'{METRIC_PREFIX}_run_peak_rss_bytes {report["peak_rss_bytes"]}'
+        ]
+        if report['events']:
+            lines.append(f'# HELP {METRIC_PREFIX}_events Events counted in the last execution.')
+            lines.append(f'# TYPE {METRIC_PREFIX}_events gauge')
+            for name, value in report['events'].items():
+                lines.append(f'{METRIC_PREFIX}_events{{event="{name}"}} {value}')
+        for field in STAGE_FIELDS:
+            metric = f'{METRIC_PREFIX}_stage_{field}'
+            lines.append(f'# HELP {metric} {field} of every stage in the last execution.')
+            lines.append(f'# TYPE {metric} gauge')
+            for stage in report['stages']:
+                lines.append(f'{metric}{{stage="{stage["stage"]}"}} {stage[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Writes the report as JSON and as a Prometheus textfile to the paths returned by report_paths.
+        The files are replaced atomically, so the collector never reads a partial file.
+        """
+        json_path, textfile_path = report_paths()
+        outputs = [
+            (json_path, lambda: json.dumps(self.to_dict(), indent=2)),
+            (textfile_path, self.to_prometheus)
+        ]
+        for path, render in outputs:
+            if not path:
+                continue
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            temporary_path = f'{path}.{os.getpid()}.tmp'
+            with open(temporary_path, 'w') as file:
+                file.write(render())
+            os.replace(temporary_path, path)
+            log_progress(f"Run report written to {path}")
+
+_report = RunReport()
+
+def current_report():
+    """
+    Returns:
+        RunReport: The report of the current execution.
+    """
+    return _report
+
+def start_run():
+    """
+    Starts the report of a new execution.
+
+    Returns:
+        RunReport: The new report.
+    """
+    global _report
+    _report = RunReport()
+    return _report
+
+def stage(name, rows_in=None):
+    """
+    Measures a stage of the current execution. Usage:
+
+        with stage('update_processes', rows_in=len(df)) as record:
+            ...
+            record.rows_out = len(df)
+
+    Args:
+        name (str): Name of the stage.
+        rows_in (int, optional): Rows received by the stage.
+
+    Returns:
+        contextmanager: Yields the StageRecord of the stage.
+    """
+    return _report.stage(name, rows_in)
+
+def with_stage_path(function):
+    """
+    Binds a function to the stages open in the calling thread, so the stages it opens when it runs
+    in a worker thread are nested under them. Usage:
+
+        executor.submit(with_stage_path(update_groups), conn, df)
+
+    Args:
+        function (callable): The function.
+
+    Returns:
+        callable: The bound function. Every call of the function needs its own binding.
+    """
+    context = copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+def count_query(statements=1):
+    """
+    Adds statements sent to a database to the current execution.
+    """
+    _report.add_counts(queries=statements)
+
+def count_fetched(nbytes):
+    """
+    Adds fetched bytes to the current execution.
+    """
+    _report.add_counts(bytes_fetched=nbytes)
+
+def count_event(name, value=1):
+    """
+    Adds occurrences of a named event to the current execution.
+    """
+    _report.add_event(name, value)
+
+def configure_logging():
+    """
+    Sends the progress messages of the pipeline to the standard output, with their time, level and the
+    path of the stage that logged them. The level is LOG_LEVEL (default INFO).
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(stage)s] %(message)s'))
+    logger.handlers[:] = [handler]
+    logger.setLevel((os.getenv('LOG_LEVEL') or 'INFO').strip().upper())
+    logger.propagate = False
+
+def log_progress(message, level=logging.INFO):
+    """
+    Logs a progress message of the current execution, tagged with the path of the stages open in the
+    calling thread. The warnings and errors are also counted as the events 'log_warning' and 'log_error'.
+
+    Args:
+        message (str): The message.
+        level (int, optional): Logging level. Default is logging.INFO.
+    """
+    if level >= logging.WARNING:
+        count_event('log_error' if level >= logging.ERROR else 'log_warning')
+    logger.log(level, message, extra={'stage': '/'.join(_stage_path.get()) or '-'})
+
+def fetched(df):
+    """
+    Adds the memory of a DataFrame read from a database (pd.read_sql) to the fetched bytes.
+
+    Args:
+        df (pd.DataFrame): The DataFrame.
+
+    Returns:
+        pd.DataFrame: The same DataFrame.
+    """
+    count_fetched(df.memory_usage(deep=True).sum())
+    return df
+
+def instrument_engine(engine):
+    """
+    Counts the statements executed through a SQLAlchemy engine (pd.read_sql and the connections of
+    ConnectionManager.connection) in the current execution.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The engine.
+
+    Returns:
+        sqlalchemy.engine.Engine: The same engine.
+    """
+    event.listen(engine, 'before_cursor_execute', lambda *args: count_query())
+    return engine
+
+class InstrumentedCursor:
+    """
+    DBAPI cursor that counts its statements and the estimated bytes of its fetched rows. Any other
+    attribute (e.g. fast_executemany) is read from and written to the wrapped cursor.
+    """
+
+    def __init__(self, cursor):
+        object.__setattr__(self, '__wrapped__', cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.__wrapped__, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__wrapped__, name, value)
+
+    def execute(self, *args):
+        count_query()
+        self.__wrapped__.execute(*args)
+        return self
+
+    def executemany(self, *args):
+        count_query()
+        self.__wrapped__.executemany(*args)
+        return self
+
+    def fetchone(self):
+        row = self.__wrapped__.fetchone()
+        if row is not None:
+            count_fetched(row_bytes(row))
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.__wrapped__.fetchmany(*args)
+        count_fetched(sum(row_bytes(row) for row in rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.__wrapped__.fetchall()
+        count_fetched(sum(row_bytes(row) for row in rows))
+        return rows
+
+    def __iter__(self):
+        for row in self.__wrapped__:
+            count_fetched(row_bytes(row))
+            yield row
+
+class InstrumentedConnection:
+    """
+    DBAPI connection whose cursors are InstrumentedCursor. Any other attribute is delegated to the wrapped connection.
+    """
+
+    def __init__(self, connection):
+        object.__setattr__(self, '__wrapped__', connection)
+
+    def __getattr__(self, name):
+        return getattr(self.__wrapped__, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__wrapped__, name, value)
+
+    def cursor(self, *args):
+        return InstrumentedCursor(self.__wrapped__.cursor(*args))
@@ -0,0 +1,86 @@
+"""DETECTOR-DE-NOVEDADES/experiment/benchmark/normality_agreement.py"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'app'))
+
+# Lower bounds of the series sizes the agreement is broken down by
+SIZE_BUCKETS = [20, 50, 100, 200, 500]
+
+def compare_normality(history):
+    """
+    Decides whether every series of the history looks Gaussian with the Shapiro-Wilk test on its values
+    and with the D'Agostino-Pearson test on its moments, and compares both decisions.
+
+    Args:
+        history (SeriesIndex): Stored consumptions of the series.
+
+    Returns:
+        dict: The number of tested series, the disagreements in each direction, the seconds of every
+        test and the same counts by series size.
+    """
+    from detection_tools.normality import moments_normal, segment_moments
+    from detection_tools.robust_stats import segment_robust_stats, segment_shapiro_normal
+
+    sizes = history.sizes()
+    tested = (sizes >= 20) & (segment_robust_stats(history.values, history.offsets)['ptp'] > 0)
+
+    start = time.perf_counter()
+    shapiro = segment_shapiro_normal(history.values, history.offsets, tested)
+    shapiro_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    moments = segment_moments(history.values, history.offsets)
+    normal = tested & moments_normal(moments['n'], moments['m2'], moments['m3'], moments['m4'])
+    moments_seconds = time.perf_counter() - start
+
+    def counts(selected):
+        return {
+            'series': int(selected.sum()),
+            'shapiro_normal': int(shapiro[selected].sum()),
+            'moments_normal': int(normal[selected].sum()),
+            'only_shapiro_normal': int((shapiro & ~normal)[selected].sum()),
+            'only_moments_normal': int((normal & ~shapiro)[selected].sum())
+        }
+
+    bounds = SIZE_BUCKETS + [np.inf]
+    return {
+        **counts(tested),
+        'shapiro_seconds': round(shapiro_seconds, 3),
+        'moments_seconds': round(moments_seconds, 3),
+        'by_size': {
+            f'{low}-{high - 1}' if high != np.inf else f'{low}+': counts(tested & (sizes >= low) & (sizes < high))
+            for low, high in zip(bounds[:-1], bounds[1:])
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the Shapiro-Wilk and moments normality decisions on the series stored in dbo.ConsumosMIPS.')
+    parser.add_argument('--all-dates', action='store_true', help='Use every stored consumption instead of the dates taken into account by the series statistics.')
+    parser.add_argument('--output', help='Path of a JSON file where the results are written.')
+    args = parser.parse_args()
+
+    from database_tools.connections import INSERTION, ConnectionManager
+    from main_functions.novelty_detection import fetch_stored_consumptions, series_start_id_fecha
+
+    with ConnectionManager() as manager, manager.raw_connection(INSERTION) as conn:
+        cursor = conn.cursor()
+        history = fetch_stored_consumptions(cursor, None, 0 if args.all_dates else series_start_id_fecha(cursor))
+
+    results = compare_normality(history)
+    disagreements = results['only_shapiro_normal'] + results['only_moments_normal']
+    print(f"{results['series']} series tested: the tests disagree on {disagreements} "
+          f"({disagreements / max(results['series'], 1):.1%}), {results['only_shapiro_normal']} only normal for Shapiro-Wilk "
+          f"and {results['only_moments_normal']} only normal for the moments test.")
+    print(f"Shapiro-Wilk took {results['shapiro_seconds']}s and the moments test {results['moments_seconds']}s.")
+    for bucket, bucket_counts in results['by_size'].items():
+        print(f"  {bucket} values: {bucket_counts['only_shapiro_normal'] + bucket_counts['only_moments_normal']} of {bucket_counts['series']} series disagree")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""DETECTOR-DE-NOVEDADES/experiment/benchmark/run_benchmark.py"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from workload_generator import SAMPLE_FILES, fit_profile, generate_workload, processes_for_rows, write_sqlite
+
+# The initial load of the pipeline reads the source view up to this date
+INITIAL_LOAD_END = pd.Timestamp('2024-10-31')
+
+# The incremental load computes the series statistics from this date, so the initial load must include it
+# (see novelty_detection.SERIES_START_DATE)
+SERIES_START = pd.Timestamp('2023-07-01')
+
+# Columns of the scratch table of the insert comparison
+BENCHMARK_TABLE_COLUMNS = """
+    IdConsumo BIGINT PRIMARY KEY, IdProceso INT, IdGrupo INT, IdFecha INT,
+    IdDiaSemana INT, IdAtipico INT, Ejecuciones INT, ConsumoMIPS FLOAT
+"""
+
+class StageTimer:
+    """
+    Collects the seconds and rows of every stage of a run.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds, rows):
+        seconds_total, rows_total = self.stages.get(stage, (0.0, 0))
+        self.stages[stage] = (seconds_total + seconds, rows_total + rows)
+
+    def measure(self, stage, function, *args, rows=None):
+        """
+        Calls function(*args) and adds its time to the stage.
+
+        Args:
+            stage (str): Name of the stage.
+            function (callable): The function to time.
+            rows (int, optional): Rows processed by the stage. Default is the length of the result.
+
+        Returns:
+            The result of the function.
+        """
+        start = time.perf_counter()
+        result = function(*args)
+        self.add(stage, time.perf_counter() - start, len(result) if rows is None else rows)
+        return result
+
+    def report(self):
+        """
+        Returns:
+            dict: Seconds, rows and rows per second of every stage.
+        """
+        return {
+            stage: {
+                'seconds': round(seconds, 3),
+                'rows': rows,
+                'rows_per_second': round(rows / seconds) if seconds > 0 else None
+            }
+            for stage, (seconds, rows) in self.stages.items()
+        }
+
+def peak_rss_mb():
+    """
+    Returns:
+        float: Peak resident set size of the process in MB (ru_maxrss is in KB on Linux and in bytes on macOS).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def update_stages(timer, conn_insert, new_data, initial_data):
+    """
+    Runs the stages of update_database and of the labeling for one batch of new data, as main.update_consumption_data does.
+
+    Args:
+        timer (StageTimer): Collects the times.
+        conn_insert (sqlite3.Connection): The insertion connection.
+        new_data (pd.DataFrame): Data returned by the extraction.
+        initial_data (list or None): List where the compacted batches of the initial load are accumulated,
+            None when the batch is labeled right away.
+    """
+    from database_tools.update_tables import (
+        update_processes,
+        update_groups,
+        update_procesos_grupos,
+        update_fechas,
+        add_day_of_week_id,
+        filter_existing_rows
+    )
+    from main_functions.inserting_data import compact_new_data
+
+    if new_data.empty:
+        return
+    rows = len(new_data)
+    start = time.perf_counter()
+    df = add_day_of_week_id(new_data)
+    df = update_processes(conn_insert, df)
+    df = update_groups(conn_insert, df)
+    df = update_fechas(conn_insert, df)
+    update_procesos_grupos(conn_insert, df)
+    timer.add('dimension_upserts', time.perf_counter() - start, rows)
+
+    df = timer.measure('duplicate_filtering', filter_existing_rows, df, conn_insert, rows=rows)
+    if df.empty:
+        return
+    if initial_data is not None:
+        initial_data.append(compact_new_data(df))
+    else:
+        label_and_insert(timer, conn_insert, df)
+
+def label_and_insert(timer, conn_insert, df):
+    """
+    Runs detect_atypical_values and splits its time into the labeling and the insert of dbo.ConsumosMIPS,
+    with the 'insert' stages it records in the run report.
+    """
+    from main_functions.novelty_detection import detect_atypical_values
+    from monitoring_tools.instrumentation import start_run
+
+    report = start_run()
+    start = time.perf_counter()
+    detect_atypical_values(conn_insert, df)
+    elapsed = time.perf_counter() - start
+    insert_seconds = sum(totals['seconds'] for path, totals in report.stages.items() if path.endswith('/insert'))
+    timer.add('labeling', elapsed - insert_seconds, len(df))
+    timer.add('insert', insert_seconds, len(df))
+
+def compare_inserts(conn, table, df, repeat=3):
+    """
+    Times the inserts of dbo.ConsumosMIPS rows into a scratch table with the former path (a tuple of
+    Python objects per row, then executemany) and with bulk_insert, keeping the best of repeat runs.
+    In SQL Server, when BULK_LOAD_SERVER_DIRECTORY is set, the opt-in BULK INSERT from data files is also timed.
+
+    Args:
+        conn: A DBAPI connection (sqlite3, or pyodbc for SQL Server).
+        table (str): Name of the scratch table, created and dropped by the caller.
+        df (pd.DataFrame): Rows with the columns of dbo.ConsumosMIPS.
+        repeat (int, optional): Runs of each path. Default is 3.
+
+    Returns:
+        dict: Seconds and rows per second of each path, and the speedup of every path over the former one.
+    """
+    from database_tools.backends import SqlServerBackend, backend_for
+    from database_tools.bulk_load import CONSUMPTION_COLUMNS, bulk_load_directories, typed_records
+
+    column_names = ', '.join(name for name, _ in CONSUMPTION_COLUMNS)
+
+    def row_tuples(cursor):
+        backend_for(cursor).prepare_bulk(cursor)
+        rows = df.astype({
+            'IdConsumo': 'int64', 'IdProceso': 'int', 'IdGrupo': 'int', 'IdFecha': 'int',
+            'IdDiaSemana': 'int', 'IdAtipico': 'int', 'Ejecuciones': 'int', 'ConsumoMIPS': 'float'
+        })[[name for name, _ in CONSUMPTION_COLUMNS]].to_records(index=False).tolist()
+        cursor.executemany(f'INSERT INTO {table} ({column_names}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    batch_rows = int(os.getenv('BULK_LOAD_BATCH_ROWS') or 100_000)
+
+    def bulk(cursor):
+        backend_for(cursor).bulk_insert(cursor, table, CONSUMPTION_COLUMNS, typed_records(df, CONSUMPTION_COLUMNS), batch_rows)
+
+    def bulk_files(cursor):
+        staging_directory, server_directory = bulk_load_directories()
+        backend_for(cursor).bulk_insert(
+            cursor, table, CONSUMPTION_COLUMNS, typed_records(df, CONSUMPTION_COLUMNS), batch_rows,
+            staging_directory=staging_directory, server_directory=server_directory
+        )
+
+    paths = [('row_tuples', row_tuples), ('bulk_insert', bulk)]
+    if isinstance(backend_for(conn), SqlServerBackend) and bulk_load_directories()[1] is not None:
+        paths.append(('bulk_insert_files', bulk_files))
+
+    results = {}
+    for name, insert in paths:
+        best = None
+        for _ in range(repeat):
+            cursor = conn.cursor()
+            cursor.execute(f'DELETE FROM {table}')
+            conn.commit()
+            start = time.perf_counter()
+            insert(cursor)
+            conn.commit()
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+            cursor.close()
+        results[name] = {'seconds': round(best, 3), 'rows_per_second': round(len(df) / best)}
+    for name, _ in paths[1:]:
+        results[name]['speedup'] = round(results['row_tuples']['seconds'] / results[name]['seconds'], 2)
+    return results
+
+def run_pipeline(conn_insert, manager, chunk_rows, skip_forecast):
+    """
+    Runs one execution of the pipeline (as main.main does) timing every stage.
+
+    Args:
+        conn_insert (sqlite3.Connection): The insertion connection.
+        manager (ConnectionManager): Provides the extraction and forecast connections.
+        chunk_rows (int): Rows per extraction chunk, 0 to read the new data at once.
+        skip_forecast (bool): Whether to skip the metrics and forecast stages.
+
+    Returns:
+        dict: The report of the stages.
+    """
+    from database_tools.backends import rows_exist
+    from database_tools.connections import EXTRACTION, INSERTION
+    from main_functions.inserting_data import check_tables_exist, fetch_new_data, fetch_new_data_chunks
+
+    timer = StageTimer()
+    check_tables_exist(conn_insert)
+    initial_load = not rows_exist(conn_insert.cursor(), 'FROM dbo.ConsumosMIPS')
+    initial_data = [] if initial_load else None
+
+    with manager.connection(EXTRACTION) as conn_fetch:
+        if chunk_rows <= 0:
+            new_data = timer.measure('extraction', fetch_new_data, conn_insert, conn_fetch)
+            update_stages(timer, conn_insert, new_data, initial_data)
+        else:
+            chunks = fetch_new_data_chunks(conn_insert, conn_fetch, chunk_rows)
+            while True:
+                start = time.perf_counter()
+                new_data = next(chunks, None)
+                if new_data is None:
+                    break
+                timer.add('extraction', time.perf_counter() - start, len(new_data))
+                update_stages(timer, conn_insert, new_data, initial_data)
+    if initial_data:
+        label_and_insert(timer, conn_insert, pd.concat(initial_data, ignore_index=True))
+
+    if not skip_forecast:
+        from main_functions.forecasting import calculate_metrics, forecast_and_insert, parameters
+
+        predictions_count, min_id_fecha, max_id_fecha = parameters(conn_insert)
+        if predictions_count != 0:
+            timer.measure('metrics', calculate_metrics, min_id_fecha, max_id_fecha, conn_insert, rows=predictions_count)
+            conn_insert.cursor().execute('DELETE FROM dbo.PrediccionesMIPS;')
+        with manager.connection(INSERTION) as engine:
+            timer.measure('forecast', forecast_and_insert, max_id_fecha, conn_insert, engine, rows=0)
+        forecast_rows = conn_insert.cursor().execute('SELECT COUNT(*) FROM dbo.PrediccionesMIPS').fetchone()[0]
+        timer.add('forecast', 0.0, forecast_rows)
+    conn_insert.commit()
+    return timer.report()
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the pipeline end to end on a synthetic workload with the embedded SQLite backend.')
+    parser.add_argument('--rows', type=int, default=100_000, help='Approximate rows of the initial load.')
+    parser.add_argument('--days', type=int, default=730,
+                        help='Dates of the initial load, ending on 2024-10-31. With an incremental load, at least the '
+                             f'{(INITIAL_LOAD_END - SERIES_START).days + 1} dates from {SERIES_START.date()}.')
+    parser.add_argument('--incremental-days', type=int, default=7, help='Dates of the incremental load, 0 to skip it.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the workload.')
+    parser.add_argument('--profile', nargs='+', default=SAMPLE_FILES, help='CSV samples the workload is fitted on.')
+    parser.add_argument('--workdir', help='Directory of the database files. Default is a temporary directory.')
+    parser.add_argument('--chunk-rows', type=int, default=0, help='EXTRACTION_CHUNK_ROWS of the runs.')
+    parser.add_argument('--skip-forecast', action='store_true', help='Skip the metrics and forecast stages.')
+    parser.add_argument('--insert-comparison', action='store_true',
+                        help='Also compare the former row tuple insert of dbo.ConsumosMIPS with bulk_insert on the initial load rows.')
+    parser.add_argument('--insert-dsn', help='ODBC connection string of a SQL Server database where the insert comparison is also run, in a temporary table. '
+                         'With BULK_LOAD_SERVER_DIRECTORY set, the opt-in BULK INSERT from data files is also timed.')
+    parser.add_argument('--output', help='Path of a JSON file where the results are written.')
+    args = parser.parse_args()
+    min_days = (INITIAL_LOAD_END - SERIES_START).days + 1
+    if args.incremental_days > 0 and args.days < min_days:
+        parser.error(f'--days must be at least {min_days} with an incremental load, so the initial load '
+                     f'includes {SERIES_START.date()}, the first date of the series statistics.')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='novelty-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    extraction_path = os.path.join(workdir, 'extraction.db')
+    insertion_path = os.path.join(workdir, 'insertion.db')
+    for path in (extraction_path, insertion_path):
+        if os.path.exists(path):
+            os.remove(path)
+    os.environ['STORAGE_BACKEND'] = 'sqlite'
+    os.environ['DB_NAME_EXTRACTION'] = extraction_path
+    os.environ['DB_NAME_INSERTIONS'] = insertion_path
+
+    from database_tools.backends import SQLiteBackend
+    from database_tools.connections import ConnectionManager
+
+    profile = fit_profile(args.profile)
+    processes = processes_for_rows(profile, args.rows, args.days)
+    start_date = INITIAL_LOAD_END - pd.Timedelta(days=args.days - 1)
+    start = time.perf_counter()
+    rows = write_sqlite(extraction_path, generate_workload(profile, processes, start_date, INITIAL_LOAD_END, args.seed))
+    print(f"Workload of {rows} rows and {processes} processes generated in {time.perf_counter() - start:.1f}s")
+
+    results = {
+        'rows': rows,
+        'processes': processes,
+        'chunk_rows': args.chunk_rows,
+        'runs': {}
+    }
+    conn_insert = SQLiteBackend().connect(insertion_path)
+    try:
+        with ConnectionManager() as manager:
+            results['runs']['initial'] = run_pipeline(conn_insert, manager, args.chunk_rows, args.skip_forecast)
+            if args.insert_comparison:
+                consumptions = pd.read_sql('SELECT * FROM dbo.ConsumosMIPS', conn_insert)
+            if args.incremental_days > 0:
+                first_date = INITIAL_LOAD_END + pd.Timedelta(days=1)
+                last_date = INITIAL_LOAD_END + pd.Timedelta(days=args.incremental_days)
+                write_sqlite(extraction_path, generate_workload(profile, processes, first_date, last_date, args.seed))
+                results['runs']['incremental'] = run_pipeline(conn_insert, manager, args.chunk_rows, args.skip_forecast)
+    finally:
+        conn_insert.close()
+
+    if args.insert_comparison:
+        print("Comparing the inserts of dbo.ConsumosMIPS...")
+        comparison_path = os.path.join(workdir, 'insert.db')
+        if os.path.exists(comparison_path):
+            os.remove(comparison_path)
+        conn = SQLiteBackend().connect(comparison_path)
+        conn.execute(f'CREATE TABLE dbo.ConsumosMIPSBenchmark ({BENCHMARK_TABLE_COLUMNS})')
+        results['insert_comparison'] = {'sqlite': compare_inserts(conn, 'dbo.ConsumosMIPSBenchmark', consumptions)}
+        conn.close()
+        if args.insert_dsn:
+            import pyodbc
+            conn = pyodbc.connect(args.insert_dsn)
+            conn.cursor().execute(f'CREATE TABLE #ConsumosMIPSBenchmark ({BENCHMARK_TABLE_COLUMNS})')
+            results['insert_comparison']['sqlserver'] = compare_inserts(conn, '#ConsumosMIPSBenchmark', consumptions)
+            conn.close()
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    print("")
+    for run, stages in results['runs'].items():
+        print(f"{run} load:")
+        for stage, values in stages.items():
+            print(f"  {stage:<20} {values['seconds']:>10.3f}s {values['rows']:>12} rows {values['rows_per_second'] or 0:>12} rows/s")
+    for backend, comparison in results.get('insert_comparison', {}).items():
+        print(f"Insert of {len(consumptions)} rows in {backend}:")
+        for path, values in comparison.items():
+            speedup = f" {values['speedup']}x" if 'speedup' in values else ''
+            print(f"  {path:<20} {values['seconds']:>10.3f}s {values['rows_per_second']:>12} rows/s{speedup}")
+    print(f"Peak RSS: {results['peak_rss_mb']} MB")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""DETECTOR-DE-NOVEDADES/experiment/benchmark/workload_generator.py"""
+import argparse
+import math
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+SOURCE_COLUMNS = ['NombreProceso', 'NombreGrupo', 'Fecha', 'total_ejecucionesFecha', 'total_mipsFecha']
+SAMPLE_FILES = [
+    os.path.join(os.path.dirname(__file__), '..', 'notebooks', f'df{i}.csv') for i in (1, 2, 3)
+]
+# Series with less observations than this are not used as templates
+MIN_TEMPLATE_POINTS = 30
+
+def fit_profile(csv_paths=SAMPLE_FILES) -> dict:
+    """
+    Learns the distributions of the source view from sample extractions.
+
+    Every (NombreProceso, NombreGrupo) series of the samples becomes a template with:
+    - the fraction of dates on which it has data,
+    - the mean and standard deviation of log(executions) and of log(MIPS per execution).
+    The standardized residuals of all templates are pooled, so the generated values keep the
+    heavy tails of the samples, and their mean per weekday gives the weekday effects. The generated
+    values are kept within the (log) range of the samples.
+
+    Parameters:
+    csv_paths (list of str): CSV files with the columns of the source view. Default are the notebooks samples.
+
+    Returns:
+    dict: The profile, with the keys 'templates', 'groups', 'groups_per_process', 'weekday_effects',
+    'execution_residuals', 'ratio_residuals', 'scale_spread', 'executions_range' and 'ratio_range'.
+    """
+    data = pd.concat([pd.read_csv(path) for path in csv_paths], ignore_index=True)
+    data['Fecha'] = pd.to_datetime(data['Fecha'])
+    data = data[(data['total_ejecucionesFecha'] > 0) & (data['total_mipsFecha'] > 0)]
+    days = data['Fecha'].nunique()
+
+    templates = []
+    execution_residuals = []
+    ratio_residuals = []
+    weekday_residuals = []
+    for (_, group), series in data.groupby(['NombreProceso', 'NombreGrupo']):
+        if len(series) < MIN_TEMPLATE_POINTS:
+            continue
+        log_executions = np.log(series['total_ejecucionesFecha'].to_numpy(dtype=np.float64))
+        log_ratio = np.log(series['total_mipsFecha'].to_numpy(dtype=np.float64)) - log_executions
+        template = {
+            'group': group,
+            'presence': len(series) / days,
+            'executions_mean': float(log_executions.mean()),
+            'executions_std': float(log_executions.std()) or 1e-3,
+            'ratio_mean': float(log_ratio.mean()),
+            'ratio_std': float(log_ratio.std()) or 1e-3
+        }
+        templates.append(template)
+        standardized = (log_executions - template['executions_mean']) / template['executions_std']
+        execution_residuals.append(standardized)
+        ratio_residuals.append((log_ratio - template['ratio_mean']) / template['ratio_std'])
+        weekday_residuals.append(pd.Series(standardized, index=series['Fecha'].dt.dayofweek.to_numpy()))
+
+    weekday_effects = pd.concat(weekday_residuals).groupby(level=0).mean().reindex(range(7), fill_value=0.0)
+    execution_residuals = np.concatenate(execution_residuals)
+    log_executions = np.log(data['total_ejecucionesFecha'].to_numpy(dtype=np.float64))
+    log_ratio = np.log(data['total_mipsFecha'].to_numpy(dtype=np.float64)) - log_executions
+    return {
+        'templates': templates,
+        'groups': data['NombreGrupo'].value_counts(normalize=True).to_dict(),
+        'groups_per_process': data.groupby('NombreProceso')['NombreGrupo'].nunique().tolist(),
+        'weekday_effects': weekday_effects.tolist(),
+        'execution_residuals': execution_residuals.tolist(),
+        'ratio_residuals': np.concatenate(ratio_residuals).tolist(),
+        'scale_spread': float(np.std([template['executions_mean'] for template in templates])),
+        'executions_range': [float(log_executions.min()), float(log_executions.max())],
+        'ratio_range': [float(log_ratio.min()), float(log_ratio.max())]
+    }
+
+def processes_for_rows(profile: dict, rows: int, days: int) -> int:
+    """
+    Calculates the number of processes needed to generate about the given number of rows.
+
+    Parameters:
+    profile (dict): Profile returned by fit_profile.
+    rows (int): Target number of rows.
+    days (int): Number of generated dates.
+
+    Returns:
+    int: The number of processes.
+    """
+    groups = np.mean(profile['groups_per_process'])
+    presence = np.mean([template['presence'] for template in profile['templates']])
+    return max(1, math.ceil(rows / (days * groups * presence)))
+
+def build_series(profile: dict, processes: int, rng: np.random.Generator) -> pd.DataFrame:
+    """
+    Draws the series of the generated processes: every process gets a number of groups like the samples,
+    and every (process, group) series the parameters of a random template, with its scale shifted by the
+    spread observed between the templates.
+
+    Parameters:
+    profile (dict): Profile returned by fit_profile.
+    processes (int): Number of processes.
+    rng (np.random.Generator): Random generator.
+
+    Returns:
+    pd.DataFrame: One row per series with its names and parameters.
+    """
+    group_names = np.array(list(profile['groups']))
+    group_weights = np.array(list(profile['groups'].values()))
+    counts = rng.choice(profile['groups_per_process'], size=processes)
+    counts = np.minimum(counts, len(group_names))
+
+    process_names = []
+    groups = []
+    for process, count in enumerate(counts):
+        process_names.extend([f'SINTETICO/PROCESO{process:07d}'] * count)
+        groups.extend(rng.choice(group_names, size=count, replace=False, p=group_weights))
+
+    templates = pd.DataFrame(profile['templates'])
+    series = templates.iloc[rng.integers(0, len(templates), size=len(groups))].reset_index(drop=True)
+    series['executions_mean'] += rng.normal(0.0, profile['scale_spread'], size=len(series))
+    series['NombreProceso'] = process_names
+    series['NombreGrupo'] = groups
+    return series
+
+def generate_workload(profile: dict, processes: int, start_date, end_date, seed: int = 0, chunk_days: int = 30):
+    """
+    Generates the rows of the source view for the given processes and dates, in date order.
+    The data is yielded in chunks of whole dates, so datasets larger than memory can be written.
+
+    Parameters:
+    profile (dict): Profile returned by fit_profile.
+    processes (int): Number of processes.
+    start_date (datetime-like): First generated date.
+    end_date (datetime-like): Last generated date.
+    seed (int, optional): Seed of the random generator. The same seed gives the same series. Default is 0.
+    chunk_days (int, optional): Number of dates of each chunk. Default is 30.
+
+    Yields:
+    pd.DataFrame: The rows of chunk_days dates, with the columns of the source view and the dates as 'YYYY-MM-DD' text.
+    """
+    # The series only depend on the seed, so consecutive date ranges continue the same workload
+    series = build_series(profile, processes, np.random.default_rng(seed))
+    weekday_effects = np.asarray(profile['weekday_effects'])
+    execution_residuals = np.asarray(profile['execution_residuals'])
+    ratio_residuals = np.asarray(profile['ratio_residuals'])
+    presence = series['presence'].to_numpy()
+
+    dates = pd.date_range(start_date, end_date)
+    rng = np.random.default_rng([seed, dates[0].toordinal()])
+    for first in range(0, len(dates), chunk_days):
+        chunk_dates = dates[first:first + chunk_days]
+        present = rng.random((len(chunk_dates), len(series))) < presence
+        day_index, series_index = np.nonzero(present)
+        selected = series.iloc[series_index]
+
+        log_executions = (
+            selected['executions_mean'].to_numpy()
+            + selected['executions_std'].to_numpy() * (
+                weekday_effects[chunk_dates.dayofweek[day_index]]
+                + rng.choice(execution_residuals, size=len(day_index))
+            )
+        )
+        log_executions = np.clip(log_executions, *profile['executions_range'])
+        executions = np.maximum(1, np.rint(np.exp(log_executions))).astype(np.int64)
+        log_ratio = np.clip(
+            selected['ratio_mean'].to_numpy()
+            + selected['ratio_std'].to_numpy() * rng.choice(ratio_residuals, size=len(day_index)),
+            *profile['ratio_range']
+        )
+        yield pd.DataFrame({
+            'NombreProceso': selected['NombreProceso'].to_numpy(),
+            'NombreGrupo': selected['NombreGrupo'].to_numpy(),
+            'Fecha': chunk_dates.strftime('%Y-%m-%d')[day_index],
+            'total_ejecucionesFecha': executions,
+            'total_mipsFecha': executions * np.exp(log_ratio)
+        })
+
+def write_sqlite(path: str, chunks, table: str = 'refrescarprocesos_10dias') -> int:
+    """
+    Appends the generated chunks to a table of a SQLite database, which can be used as the extraction
+    database of the embedded storage backend.
+
+    Parameters:
+    path (str): Path of the database file.
+    chunks (iterable of pd.DataFrame): Chunks returned by generate_workload.
+    table (str, optional): Name of the table. Default is the source view of the pipeline.
+
+    Returns:
+    int: The number of written rows.
+    """
+    rows = 0
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                NombreProceso TEXT, NombreGrupo TEXT, Fecha TEXT,
+                total_ejecucionesFecha INTEGER, total_mipsFecha REAL
+            )
+        """)
+        connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_fecha ON {table} (Fecha)')
+        for chunk in chunks:
+            connection.executemany(
+                f'INSERT INTO {table} VALUES (?, ?, ?, ?, ?)',
+                chunk[SOURCE_COLUMNS].itertuples(index=False, name=None)
+            )
+            connection.commit()
+            rows += len(chunk)
+    finally:
+        connection.close()
+    return rows
+
+def write_csv(path: str, chunks) -> int:
+    """
+    Writes the generated chunks to a CSV file with the columns of the samples.
+
+    Parameters:
+    path (str): Path of the CSV file.
+    chunks (iterable of pd.DataFrame): Chunks returned by generate_workload.
+
+    Returns:
+    int: The number of written rows.
+    """
+    rows = 0
+    for chunk in chunks:
+        chunk[SOURCE_COLUMNS].to_csv(path, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+        rows += len(chunk)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic extraction of the MIPS consumptions.')
+    parser.add_argument('output', help='Output file: a SQLite database (.db) or a CSV file (.csv).')
+    parser.add_argument('--rows', type=int, default=100_000, help='Approximate number of rows.')
+    parser.add_argument('--end-date', default='2024-10-31', help='Last generated date.')
+    parser.add_argument('--days', type=int, default=730, help='Number of generated dates.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator.')
+    args = parser.parse_args()
+
+    profile = fit_profile()
+    processes = processes_for_rows(profile, args.rows, args.days)
+    start_date = pd.Timestamp(args.end_date) - pd.Timedelta(days=args.days - 1)
+    chunks = generate_workload(profile, processes, start_date, args.end_date, args.seed)
+    write = write_csv if args.output.endswith('.csv') else write_sqlite
+    rows = write(args.output, chunks)
+    print(f"{rows} rows of {processes} processes written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,9 @@ import scipy.stats as stats
 import scikit_posthocs as sp
 import matplotlib.pyplot as plt
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
-from app.database_tools.connections import connect_to_fetch_data
+from app.database_tools.connections import EXTRACTION, ConnectionManager
 
-conn_fetch = connect_to_fetch_data()
+conn_fetch = ConnectionManager().engine(EXTRACTION).connect()
 
 query = "SELECT * FROM dbo.refrescarprocesos_10dias"
 
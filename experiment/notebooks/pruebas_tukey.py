@@ -3,7 +3,7 @@ import scipy.stats as stats
 import scikit_posthocs as sp
 import matplotlib.pyplot as plt
 from statsmodels.stats.multicomp import pairwise_tukeyhsd
-from database_tools.connections import connect_to_fetch_data
+from database_tools.connections import EXTRACTION, ConnectionManager
 
 def fetch_new_data(conn_fetch):
     query = "SELECT * FROM dbo.refrescarprocesos_10dias"
@@ -61,7 +61,7 @@ def perform_kruskal_wallis(segment1, segment2, segment3, segment4):
     print(dunn_result)
 
 def main():
-    conn_fetch = connect_to_fetch_data()
+    conn_fetch = ConnectionManager().engine(EXTRACTION).connect()
     df = fetch_new_data(conn_fetch)
 
     segment1, segment2, segment3, segment4 = segment_data(df)
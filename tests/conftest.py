@@ -0,0 +1,6 @@
+"""DETECTOR-DE-NOVEDADES/tests/conftest.py"""
+import os
+import sys
+
+# The modules of the application import each other from the app directory, the same as main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
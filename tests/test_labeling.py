@@ -0,0 +1,31 @@
+"""DETECTOR-DE-NOVEDADES/tests/test_labeling.py"""
+import numpy as np
+import pandas as pd
+import pytest
+from detection_tools.robust_stats import group_robust_stats
+from main_functions.novelty_detection import atypical_bounds, label_atypical_array, label_atypical_values
+
+METHODS = ['MAD', 'MADadj', 'IQR']
+
+def test_array_labels_match_label_atypical_values():
+    rng = np.random.default_rng(1)
+    stored = [rng.gamma(2, 50, size) for size in (1, 4, 19, 20, 80)] + [np.full(30, 12.0)]
+    new = [np.append(rng.gamma(2, 50, 10), [0.0, 5000.0]) for _ in stored]
+    codes = np.repeat(np.arange(len(stored)), [len(values) for values in stored])
+    series_stats = group_robust_stats(codes, np.concatenate(stored), len(stored))
+    series = np.repeat(np.arange(len(new)), [len(values) for values in new])
+
+    for method in METHODS:
+        lower_bound, upper_bound = atypical_bounds(
+            np.full(len(stored), method), series_stats['median'], series_stats['mad'], series_stats['q1'], series_stats['q3']
+        )
+        labels = label_atypical_array(np.concatenate(new), lower_bound, upper_bound, series)
+        expected = np.concatenate([
+            label_atypical_values(pd.DataFrame({'ConsumoMIPS': values}), method, history)['IdAtipico'].to_numpy()
+            for values, history in zip(new, stored)
+        ])
+        np.testing.assert_array_equal(labels, expected)
+
+def test_atypical_bounds_reject_unknown_methods():
+    with pytest.raises(ValueError):
+        atypical_bounds(['MAD', 'Tukey'], [1.0, 1.0], [0.5, 0.5])
@@ -0,0 +1,104 @@
+"""DETECTOR-DE-NOVEDADES/tests/test_metrics.py"""
+import numpy as np
+import pandas as pd
+import pytest
+from forecast_tools.metrics import METRIC_NAMES, MetricsAccumulator, error_terms, metrics, observation_counts
+
+LAST_METRICS = {"MAE": 12.0, "MSE": 300.0, "RMSE": np.sqrt(300.0), "MAPE": 8.0, "sMAPE": 7.5}
+
+@pytest.fixture
+def daily():
+    """Daily consumptions and predictions from the middle of a month, with some zero actuals."""
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2024-01-15', '2024-04-20')
+    y_true = rng.gamma(2, 500, len(dates))
+    y_true[[3, 40]] = 0
+    y_pred = y_true * rng.normal(1, 0.1, len(dates))
+    y_pred[40] = 0
+    return dates, y_true, y_pred
+
+def scalar_metrics(y_true, y_pred, n, last_metrics):
+    """Applies metrics() one observation at a time, feeding each result to the next one."""
+    values = {name: [] for name in METRIC_NAMES}
+    for n_value, true_value, pred_value in zip(n, y_true, y_pred):
+        last_metrics = metrics(int(n_value), true_value, pred_value, last_metrics)
+        for name in METRIC_NAMES:
+            values[name].append(last_metrics[name])
+    return values
+
+def assert_metrics_close(result, expected):
+    for name in METRIC_NAMES:
+        np.testing.assert_allclose(result[name], expected[name], rtol=1e-9, atol=1e-9)
+
+def test_first_load_accumulates_from_the_first_date(daily):
+    _, y_true, y_pred = daily
+    expected = scalar_metrics(y_true, y_pred, np.arange(1, len(y_true) + 1), dict.fromkeys(METRIC_NAMES, 0.0))
+    assert_metrics_close(MetricsAccumulator().running(y_true, y_pred)["metrics"], expected)
+
+def test_monthly_metrics_restart_every_month(daily):
+    dates, y_true, y_pred = daily
+    # The monthly state of the day before the first date summarizes the previous days of the month
+    month_change = np.r_[False, dates.month[1:] != dates.month[:-1]]
+    n = np.where(month_change, 1, dates.day)
+    expected = scalar_metrics(y_true, y_pred, n, LAST_METRICS)
+    accumulator = MetricsAccumulator.from_metrics(LAST_METRICS, dates[0].day - 1)
+    assert_metrics_close(accumulator.running(y_true, y_pred, month_change)["metrics"], expected)
+
+def test_historical_metrics_continue_the_stored_count(daily):
+    _, y_true, y_pred = daily
+    expected = scalar_metrics(y_true, y_pred, np.arange(101, len(y_true) + 101), LAST_METRICS)
+    accumulator = MetricsAccumulator.from_metrics(LAST_METRICS, 100)
+    assert_metrics_close(accumulator.running(y_true, y_pred)["metrics"], expected)
+
+def test_observation_counts_restart_at_the_resets():
+    resets = np.array([False, False, True, False, False, True, False])
+    np.testing.assert_array_equal(observation_counts(len(resets), resets, initial_count=10), [11, 12, 1, 2, 3, 1, 2])
+    np.testing.assert_array_equal(observation_counts(3, initial_count=4), [5, 6, 7])
+
+def test_error_terms_of_zero_actuals():
+    terms = error_terms([0.0, 0.0, 10.0], [0.0, 5.0, 5.0])
+    np.testing.assert_array_equal(terms["percentage"], [0.0, 0.0, 50.0])
+    np.testing.assert_allclose(terms["symmetric"], [0.0, 200.0, 200 * 5 / 15])
+
+def test_accumulator_matches_the_scalar_functions(daily):
+    _, y_true, y_pred = daily
+    count = 40
+    expected = scalar_metrics(y_true, y_pred, np.arange(count + 1, len(y_true) + count + 1), LAST_METRICS)
+
+    accumulator = MetricsAccumulator.from_metrics(LAST_METRICS, count)
+    accumulator.update(y_true[:30], y_pred[:30])
+    for true_value, pred_value in zip(y_true[30:], y_pred[30:]):
+        accumulator.update(true_value, pred_value)
+
+    result = accumulator.metrics()
+    for name in METRIC_NAMES:
+        assert result[name] == pytest.approx(expected[name][-1], rel=1e-9)
+
+def test_accumulator_running_with_resets_matches_the_scalar_functions(daily):
+    _, y_true, y_pred = daily
+    resets = np.zeros(len(y_true), dtype=bool)
+    resets[[17, 48, 77]] = True
+    n = observation_counts(len(y_true), resets, initial_count=30)
+    expected = scalar_metrics(y_true, y_pred, n, LAST_METRICS)
+
+    accumulator = MetricsAccumulator.from_metrics(LAST_METRICS, 30)
+    result = accumulator.running(y_true, y_pred, resets)
+    assert_metrics_close(result["metrics"], expected)
+    np.testing.assert_array_equal(result["count"], n)
+    assert accumulator.count == n[-1]
+
+def test_accumulator_resumes_from_a_stored_state(daily):
+    _, y_true, y_pred = daily
+    expected = MetricsAccumulator().running(y_true, y_pred)
+
+    # The state stored with the row of a date is the accumulator the next run starts from
+    first = MetricsAccumulator().running(y_true[:50], y_pred[:50])
+    stored = MetricsAccumulator(first["count"][-1], {term: first["sums"][term][-1] for term in MetricsAccumulator.TERMS})
+    result = stored.running(y_true[50:], y_pred[50:])
+    for name in METRIC_NAMES:
+        np.testing.assert_allclose(result["metrics"][name], expected["metrics"][name][50:], rtol=1e-12)
+
+def test_accumulator_reset():
+    accumulator = MetricsAccumulator().update([1.0, 2.0], [2.0, 2.0]).reset()
+    assert accumulator.count == 0
+    assert accumulator.metrics() == dict.fromkeys(METRIC_NAMES, 0.0)
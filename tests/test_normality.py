@@ -0,0 +1,72 @@
+"""DETECTOR-DE-NOVEDADES/tests/test_normality.py"""
+import numpy as np
+import pytest
+import scipy.stats as stats
+from detection_tools.normality import merge_moments, moments_normal, segment_moments, segment_normal
+from detection_tools.robust_stats import segment_shapiro_normal
+from monitoring_tools.instrumentation import start_run
+
+@pytest.fixture
+def series():
+    """
+    Gaussian, skewed, heavy-tailed and short series stored one after the other, with their offsets.
+    The samples are fixed: with another seed a Gaussian series can be rejected by chance at alpha = 0.05.
+    """
+    rng = np.random.default_rng(1)
+    groups = (
+        [rng.normal(300, 30, size) for size in (20, 45, 120, 400, 1_000)]
+        + [rng.exponential(100, size) for size in (30, 200, 800)]
+        + [rng.standard_t(2, size) for size in (60, 500)]
+        + [rng.normal(0, 1, 8)]
+    )
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    np.cumsum([len(group) for group in groups], out=offsets[1:])
+    return groups, np.concatenate(groups), offsets
+
+def test_moments_normal_matches_normaltest(series):
+    groups, values, offsets = series
+    moments = segment_moments(values, offsets)
+    normal = moments_normal(moments['n'], moments['m2'], moments['m3'], moments['m4'])
+    expected = [len(group) >= 20 and stats.normaltest(group).pvalue > 0.05 for group in groups]
+    np.testing.assert_array_equal(normal, expected)
+
+def test_merged_moments_match_the_moments_of_all_the_values(series):
+    _, values, offsets = series
+    # Every series is split in an old and a new part, the new part of the last one is empty
+    cut = offsets[:-1] + np.diff(offsets) * 2 // 3
+    cut[-1] = offsets[-1]
+    old = np.concatenate([values[start:middle] for start, middle in zip(offsets[:-1], cut)])
+    new = np.concatenate([values[middle:end] for middle, end in zip(cut, offsets[1:])])
+    old_offsets = np.r_[0, np.cumsum(cut - offsets[:-1])]
+    new_offsets = np.r_[0, np.cumsum(offsets[1:] - cut)]
+
+    merged = merge_moments(segment_moments(old, old_offsets), segment_moments(new, new_offsets))
+    expected = segment_moments(values, offsets)
+    for key in ('n', 'mean', 'm2', 'm3', 'm4'):
+        np.testing.assert_allclose(merged[key], expected[key], rtol=1e-9)
+
+def test_shapiro_method_is_the_default(series, monkeypatch):
+    _, values, offsets = series
+    monkeypatch.delenv('NORMALITY_TEST', raising=False)
+    selected = np.diff(offsets) >= 20
+    np.testing.assert_array_equal(segment_normal(values, offsets, selected), segment_shapiro_normal(values, offsets, selected))
+
+def test_recheck_agrees_with_shapiro(series, monkeypatch):
+    groups, values, offsets = series
+    monkeypatch.setenv('NORMALITY_TEST', 'moments')
+    monkeypatch.setenv('NORMALITY_RECHECK_EVERY', '10')
+    report = start_run()
+    selected = np.diff(offsets) >= 20
+    # Only the series whose size reached a multiple of 10 with the last 5 values are checked
+    added = np.full(len(groups), 5)
+
+    normal = segment_normal(values, offsets, selected, added=added)
+
+    checked = selected & (np.diff(offsets) % 10 < 5)
+    shapiro = segment_shapiro_normal(values, offsets, checked)
+    assert report.events['normality_rechecks'] == checked.sum()
+    assert report.events['normality_disagreements'] == (normal != shapiro)[checked].sum()
+    # The Gaussian series are normal and the skewed and heavy-tailed ones are not, for both tests
+    np.testing.assert_array_equal(normal[checked], shapiro[checked])
+    np.testing.assert_array_equal(normal[:5], [True] * 5)
+    assert not normal[5:].any()
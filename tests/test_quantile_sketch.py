@@ -0,0 +1,51 @@
+"""DETECTOR-DE-NOVEDADES/tests/test_quantile_sketch.py"""
+import numpy as np
+import pytest
+import scipy.stats as stats
+from detection_tools.quantile_sketch import QuantileSketch, capacity_for_error
+
+QUANTILES = np.linspace(0.01, 0.99, 99)
+
+def rank_error(sketch, values, q):
+    """Distance between q and the fraction of the values not above the estimated q-quantile."""
+    return abs(np.searchsorted(np.sort(values), sketch.quantile(q), side='right') / len(values) - q)
+
+@pytest.mark.parametrize('epsilon', [0.05, 0.01])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_rank_error_within_sketch_epsilon(epsilon, seed):
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(2, 50, 50_000)
+    sketch = QuantileSketch(capacity_for_error(epsilon))
+    # The values arrive day after day, as in the incremental load
+    for day in np.array_split(values, 365):
+        sketch.update(day)
+
+    assert not sketch.is_exact
+    assert max(rank_error(sketch, values, q) for q in QUANTILES) <= epsilon
+
+def test_merged_sketch_within_sketch_epsilon():
+    epsilon = 0.01
+    rng = np.random.default_rng(3)
+    first, second = rng.gamma(2, 50, 30_000), rng.normal(400, 20, 20_000)
+    sketch = QuantileSketch.from_values(first, capacity_for_error(epsilon))
+    sketch.merge(QuantileSketch.from_values(second, capacity_for_error(epsilon)))
+
+    values = np.concatenate([first, second])
+    assert sketch.n == len(values)
+    assert max(rank_error(sketch, values, q) for q in QUANTILES) <= epsilon
+
+def test_exact_below_capacity():
+    values = np.random.default_rng(4).gamma(2, 50, 150)
+    sketch = QuantileSketch.from_values(values, capacity_for_error(0.01))
+
+    assert sketch.is_exact
+    assert sketch.median() == np.median(values)
+    assert sketch.median_abs_deviation() == stats.median_abs_deviation(values)
+    assert sketch.quantile(0.25) == np.quantile(values, 0.25)
+
+def test_serialization_keeps_the_estimates():
+    sketch = QuantileSketch.from_values(np.random.default_rng(5).gamma(2, 50, 10_000), capacity_for_error(0.01))
+    restored = QuantileSketch.from_bytes(sketch.to_bytes())
+
+    assert (restored.n, restored.min, restored.max) == (sketch.n, sketch.min, sketch.max)
+    assert [restored.quantile(q) for q in QUANTILES] == [sketch.quantile(q) for q in QUANTILES]
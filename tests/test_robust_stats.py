@@ -0,0 +1,65 @@
+"""DETECTOR-DE-NOVEDADES/tests/test_robust_stats.py"""
+import numpy as np
+import pytest
+import scipy.stats as stats
+from detection_tools.robust_stats import group_robust_stats, group_values, segment_quantile, segment_robust_stats
+
+# Sizes of the ragged groups: empty, single row, short (< 20 values) and long series
+GROUP_SIZES = [0, 1, 2, 3, 5, 19, 20, 21, 57, 300]
+
+@pytest.fixture
+def ragged_groups():
+    """Values of groups of GROUP_SIZES plus two constant groups, in shuffled order, with their codes."""
+    rng = np.random.default_rng(0)
+    groups = [rng.gamma(2, 50, size) for size in GROUP_SIZES]
+    # Rounded values have ties, so the interpolation of the quantiles falls between equal values
+    groups.append(np.round(rng.gamma(2, 5, 40)))
+    groups.append(np.full(25, 7.5))
+    groups.append(np.full(3, -2.0))
+    codes = np.concatenate([np.full(len(values), g) for g, values in enumerate(groups)]).astype(np.int64)
+    values = np.concatenate(groups)
+    order = rng.permutation(len(values))
+    return groups, codes[order], values[order]
+
+def test_group_robust_stats_match_numpy_and_scipy(ragged_groups):
+    groups, codes, values = ragged_groups
+    result = group_robust_stats(codes, values, len(groups))
+
+    for g, group in enumerate(groups):
+        assert result['n'][g] == len(group)
+        if len(group) == 0:
+            assert all(np.isnan(result[key][g]) for key in ('median', 'mad', 'q1', 'q3', 'ptp'))
+            continue
+        assert result['median'][g] == np.median(group)
+        assert result['mad'][g] == stats.median_abs_deviation(group)
+        assert result['q1'][g] == np.quantile(group, 0.25)
+        assert result['q3'][g] == np.quantile(group, 0.75)
+        assert result['ptp'][g] == np.ptp(group)
+
+def test_constant_and_single_row_groups(ragged_groups):
+    groups, codes, values = ragged_groups
+    result = group_robust_stats(codes, values, len(groups))
+    sizes = np.array([len(group) for group in groups])
+
+    constant = np.flatnonzero([len(group) > 0 and np.ptp(group) == 0 for group in groups])
+    assert np.all(result['ptp'][constant] == 0)
+    assert np.all(result['mad'][constant] == 0)
+    single = np.flatnonzero(sizes == 1)
+    assert np.all(result['median'][single] == [groups[g][0] for g in single])
+
+@pytest.mark.parametrize('q', [0, 0.1, 0.25, 0.5, 0.75, 0.9, 1])
+def test_segment_quantile_matches_np_quantile(ragged_groups, q):
+    groups, codes, values = ragged_groups
+    sorted_values, offsets = group_values(codes, values, len(groups))
+    result = segment_quantile(sorted_values, offsets, q)
+    expected = [np.quantile(group, q) if len(group) else np.nan for group in groups]
+    np.testing.assert_array_equal(result, expected)
+
+def test_segment_robust_stats_match_group_robust_stats(ragged_groups):
+    groups, codes, values = ragged_groups
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    np.cumsum([len(group) for group in groups], out=offsets[1:])
+    segmented = segment_robust_stats(np.concatenate(groups), offsets)
+    grouped = group_robust_stats(codes, values, len(groups))
+    for key in grouped:
+        np.testing.assert_array_equal(segmented[key], grouped[key])
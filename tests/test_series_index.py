@@ -0,0 +1,73 @@
+"""DETECTOR-DE-NOVEDADES/tests/test_series_index.py"""
+import numpy as np
+import pandas as pd
+import pytest
+from detection_tools.series_index import SeriesIndex
+
+SERIES_KEYS = ['IdProceso', 'IdGrupo', 'IdDiaSemana']
+
+@pytest.fixture
+def rows():
+    """Stored consumptions of many series of every length, in the order they were stored."""
+    rng = np.random.default_rng(0)
+    n = 5_000
+    return pd.DataFrame({
+        'IdProceso': rng.integers(1, 60, n),
+        'IdGrupo': rng.integers(1, 4, n),
+        'IdDiaSemana': rng.integers(1, 8, n),
+        'ConsumoMIPS': rng.gamma(2, 50, n)
+    })
+
+def grouped(rows):
+    """Values of every series with a pandas groupby, in the order they were stored."""
+    return {key: group.to_numpy() for key, group in rows.groupby(SERIES_KEYS)['ConsumoMIPS']}
+
+def as_dict(index):
+    return {tuple(key): index.series(series_id) for series_id, key in enumerate(index.keys.tolist())}
+
+def assert_same_series(index, expected):
+    result = as_dict(index)
+    assert result.keys() == expected.keys()
+    for key, values in expected.items():
+        np.testing.assert_array_equal(result[key], values)
+
+def test_from_rows_matches_groupby(rows):
+    index = SeriesIndex.from_rows(rows[SERIES_KEYS].to_numpy(), rows['ConsumoMIPS'].to_numpy())
+    assert_same_series(index, grouped(rows))
+    assert index.offsets[-1] == len(rows)
+    np.testing.assert_array_equal(index.sizes(), [len(values) for values in as_dict(index).values()])
+
+def test_append_matches_groupby_of_all_the_rows(rows):
+    stored, new = rows.iloc[:4_000], rows.iloc[4_000:]
+    # Series that only appear in the new rows are created
+    new = pd.concat([new, pd.DataFrame({'IdProceso': [99, 99], 'IdGrupo': [1, 1], 'IdDiaSemana': [3, 3], 'ConsumoMIPS': [1.0, 2.0]})])
+    index = SeriesIndex.from_rows(stored[SERIES_KEYS].to_numpy(), stored['ConsumoMIPS'].to_numpy())
+    for _, day in new.groupby(np.arange(len(new)) // 250):
+        index.append(day[SERIES_KEYS].to_numpy(), day['ConsumoMIPS'].to_numpy())
+    assert_same_series(index, grouped(pd.concat([stored, new])))
+
+def test_ids_subset_and_gather(rows):
+    index = SeriesIndex.from_rows(rows[SERIES_KEYS].to_numpy(), rows['ConsumoMIPS'].to_numpy())
+    expected = grouped(rows)
+    keys = np.array(list(expected)[::7] + [(1000, 1, 1)])
+
+    ids = index.ids(keys)
+    assert ids[-1] == -1
+    assert (1000, 1, 1) not in index and tuple(keys[0]) in index
+    values, offsets = index.gather(ids[:-1])
+    for i, key in enumerate(map(tuple, keys[:-1].tolist())):
+        np.testing.assert_array_equal(values[offsets[i]:offsets[i + 1]], expected[key])
+    assert_same_series(index.subset(keys), {tuple(key): expected[tuple(key)] for key in keys[:-1].tolist()})
+
+def test_merge_replaces_the_series_of_the_other_index(rows):
+    index = SeriesIndex.from_rows(rows[SERIES_KEYS].to_numpy(), rows['ConsumoMIPS'].to_numpy())
+    expected = grouped(rows)
+    keys = np.array(list(expected)[::5])
+    updated = index.subset(keys)
+    updated.append(np.vstack([keys, [[99, 1, 3]]]), np.arange(len(keys) + 1, dtype=np.float64))
+
+    merged = index.merge(updated)
+    for i, key in enumerate(map(tuple, keys.tolist())):
+        expected[key] = np.append(expected[key], i)
+    expected[(99, 1, 3)] = np.array([float(len(keys))])
+    assert_same_series(merged, expected)